@@ -0,0 +1,84 @@
+"""
+Recall and latency of the IVF product index against exact search.
+
+Builds an index over synthetic clustered embeddings (or a real catalog index
+directory with --index) and reports, per n_probe, recall@k against
+brute-force search and query latency for single and batched queries.
+
+    python benchmarks/ann_benchmark.py --products 100000 --dim 256
+    python benchmarks/ann_benchmark.py --index catalog_index/
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from src.backend.vectors import VectorIndex, build_vector_index  # noqa: E402
+
+
+def synthetic_embeddings(products: int, dim: int, clusters: int, rng) -> np.ndarray:
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, clusters, size=products)
+    return centers[labels] + 1.2 * rng.standard_normal((products, dim)).astype(np.float32)
+
+
+def timed(fn, repeat: int) -> float:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - started) / repeat
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--index", help="Existing catalog index directory with an embedding index")
+    parser.add_argument("--products", type=int, default=100_000)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--clusters", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=256)
+    parser.add_argument("--batch", type=int, default=32)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--dtype", choices=("float16", "float32"), default="float16")
+    args = parser.parse_args()
+    rng = np.random.default_rng(0)
+
+    with tempfile.TemporaryDirectory() as scratch:
+        if args.index:
+            directory = args.index
+            index = VectorIndex.open(directory)
+            sample = rng.choice(index.size, size=args.queries, replace=False)
+            base = np.asarray(index._vectors, dtype=np.float32)[np.argsort(index._ids)][sample]
+        else:
+            directory = scratch
+            embeddings = synthetic_embeddings(args.products, args.dim, args.clusters, rng)
+            started = time.perf_counter()
+            lists = build_vector_index(embeddings, directory, embedder="synthetic", dtype=args.dtype)
+            print(f"built {args.products} x {args.dim} {args.dtype} index, {lists} lists, "
+                  f"in {time.perf_counter() - started:.1f}s")
+            index = VectorIndex.open(directory)
+            base = embeddings[rng.choice(len(embeddings), size=args.queries, replace=False)]
+        queries = base + 0.8 * rng.standard_normal(base.shape).astype(np.float32)
+
+        exact = index.exact_search(queries, args.k)
+        exact_ms = timed(lambda: index.exact_search(queries[:1], args.k), 5) * 1000
+        print(f"exact: {exact_ms:.2f} ms/query")
+        print(f"{'n_probe':>8} {'recall@' + str(args.k):>10} {'single ms':>10} {'batched ms/q':>13}")
+        for n_probe in (1, 2, 4, 8, 16, 32, 64):
+            approx = index.search(queries, args.k, n_probe=n_probe)
+            recall = np.mean([
+                len(set(a.tolist()) & set(e.tolist())) / args.k for (a, _), (e, _) in zip(approx, exact)
+            ])
+            single = timed(lambda: [index.search(q, args.k, n_probe=n_probe) for q in queries[:32]], 3) / 32
+            batch = queries[:args.batch]
+            batched = timed(lambda: index.search(batch, args.k, n_probe=n_probe), 5) / len(batch)
+            print(f"{n_probe:>8} {recall:>10.3f} {single * 1000:>10.3f} {batched * 1000:>13.3f}")
+
+
+if __name__ == "__main__":
+    main()
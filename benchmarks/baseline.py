@@ -0,0 +1,68 @@
+"""
+Saving benchmark results as baselines and failing runs that regress on them.
+
+A baseline is a JSON file holding the benchmark's configuration and its
+flat `metrics` dict. A comparison run fails when a metric is worse than the
+baseline by more than the tolerance, in the metric's own direction: lower
+is better unless the name is listed in `HIGHER_IS_BETTER`.
+"""
+
+import json
+import sys
+from pathlib import Path
+from typing import Dict, List, Optional
+
+HIGHER_IS_BETTER = {"rps"}
+
+
+def compare(metrics: Dict[str, float], baseline: Dict[str, float], tolerance: float) -> List[str]:
+    """
+    Describe every metric that regressed by more than `tolerance` (a fraction).
+    """
+    regressions = []
+    for name, before in baseline.items():
+        now = metrics.get(name)
+        if now is None:
+            continue
+        if not before:
+            # e.g. an error rate that was zero: any increase counts
+            if now > 0 and name not in HIGHER_IS_BETTER:
+                regressions.append(f"{name}: 0 -> {now:g}")
+            continue
+        change = (now - before) / abs(before)
+        worse = -change if name in HIGHER_IS_BETTER else change
+        if worse > tolerance:
+            regressions.append(f"{name}: {before:g} -> {now:g} ({change:+.1%})")
+    return regressions
+
+
+def save(path: str, config: dict, metrics: Dict[str, float]) -> None:
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({"config": config, "metrics": metrics}, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def check(config: dict, metrics: Dict[str, float], save_path: Optional[str], baseline_path: Optional[str],
+          tolerance: float) -> int:
+    """
+    Save and/or compare against baselines as requested; return the process exit code.
+    """
+    if save_path:
+        save(save_path, config, metrics)
+        print(f"saved baseline to {save_path}")
+    if not baseline_path:
+        return 0
+
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    if baseline.get("config") != config:
+        print("warning: baseline was recorded with a different configuration", file=sys.stderr)
+    regressions = compare(metrics, baseline["metrics"], tolerance)
+    if regressions:
+        print(f"REGRESSED beyond {tolerance:.0%} of {baseline_path}:")
+        for line in regressions:
+            print(f"  {line}")
+        return 1
+    print(f"no regressions beyond {tolerance:.0%} of {baseline_path}")
+    return 0
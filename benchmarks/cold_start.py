@@ -0,0 +1,110 @@
+"""
+Cold-start cost of the backend: import time, time to live and to ready, and
+the latency of the first analysis compared with a warm one.
+
+Starts benchmarks/mock_azure.py, then starts the backend under uvicorn
+several times and measures, from process spawn, when /healthz first answers
+and when /readyz first answers 200, then times the first and second
+/api/analyze requests.
+
+    python benchmarks/cold_start.py --runs 5
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from benchmarks.load_test import free_port, make_images, wait_until_up  # noqa: E402
+
+IMPORT_SNIPPET = "import time; t = time.perf_counter(); import src.backend.main; print(time.perf_counter() - t)"
+
+
+def wait_for_status(url: str, started: float, timeout: float = 60.0) -> float:
+    while time.perf_counter() - started < timeout:
+        try:
+            if httpx.get(url, timeout=1.0).status_code == 200:
+                return time.perf_counter() - started
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.02)
+    raise RuntimeError(f"{url} did not answer 200 within {timeout:.0f}s")
+
+
+def timed_upload(url: str, image: bytes) -> float:
+    started = time.perf_counter()
+    response = httpx.post(url, files={"file": ("cold.jpg", image, "image/jpeg")}, timeout=60.0)
+    response.raise_for_status()
+    return time.perf_counter() - started
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--latency", default="fixed:300", help="Mock model latency spec")
+    parser.add_argument("--live-path", default="/healthz")
+    parser.add_argument("--ready-path", default="/readyz")
+    args = parser.parse_args()
+
+    mock_port = free_port()
+    mock_url = f"http://127.0.0.1:{mock_port}"
+    images = make_images(2 * args.runs, (1600, 1200), seed=1)
+    results = {"import": [], "live": [], "ready": [], "first": [], "warm": []}
+
+    with tempfile.TemporaryDirectory() as scratch:
+        env = {
+            **os.environ,
+            "AZURE_OPENAI_API_KEY": "benchmark",
+            "AZURE_OPENAI_ENDPOINT": mock_url,
+            "BATCH_JOBS_DIR": os.path.join(scratch, "batch_jobs"),
+            "JOBS_DB_PATH": os.path.join(scratch, "jobs.sqlite3"),
+        }
+        mock = subprocess.Popen([sys.executable, str(ROOT / "benchmarks" / "mock_azure.py"),
+                                 "--port", str(mock_port), "--latency", args.latency])
+        try:
+            wait_until_up(f"{mock_url}/stats")
+            for run in range(args.runs):
+                imported = subprocess.run([sys.executable, "-c", IMPORT_SNIPPET], cwd=ROOT, env=env,
+                                          capture_output=True, text=True, check=True)
+                results["import"].append(float(imported.stdout.strip()))
+
+                port = free_port()
+                app_url = f"http://127.0.0.1:{port}"
+                started = time.perf_counter()
+                app = subprocess.Popen([sys.executable, "-m", "uvicorn", "src.backend.main:app", "--port", str(port),
+                                        "--log-level", "warning"], cwd=ROOT, env=env)
+                try:
+                    results["live"].append(wait_for_status(app_url + args.live_path, started))
+                    results["ready"].append(wait_for_status(app_url + args.ready_path, started))
+                    results["first"].append(timed_upload(f"{app_url}/api/analyze", images[2 * run]))
+                    results["warm"].append(timed_upload(f"{app_url}/api/analyze", images[2 * run + 1]))
+                finally:
+                    app.terminate()
+                    app.wait(timeout=10)
+        finally:
+            mock.terminate()
+            mock.wait(timeout=10)
+
+    labels = {
+        "import": "import src.backend.main",
+        "live": f"spawn -> {args.live_path}",
+        "ready": f"spawn -> {args.ready_path} 200",
+        "first": "first /api/analyze",
+        "warm": "second /api/analyze",
+    }
+    for key, label in labels.items():
+        print(f"{label:<28} median {statistics.median(results[key]) * 1000:8.1f} ms   "
+              f"min {min(results[key]) * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
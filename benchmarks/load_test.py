@@ -0,0 +1,260 @@
+"""
+Throughput and latency of the running API against a mock vision model.
+
+Starts benchmarks/mock_azure.py and the backend under uvicorn (pointed at
+the mock), then drives /api/analyze (or /api/analyze/stream) at a fixed
+concurrency with distinct generated images, so every request misses the
+cache unless --distinct-images is lower than --requests. Reports requests
+per second, latency percentiles, status codes, resident memory per worker
+and how many upstream calls and tokens the run caused.
+
+    python benchmarks/load_test.py --concurrency 64 --requests 1000 --latency lognormal:800,0.4
+    python benchmarks/load_test.py --save-baseline benchmarks/baselines/load.json
+    python benchmarks/load_test.py --baseline benchmarks/baselines/load.json   # exits 1 on regression
+
+Extra backend settings are passed as --env NAME=VALUE.
+"""
+
+import argparse
+import asyncio
+import io
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import httpx
+from PIL import Image
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from benchmarks.baseline import check  # noqa: E402
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def make_images(count: int, size: tuple, seed: int) -> List[bytes]:
+    """
+    Generate distinct JPEGs: blocks of random colour, so neither the exact
+    nor the perceptual-hash cache can match one image to another.
+    """
+    rng = random.Random(seed)
+    images = []
+    for _ in range(count):
+        small = Image.new("RGB", (16, 12))
+        small.putdata([tuple(rng.randrange(256) for _ in range(3)) for _ in range(16 * 12)])
+        buffer = io.BytesIO()
+        small.resize(size, Image.NEAREST).save(buffer, "JPEG", quality=85)
+        images.append(buffer.getvalue())
+    return images
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q * (len(ordered) - 1))))]
+
+
+def rss_mb(pid: int) -> Optional[float]:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+
+def worker_pids(pid: int) -> List[int]:
+    """
+    The uvicorn process itself, or its worker processes when it runs several.
+    """
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(child) for child in f.read().split()]
+    except OSError:
+        return [pid]
+    # Multiprocess mode also forks a resource tracker; workers are the big ones
+    return [child for child in children if (rss_mb(child) or 0) > 30] or [pid]
+
+
+def wait_until_up(url: str, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(url, timeout=1.0)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up within {timeout:.0f}s")
+
+
+async def drive(base_url: str, path: str, images: List[bytes], requests: int, concurrency: int,
+                mock_url: str, warmup: int) -> dict:
+    latencies, first_bytes, statuses = [], [], Counter()
+    issued = 0
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=300.0) as client:
+        async def one(index: int, record: bool) -> None:
+            files = {"file": (f"{index}.jpg", images[index % len(images)], "image/jpeg")}
+            started = time.perf_counter()
+            try:
+                async with client.stream("POST", path, files=files) as response:
+                    first = None
+                    async for _ in response.aiter_bytes():
+                        if first is None:
+                            first = time.perf_counter() - started
+                    status = response.status_code
+            except httpx.HTTPError as e:
+                status, first = type(e).__name__, None
+            if record:
+                latencies.append(time.perf_counter() - started)
+                if first is not None:
+                    first_bytes.append(first)
+                statuses[status] += 1
+
+        await asyncio.gather(*(one(requests + i, False) for i in range(warmup)))
+        calls_before = (await client.get(f"{mock_url}/stats")).json()
+
+        async def worker() -> None:
+            nonlocal issued
+            while issued < requests:
+                index = issued
+                issued += 1
+                await one(index, True)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    return {"latencies": latencies, "first_bytes": first_bytes, "statuses": statuses, "elapsed": elapsed,
+            "calls_before": calls_before}
+
+
+async def sample_memory(pids: List[int], peaks: Dict[int, float], stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        for pid in pids:
+            peaks[pid] = max(peaks.get(pid, 0.0), rss_mb(pid) or 0.0)
+        try:
+            await asyncio.wait_for(stop.wait(), 0.25)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run(args, app_pid: int, app_url: str, mock_url: str) -> dict:
+    images = make_images(args.distinct_images or args.requests + args.warmup, args.image_size, args.seed)
+    path = "/api/analyze/stream" if args.stream else "/api/analyze"
+
+    pids = worker_pids(app_pid)
+    peaks: Dict[int, float] = {}
+    stop = asyncio.Event()
+    sampler = asyncio.create_task(sample_memory(pids, peaks, stop))
+    outcome = await drive(app_url, path, images, args.requests, args.concurrency, mock_url, args.warmup)
+    stop.set()
+    await sampler
+
+    calls_before, calls_after = outcome["calls_before"], httpx.get(f"{mock_url}/stats").json()
+    latencies = outcome["latencies"]
+    ok = outcome["statuses"].get(200, 0)
+    metrics = {
+        "rps": round(ok / outcome["elapsed"], 2),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "error_rate": round(1 - ok / max(1, len(latencies)), 4),
+        "upstream_calls_per_request": round((calls_after["calls"] - calls_before["calls"]) / max(1, args.requests), 3),
+        "tokens_per_request": round((calls_after["promptTokens"] + calls_after["completionTokens"]
+                                     - calls_before["promptTokens"] - calls_before["completionTokens"])
+                                    / max(1, args.requests), 1),
+        "max_tokens_per_call": round((calls_after["maxTokens"] - calls_before["maxTokens"])
+                                     / max(1, calls_after["calls"] - calls_before["calls"]), 1),
+        "peak_rss_mb_per_worker": round(max(peaks.values()) if peaks else 0.0, 1),
+    }
+    if args.stream:
+        metrics["first_byte_p50_ms"] = round(percentile(outcome["first_bytes"], 0.50) * 1000, 1)
+        metrics["first_byte_p95_ms"] = round(percentile(outcome["first_bytes"], 0.95) * 1000, 1)
+
+    print(f"{args.requests} requests to {path} at concurrency {args.concurrency} in {outcome['elapsed']:.2f}s")
+    print(f"statuses: {dict(outcome['statuses'])}")
+    print(f"upstream: {calls_after['calls'] - calls_before['calls']} calls, "
+          f"{calls_after['errors'] - calls_before['errors']} simulated errors, "
+          f"max {calls_after['maxInFlight']} in flight")
+    print(f"rss per worker (MB): {', '.join(f'{peaks[pid]:.0f}' for pid in pids)}")
+    for name, value in metrics.items():
+        print(f"  {name:<28} {value}")
+    return metrics
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--warmup", type=int, default=8, help="Unrecorded requests sent first")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--stream", action="store_true", help="Drive /api/analyze/stream instead")
+    parser.add_argument("--distinct-images", type=int, default=0,
+                        help="Cycle through this many images (default: one per request, all cache misses)")
+    parser.add_argument("--image-size", type=lambda s: tuple(int(v) for v in s.split("x")), default=(1600, 1200))
+    parser.add_argument("--latency", default="lognormal:800,0.4", help="Mock model latency spec")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of mock calls that fail")
+    parser.add_argument("--error-status", type=int, default=429)
+    parser.add_argument("--env", action="append", default=[], help="Backend setting NAME=VALUE")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save-baseline", help="Write this run's metrics to a baseline file")
+    parser.add_argument("--baseline", help="Compare against a baseline file and exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Allowed regression per metric (fraction)")
+    args = parser.parse_args()
+
+    mock_port, app_port = free_port(), free_port()
+    mock_url, app_url = f"http://127.0.0.1:{mock_port}", f"http://127.0.0.1:{app_port}"
+    processes = []
+    with tempfile.TemporaryDirectory() as scratch:
+        env = {
+            **os.environ,
+            "AZURE_OPENAI_API_KEY": "benchmark",
+            "AZURE_OPENAI_ENDPOINT": mock_url,
+            "BATCH_JOBS_DIR": os.path.join(scratch, "batch_jobs"),
+            "JOBS_DB_PATH": os.path.join(scratch, "jobs.sqlite3"),
+            **dict(item.split("=", 1) for item in args.env),
+        }
+        try:
+            processes.append(subprocess.Popen([
+                sys.executable, str(ROOT / "benchmarks" / "mock_azure.py"), "--port", str(mock_port),
+                "--latency", args.latency, "--error-rate", str(args.error_rate),
+                "--error-status", str(args.error_status), "--seed", str(args.seed),
+            ]))
+            app = subprocess.Popen([
+                sys.executable, "-m", "uvicorn", "src.backend.main:app", "--port", str(app_port),
+                "--workers", str(args.workers), "--log-level", "warning",
+            ], cwd=ROOT, env=env)
+            processes.append(app)
+            wait_until_up(f"{mock_url}/stats")
+            wait_until_up(f"{app_url}/")
+            metrics = asyncio.run(run(args, app.pid, app_url, mock_url))
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.wait(timeout=10)
+
+    config = {key: value for key, value in vars(args).items() if key not in ("save_baseline", "baseline", "tolerance")}
+    config["image_size"] = list(args.image_size)
+    return check(config, metrics, args.save_baseline, args.baseline, args.tolerance)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+"""
+Microbenchmarks for the CPU work on the analyze path outside the model call.
+
+Times response parsing (structured JSON, markdown, and the streaming parser
+fed small deltas), base64 data-URL encoding of typical and large images, and
+encoding and compressing the analysis response, reporting the best per-call
+time of several repeats in microseconds. Also reports the response size on
+the wire with each content coding.
+
+    python benchmarks/microbench.py
+    python benchmarks/microbench.py --save-baseline benchmarks/baselines/micro.json
+    python benchmarks/microbench.py --baseline benchmarks/baselines/micro.json   # exits 1 on regression
+"""
+
+import argparse
+import base64
+import json
+import os
+import sys
+import timeit
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from benchmarks.baseline import check  # noqa: E402
+from benchmarks.mock_azure import MARKDOWN_TEXT, STRUCTURED_TEXT  # noqa: E402
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from src.backend.compression import COMPRESSORS  # noqa: E402
+from src.backend.encoding import encode_analysis  # noqa: E402
+from src.backend.parsing import StreamingAnalysisParser, parse_model_output  # noqa: E402
+from src.backend.schemas import AnalysisResponse  # noqa: E402
+from src.backend.uploads import data_url  # noqa: E402
+
+
+def best_us(fn, repeat: int) -> float:
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e6
+
+
+def stream_parse(text: str, delta: int) -> None:
+    parser = StreamingAnalysisParser()
+    for i in range(0, len(text), delta):
+        parser.feed(text[i:i + delta])
+    parser.close()
+
+
+def naive_data_url(content: bytes, mime_type: str) -> str:
+    return f"data:{mime_type};base64,{base64.b64encode(content).decode('utf-8')}"
+
+
+def fastapi_encode(payload: dict) -> bytes:
+    # What returning the dict from a route with response_model=AnalysisResponse costs
+    content = jsonable_encoder(AnalysisResponse.model_validate(payload))
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--save-baseline", help="Write this run's metrics to a baseline file")
+    parser.add_argument("--baseline", help="Compare against a baseline file and exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed regression per metric (fraction)")
+    args = parser.parse_args()
+
+    # A preprocessed upload is typically ~300 KB; 8 MB is a passthrough of a large original
+    typical, large = os.urandom(300 * 1024), os.urandom(8 * 1024 * 1024)
+    cases = {
+        "parse_json_us": lambda: parse_model_output(STRUCTURED_TEXT),
+        "parse_markdown_us": lambda: parse_model_output(MARKDOWN_TEXT),
+        "parse_stream_markdown_us": lambda: stream_parse(MARKDOWN_TEXT, 8),
+        "data_url_300k_us": lambda: data_url(typical, "image/jpeg"),
+        "data_url_300k_naive_us": lambda: naive_data_url(typical, "image/jpeg"),
+        "data_url_8m_us": lambda: data_url(large, "image/jpeg"),
+        "data_url_8m_naive_us": lambda: naive_data_url(large, "image/jpeg"),
+    }
+    payload = parse_model_output(STRUCTURED_TEXT)
+    body = encode_analysis(payload)
+    cases["encode_response_us"] = lambda: encode_analysis(payload)
+    cases["encode_response_fastapi_us"] = lambda: fastapi_encode(payload)
+    for encoding, (compress, level) in COMPRESSORS.items():
+        cases[f"compress_response_{encoding}_us"] = lambda compress=compress, level=level: compress(body, level)
+
+    metrics = {}
+    for name, fn in cases.items():
+        metrics[name] = round(best_us(fn, args.repeat), 2)
+        print(f"{name:<28} {metrics[name]:>12.2f} us")
+    sizes = {"response_identity_bytes": len(body)}
+    for encoding, (compress, level) in COMPRESSORS.items():
+        sizes[f"response_{encoding}_bytes"] = len(compress(body, level))
+    for name, size in sizes.items():
+        print(f"{name:<28} {size:>12d} B")
+    metrics.update(sizes)
+    return check({"repeat": args.repeat}, metrics, args.save_baseline, args.baseline, args.tolerance)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,221 @@
+"""
+Local stand-in for the Azure OpenAI chat completions endpoint.
+
+Answers `POST /openai/deployments/<deployment>/chat/completions` with a
+canned outfit analysis (JSON when `response_format` is sent, the markdown
+format otherwise), after a delay drawn from a latency distribution, failing
+a configurable share of calls with 429 or 500. Answers longer than
+`max_tokens` are cut off with finish reason "length", and usage is reported
+from the prompt length and each image's detail level. Streaming requests get
+the same text as SSE chunks spread over the call's latency. `GET /stats`
+reports call and token counts so a load test can check how many upstream
+calls and tokens it caused.
+
+    python benchmarks/mock_azure.py --port 9100 --latency lognormal:800,0.4 --error-rate 0.02
+
+Point the backend at it with AZURE_OPENAI_ENDPOINT=http://127.0.0.1:9100.
+Latency specs: `fixed:MS`, `uniform:LO_MS,HI_MS`, `lognormal:MEDIAN_MS,SIGMA`.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from typing import Callable
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+STRUCTURED_TEXT = json.dumps({
+    "description": "Relaxed smart-casual look built around soft neutral layers.",
+    "colorTones": "Camel, cream and charcoal with a single burgundy accent.",
+    "coreApparel": "Camel wool overcoat, cream cable-knit sweater, charcoal straight-leg trousers.",
+    "accessories": "Burgundy leather belt, brown suede loafers, minimal silver watch.",
+    "fashionTips": [
+        "Swap the loafers for white leather sneakers to dress it down.",
+        "Roll the trouser hem once to show a sliver of ankle.",
+        "Add a burgundy scarf to repeat the belt colour higher up.",
+    ],
+    "similarItems": [
+        {"name": "Wool Blend Overcoat", "description": "Single-breasted camel coat.", "priceRange": "$180 - $260"},
+        {"name": "Cable Knit Sweater", "description": "Chunky cream crewneck.", "priceRange": "$60 - $95"},
+        {"name": "Suede Penny Loafers", "description": "Brown suede with leather sole.", "priceRange": "$90 - $140"},
+    ],
+})
+
+MARKDOWN_TEXT = """### 1. Description
+Relaxed smart-casual look built around soft neutral layers.
+### 2. Color Tones
+Camel, cream and charcoal with a single burgundy accent.
+### 3. Core Apparel
+Camel wool overcoat, cream cable-knit sweater, charcoal straight-leg trousers.
+### 4. Accessories
+Burgundy leather belt, brown suede loafers, minimal silver watch.
+### 5. Fashion Tips
+- Swap the loafers for white leather sneakers to dress it down.
+- Roll the trouser hem once to show a sliver of ankle.
+- Add a burgundy scarf to repeat the belt colour higher up.
+### 6. Similar Items
+1. Wool Blend Overcoat
+   - Description: Single-breasted camel coat.
+   - Price Range: $180 - $260
+2. Cable Knit Sweater
+   - Description: Chunky cream crewneck.
+   - Price Range: $60 - $95
+3. Suede Penny Loafers
+   - Description: Brown suede with leather sole.
+   - Price Range: $90 - $140"""
+
+
+def parse_latency(spec: str, rng: random.Random) -> Callable[[], float]:
+    """
+    Return a sampler of call latencies in seconds for a spec such as `lognormal:800,0.4`.
+    """
+    kind, _, params = spec.partition(":")
+    values = [float(v) for v in params.split(",") if v]
+    if kind == "fixed" and len(values) == 1:
+        return lambda: values[0] / 1000
+    if kind == "uniform" and len(values) == 2:
+        return lambda: rng.uniform(values[0], values[1]) / 1000
+    if kind == "lognormal" and len(values) == 2:
+        median, sigma = values
+        return lambda: median * rng.lognormvariate(0, sigma) / 1000
+    raise ValueError(f"Invalid latency spec: {spec!r}")
+
+
+def create_app(latency: str = "fixed:800", error_rate: float = 0.0, error_status: int = 429,
+               stream_chunks: int = 40, first_token_share: float = 0.3, seed: int = 0) -> FastAPI:
+    rng = random.Random(seed)
+    sample_latency = parse_latency(latency, rng)
+    stats = {"calls": 0, "streamed": 0, "errors": 0, "inFlight": 0, "maxInFlight": 0,
+             "promptTokens": 0, "completionTokens": 0, "maxTokens": 0}
+    app = FastAPI()
+
+    def prompt_tokens(body: dict) -> int:
+        # About 4 characters per text token; a typical photo is 4 tiles at high detail
+        tokens = 10
+        for message in body.get("messages", []):
+            for part in message.get("content", []):
+                if part.get("type") == "text":
+                    tokens += len(part["text"]) // 4
+                elif part.get("type") == "image_url":
+                    tokens += 85 if part["image_url"].get("detail") == "low" else 765
+        return tokens
+
+    def completion(deployment: str, text: str, body: dict) -> dict:
+        finish_reason = "stop"
+        limit = body.get("max_tokens")
+        if limit and len(text) // 4 > limit:
+            text, finish_reason = text[:limit * 4], "length"
+        usage = {"prompt_tokens": prompt_tokens(body), "completion_tokens": len(text) // 4}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        stats["promptTokens"] += usage["prompt_tokens"]
+        stats["completionTokens"] += usage["completion_tokens"]
+        stats["maxTokens"] += limit or 0
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": deployment,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": finish_reason}],
+            "usage": usage,
+        }
+
+    def chunk(deployment: str, content, finish_reason=None) -> str:
+        delta = {"content": content} if content is not None else {}
+        return "data: " + json.dumps({
+            "id": "chatcmpl-mock",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": deployment,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }) + "\n\n"
+
+    def usage_chunk(deployment: str, body: dict, text: str) -> str:
+        # Sent last when the request asks for stream_options.include_usage
+        usage = {"prompt_tokens": prompt_tokens(body), "completion_tokens": len(text) // 4}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        stats["promptTokens"] += usage["prompt_tokens"]
+        stats["completionTokens"] += usage["completion_tokens"]
+        return "data: " + json.dumps({
+            "id": "chatcmpl-mock",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": deployment,
+            "choices": [],
+            "usage": usage,
+        }) + "\n\n"
+
+    @app.post("/openai/deployments/{deployment}/chat/completions")
+    async def chat_completions(deployment: str, request: Request):
+        body = await request.json()
+        stats["calls"] += 1
+        if rng.random() < error_rate:
+            stats["errors"] += 1
+            headers = {"Retry-After": "1"} if error_status == 429 else {}
+            return JSONResponse(
+                status_code=error_status,
+                content={"error": {"code": str(error_status), "message": "Simulated upstream error"}},
+                headers=headers,
+            )
+
+        text = STRUCTURED_TEXT if body.get("response_format") else MARKDOWN_TEXT
+        duration = sample_latency()
+        if not body.get("stream"):
+            stats["inFlight"] += 1
+            stats["maxInFlight"] = max(stats["maxInFlight"], stats["inFlight"])
+            try:
+                await asyncio.sleep(duration)
+            finally:
+                stats["inFlight"] -= 1
+            return completion(deployment, text, body)
+
+        stats["streamed"] += 1
+        stats["maxTokens"] += body.get("max_tokens") or 0
+        size = max(1, len(text) // stream_chunks)
+        pieces = [text[i:i + size] for i in range(0, len(text), size)]
+        interval = duration * (1 - first_token_share) / len(pieces)
+
+        async def events():
+            stats["inFlight"] += 1
+            stats["maxInFlight"] = max(stats["maxInFlight"], stats["inFlight"])
+            try:
+                await asyncio.sleep(duration * first_token_share)
+                for piece in pieces:
+                    yield chunk(deployment, piece)
+                    await asyncio.sleep(interval)
+                yield chunk(deployment, None, "stop")
+                if (body.get("stream_options") or {}).get("include_usage"):
+                    yield usage_chunk(deployment, body, text)
+                yield "data: [DONE]\n\n"
+            finally:
+                stats["inFlight"] -= 1
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.get("/stats")
+    def get_stats():
+        return stats
+
+    return app
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency", default="lognormal:800,0.4")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=429, choices=(429, 500, 503))
+    parser.add_argument("--stream-chunks", type=int, default=40)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    app = create_app(args.latency, args.error_rate, args.error_status, args.stream_chunks, seed=args.seed)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
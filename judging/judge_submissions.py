@@ -6,53 +6,319 @@ This script automates the judging process for hackathon submissions.
 It clones repositories, follows setup instructions, runs applications,
 and scores them according to the defined rubrics.
 
+Submissions are judged concurrently, each in its own working directory and
+within the 4-minute limit, and every score is appended to
+judging_results/results.jsonl as soon as it is ready.
+
 Usage:
-    python judge_submissions.py submissions.txt
+    python judge_submissions.py submissions.txt [--workers 8] [--global-budget SECONDS]
 
 Where submissions.txt contains one GitHub repo URL per line.
 """
 
+import argparse
+import hashlib
 import os
+import re
+import shutil
+import signal
 import sys
+import tempfile
 import time
 import subprocess
+import threading
 import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 from dataclasses import dataclass, asdict
 
+try:
+    from .results import Leaderboard, ResultsStore, SubmissionScore, write_atomically
+    from .scoring import (ChatModelBackend, Criterion, CriterionScore, Evidence, LocalBackend, ScoreCache,
+                          ScoringBackend, ScoringEngine)
+except ImportError:  # run as a script from this directory
+    from results import Leaderboard, ResultsStore, SubmissionScore, write_atomically
+    from scoring import (ChatModelBackend, Criterion, CriterionScore, Evidence, LocalBackend, ScoreCache,
+                         ScoringBackend, ScoringEngine)
+
+TASK_BUDGET_SECONDS = 240  # 4-minute hard limit per submission
+EXPLORATION_SECONDS = 60
+SETUP_SECONDS = 120
+TEST_SECONDS = 60
+DEFAULT_WORKERS = 8
+REFRESH_SECONDS = 5  # how often scores.md is rewritten while judging
+# Log lines of a setup or test step that ran out of time
+CUT_SHORT_MARKERS = ("Time budget exhausted", "Timeout running", "Timed out")
+
+def project_name_for(repo_url: str) -> str:
+    return repo_url.rstrip('/').split('/')[-1].replace('.git', '')
+
+def default_score(repo_url: str, notes: str = "") -> SubmissionScore:
+    """Minimum scores, used before scoring and for submissions that could not be judged"""
+    return SubmissionScore(
+        project_name=project_name_for(repo_url),
+        github_repo=repo_url,
+        category1_scores={"problem_definition": 1, "significance_impact": 1, "effectiveness": 1, "learning_craftsmanship": 1},
+        category2_scores={"scope_coverage": 1, "robustness_testing": 1, "documentation_reproducibility": 1, "code_quality": 1},
+        category3_scores={"originality_innovation": 1, "vibe_polish": 1, "effective_execution": 1, "storytelling_presentation": 1},
+        category1_total=4,
+        category2_total=4,
+        category3_total=4,
+        notes=notes
+    )
+
+class TimeBudget:
+    """A deadline for a piece of work, never later than the deadline of the work containing it"""
+
+    def __init__(self, seconds: Optional[float], parent: Optional["TimeBudget"] = None):
+        self.deadline = time.monotonic() + seconds if seconds is not None else float("inf")
+        if parent is not None:
+            self.deadline = min(self.deadline, parent.deadline)
+
+    def remaining(self) -> float:
+        return max(0.0, self.deadline - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def limit(self, timeout: float) -> float:
+        """The timeout for one step: its own limit, cut short by the budget"""
+        return min(timeout, self.remaining())
+
+    def child(self, seconds: float) -> "TimeBudget":
+        return TimeBudget(seconds, parent=self)
+
+@dataclass
+class CommandResult:
+    returncode: Optional[int]
+    stdout: str
+    stderr: str
+    timed_out: bool = False
+
+def run_command(command: List[str], cwd: Optional[str] = None, timeout: float = 60,
+                env: Optional[Dict[str, str]] = None) -> CommandResult:
+    """
+    Run a command in `cwd` and kill it, and everything it started, after `timeout` seconds.
+
+    The command gets its own process group so that dev servers and install
+    scripts spawned by it do not outlive the timeout. Raises FileNotFoundError
+    when the program does not exist.
+    """
+    process = subprocess.Popen(
+        command,
+        cwd=cwd,
+        env=env,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        errors="replace",
+        start_new_session=hasattr(os, "killpg"),
+    )
+    try:
+        stdout, stderr = process.communicate(timeout=max(timeout, 0.01) if timeout != float("inf") else None)
+        return CommandResult(process.returncode, stdout, stderr)
+    except subprocess.TimeoutExpired:
+        kill_process_tree(process)
+        stdout, stderr = process.communicate()
+        return CommandResult(None, stdout, stderr, timed_out=True)
+    except BaseException:
+        kill_process_tree(process)
+        process.wait()
+        raise
+
+def kill_process_tree(process: subprocess.Popen) -> None:
+    try:
+        if hasattr(os, "killpg"):
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except (ProcessLookupError, PermissionError):
+        pass
+
+# Large media is left out of checkouts; the judge reads code and docs, not screenshots
+MEDIA_SUFFIXES = (".png", ".jpg", ".jpeg", ".gif", ".webp", ".bmp", ".tif", ".tiff", ".psd", ".ico",
+                  ".mp4", ".mov", ".webm", ".avi", ".mkv", ".mp3", ".wav", ".pdf", ".zip")
+BLOB_LIMIT = "1m"
+
+class FetchError(Exception):
+    pass
+
 @dataclass
-class SubmissionScore:
-    project_name: str
-    github_repo: str
-    category1_scores: Dict[str, int]  # subcategory -> score
-    category2_scores: Dict[str, int]
-    category3_scores: Dict[str, int]
-    category1_total: int
-    category2_total: int
-    category3_total: int
-    notes: str = ""
+class FetchResult:
+    commit: str
+    bytes_fetched: int
+    seconds: float
+    cached: bool = False
+
+    def describe(self) -> str:
+        if self.cached:
+            return f"cached @ {self.commit[:8]}"
+        size = f"{self.bytes_fetched / 1e6:.1f} MB" if self.bytes_fetched >= 1e6 else f"{self.bytes_fetched / 1e3:.0f} KB"
+        return f"{size} in {self.seconds:.1f}s @ {self.commit[:8]}"
+
+def directory_size(path: Path) -> int:
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file()) if path.exists() else 0
+
+class RepoCache:
+    """
+    Shallow, partial bare mirrors of submission repositories, kept across runs.
+
+    Each repository URL has one mirror holding only the commits that were
+    judged, fetched with depth 1 and without blobs over `blob_limit`.
+    Submissions are checked out from the mirror as git worktrees, leaving out
+    the media files that were never downloaded, so re-runs fetch only new
+    commits and unchanged repositories need no network at all beyond a
+    `git ls-remote`.
+    """
+
+    def __init__(self, cache_dir: str, blob_limit: str = BLOB_LIMIT):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.blob_limit = blob_limit
+        self._locks: Dict[Path, threading.Lock] = {}
+        self._locks_guard = threading.Lock()
+
+    def mirror_path(self, repo_url: str) -> Path:
+        digest = hashlib.sha1(repo_url.encode("utf-8")).hexdigest()[:12]
+        return self.cache_dir / f"{project_name_for(repo_url)}-{digest}.git"
+
+    def _lock(self, mirror: Path) -> threading.Lock:
+        with self._locks_guard:
+            return self._locks.setdefault(mirror, threading.Lock())
+
+    def _git(self, args: List[str], budget: TimeBudget, cwd: Optional[Path] = None) -> str:
+        try:
+            result = run_command(["git", *args], cwd=str(cwd) if cwd else None, timeout=budget.remaining())
+        except OSError as e:
+            raise FetchError(f"git {args[0]} failed: {e}")
+        if result.timed_out:
+            raise FetchError(f"git {args[0]} timed out")
+        if result.returncode != 0:
+            raise FetchError(f"git {args[0]} failed: {result.stderr.strip()}")
+        return result.stdout
+
+    def remote_commit(self, repo_url: str, budget: TimeBudget) -> Optional[str]:
+        """The commit the remote's HEAD points at, or None when the remote cannot be reached"""
+        try:
+            output = self._git(["ls-remote", repo_url, "HEAD"], budget)
+        except FetchError:
+            return None
+        return output.split()[0] if output.strip() else None
+
+    def fetch(self, repo_url: str, budget: TimeBudget, commit: Optional[str] = None) -> FetchResult:
+        """
+        Bring the mirror up to date with the remote's HEAD.
+
+        When `commit` (from `remote_commit`) is already in the mirror nothing
+        is fetched. `bytes_fetched` is how much the mirror grew, which for
+        packed objects is close to what went over the wire.
+        """
+        mirror = self.mirror_path(repo_url)
+        started = time.monotonic()
+        with self._lock(mirror):
+            if commit and mirror.exists() and self.cached_commit(repo_url) == commit:
+                return FetchResult(commit, 0, time.monotonic() - started, cached=True)
+
+            before = directory_size(mirror / "objects")
+            shallow = ["--depth", "1", f"--filter=blob:limit={self.blob_limit}"]
+            if mirror.exists():
+                self._git(["fetch", "--quiet", *shallow, "origin", "HEAD"], budget, cwd=mirror)
+                fetched = self._git(["rev-parse", "FETCH_HEAD"], budget, cwd=mirror).strip()
+            else:
+                # Clone beside the mirror and move it into place, so an interrupted clone is not mistaken for one
+                partial = mirror.with_suffix(".partial")
+                shutil.rmtree(partial, ignore_errors=True)
+                self._git(["clone", "--quiet", "--bare", *shallow, repo_url, str(partial)], budget)
+                fetched = self._git(["rev-parse", "HEAD"], budget, cwd=partial).strip()
+                os.replace(partial, mirror)
+            self._git(["update-ref", "refs/heads/judged", fetched], budget, cwd=mirror)
+            return FetchResult(fetched, directory_size(mirror / "objects") - before, time.monotonic() - started)
+
+    def cached_commit(self, repo_url: str) -> Optional[str]:
+        """The commit last fetched into the mirror"""
+        # Only read the ref: asking about a commit missing from a partial clone makes git fetch it
+        try:
+            output = self._git(["for-each-ref", "--format=%(objectname)", "refs/heads/judged"], TimeBudget(30),
+                               cwd=self.mirror_path(repo_url))
+        except FetchError:
+            return None
+        return output.strip() or None
+
+    def checkout(self, repo_url: str, commit: str, target_dir: str, budget: TimeBudget) -> List[str]:
+        """
+        Check `commit` out into `target_dir` as a worktree of the mirror.
+
+        Returns the media files left out because their blobs were over the
+        blob limit; other large files are fetched on demand.
+        """
+        mirror = self.mirror_path(repo_url)
+        target_dir = str(Path(target_dir).resolve())
+        with self._lock(mirror):
+            self._git(["worktree", "add", "--quiet", "--detach", "--no-checkout", target_dir, commit], budget,
+                      cwd=mirror)
+            missing = {line[1:] for line in
+                       self._git(["rev-list", "--objects", "--missing=print", commit], budget, cwd=mirror).splitlines()
+                       if line.startswith("?")}
+            left_out = []
+            for line in self._git(["ls-tree", "-r", "-z", commit], budget, cwd=mirror).split("\0"):
+                if not line:
+                    continue
+                info, path = line.split("\t", 1)
+                if info.split()[2] in missing and path.lower().endswith(MEDIA_SUFFIXES):
+                    left_out.append(path)
+            if left_out:
+                patterns = ["/*"] + ["!/" + re.sub(r'([\\*?\[])', r'\\\1', path) for path in left_out]
+                self._git(["sparse-checkout", "set", "--no-cone", *patterns], budget, cwd=Path(target_dir))
+            self._git(["reset", "--quiet", "--hard", commit], budget, cwd=Path(target_dir))
+        return left_out
+
+    def release(self, repo_url: str, target_dir: str) -> None:
+        """Remove a worktree made by `checkout`"""
+        mirror = self.mirror_path(repo_url)
+        with self._lock(mirror):
+            shutil.rmtree(target_dir, ignore_errors=True)
+            try:
+                self._git(["worktree", "prune"], TimeBudget(30), cwd=mirror)
+            except FetchError:
+                pass
 
 class HackathonJudge:
-    def __init__(self, output_dir: str = "judging_results"):
+    def __init__(self, output_dir: str = "judging_results", task_budget: float = TASK_BUDGET_SECONDS,
+                 isolate_python: bool = True, cache_dir: Optional[str] = None, rejudge: bool = False,
+                 scorer: Optional[ScoringBackend] = None, scoring_workers: int = 16):
         self.output_dir = Path(output_dir)
         self.output_dir.mkdir(exist_ok=True)
+        self.results_file = self.output_dir / "results.jsonl"
+        self.store = ResultsStore(self.results_file)
+        self.task_budget = task_budget
+        self.isolate_python = isolate_python
+        self.repo_cache = RepoCache(cache_dir or str(self.output_dir / "repo_cache"))
+        # Submissions whose commit has not changed keep these scores unless rejudge is set
+        self.rejudge = rejudge
+        self.previous_scores = self.store.load()
+        self.scoring = ScoringEngine(scorer or LocalBackend(), ScoreCache(str(self.output_dir / "score_cache")),
+                                     max_workers=scoring_workers)
         self.scores: List[SubmissionScore] = []
-        
-    def clone_repository(self, repo_url: str, target_dir: str) -> bool:
-        """Clone a GitHub repository"""
+        self.leaderboard = Leaderboard()
+        self.refresh_seconds = REFRESH_SECONDS
+        self._refreshed_at = 0.0
+        self._saved_version = -1
+
+    def fetch_repository(self, repo_url: str, target_dir: str, budget: TimeBudget,
+                         commit: Optional[str] = None) -> Optional[FetchResult]:
+        """Update the repository's cached mirror and check it out into target_dir"""
         try:
-            subprocess.run(
-                ["git", "clone", repo_url, target_dir], 
-                check=True, 
-                capture_output=True, 
-                text=True
-            )
-            return True
-        except subprocess.CalledProcessError as e:
+            fetched = self.repo_cache.fetch(repo_url, budget, commit)
+            left_out = self.repo_cache.checkout(repo_url, fetched.commit, target_dir, budget)
+        except FetchError as e:
             print(f"Failed to clone {repo_url}: {e}")
-            return False
-    
+            return None
+        print(f"📦 Fetched {project_name_for(repo_url)}: {fetched.describe()}"
+              + (f", {len(left_out)} large media files left out" if left_out else ""))
+        return fetched
+
     def read_readme(self, project_dir: str) -> str:
         """Read and return README content"""
         readme_files = ["README.md", "README.txt", "readme.md", "readme.txt"]
@@ -65,232 +331,365 @@ class HackathonJudge:
                     return readme_path.read_text(encoding='latin-1')
         return ""
     
-    def try_setup(self, project_dir: str) -> Tuple[bool, str]:
+    def sandbox_env(self, workdir: Path, project_dir: str, budget: TimeBudget) -> Tuple[Dict[str, str], List[str]]:
+        """
+        Environment for a submission's setup and run commands.
+
+        Each submission gets its own TMPDIR and, for Python projects, its own
+        virtualenv, so concurrent `pip install`s neither race each other nor
+        touch the judge's interpreter.
+        """
+        env = dict(os.environ)
+        env["TMPDIR"] = str(workdir / "tmp")
+        env["PIP_DISABLE_PIP_VERSION_CHECK"] = "1"
+        (workdir / "tmp").mkdir(exist_ok=True)
+        log = []
+
+        python_indicators = ["requirements.txt", "setup.py", "pyproject.toml"]
+        if self.isolate_python and any((Path(project_dir) / indicator).exists() for indicator in python_indicators):
+            venv_dir = workdir / "venv"
+            try:
+                result = run_command([sys.executable, "-m", "venv", str(venv_dir)], timeout=budget.limit(60))
+                created = result.returncode == 0
+            except OSError:
+                created = False
+            if created:
+                bin_dir = venv_dir / ("Scripts" if os.name == "nt" else "bin")
+                env["VIRTUAL_ENV"] = str(venv_dir)
+                env["PATH"] = str(bin_dir) + os.pathsep + env.get("PATH", "")
+                env.pop("PYTHONHOME", None)
+            else:
+                log.append("Could not create a virtualenv; using the system Python")
+        return env, log
+
+    def try_setup(self, project_dir: str, budget: Optional[TimeBudget] = None,
+                  env: Optional[Dict[str, str]] = None) -> Tuple[bool, str]:
         """Attempt to follow setup instructions"""
-        original_dir = os.getcwd()
+        budget = budget or TimeBudget(SETUP_SECONDS)
         setup_log = []
-        
-        try:
-            os.chdir(project_dir)
-            
-            # Common setup patterns
-            setup_commands = [
-                # Python
-                ("pip install -r requirements.txt", ["requirements.txt"]),
-                ("pip install -e .", ["setup.py", "pyproject.toml"]),
-                # Node.js
-                ("npm install", ["package.json"]),
-                ("yarn install", ["yarn.lock"]),
-                # Other
-                ("make install", ["Makefile"]),
-                ("cargo build", ["Cargo.toml"]),
-            ]
-            
-            for command, indicators in setup_commands:
-                if any(Path(indicator).exists() for indicator in indicators):
-                    try:
-                        result = subprocess.run(
-                            command.split(), 
-                            capture_output=True, 
-                            text=True, 
-                            timeout=60
-                        )
-                        setup_log.append(f"Ran: {command}")
-                        setup_log.append(f"Exit code: {result.returncode}")
-                        if result.returncode != 0:
-                            setup_log.append(f"Error: {result.stderr}")
-                            return False, "\n".join(setup_log)
-                    except subprocess.TimeoutExpired:
-                        setup_log.append(f"Timeout running: {command}")
-                        return False, "\n".join(setup_log)
-                    except Exception as e:
-                        setup_log.append(f"Failed to run {command}: {e}")
-                        return False, "\n".join(setup_log)
-            
-            return True, "\n".join(setup_log)
-            
-        finally:
-            os.chdir(original_dir)
-    
-    def try_run_application(self, project_dir: str) -> Tuple[bool, str]:
+
+        # Common setup patterns
+        setup_commands = [
+            # Python
+            ("pip install -r requirements.txt", ["requirements.txt"]),
+            ("pip install -e .", ["setup.py", "pyproject.toml"]),
+            # Node.js
+            ("npm install", ["package.json"]),
+            ("yarn install", ["yarn.lock"]),
+            # Other
+            ("make install", ["Makefile"]),
+            ("cargo build", ["Cargo.toml"]),
+        ]
+
+        for command, indicators in setup_commands:
+            if any((Path(project_dir) / indicator).exists() for indicator in indicators):
+                if budget.expired():
+                    setup_log.append(f"Time budget exhausted before: {command}")
+                    return False, "\n".join(setup_log)
+                try:
+                    result = run_command(command.split(), cwd=project_dir, timeout=budget.limit(60), env=env)
+                except Exception as e:
+                    setup_log.append(f"Failed to run {command}: {e}")
+                    return False, "\n".join(setup_log)
+                if result.timed_out:
+                    setup_log.append(f"Timeout running: {command}")
+                    return False, "\n".join(setup_log)
+                setup_log.append(f"Ran: {command}")
+                setup_log.append(f"Exit code: {result.returncode}")
+                if result.returncode != 0:
+                    setup_log.append(f"Error: {result.stderr}")
+                    return False, "\n".join(setup_log)
+
+        return True, "\n".join(setup_log)
+
+    def try_run_application(self, project_dir: str, budget: Optional[TimeBudget] = None,
+                            env: Optional[Dict[str, str]] = None) -> Tuple[bool, str]:
         """Attempt to run the application"""
-        original_dir = os.getcwd()
+        budget = budget or TimeBudget(SETUP_SECONDS)
         run_log = []
-        
+
+        # Common run patterns
+        run_commands = [
+            "python main.py",
+            "python app.py",
+            "python -m src",
+            "npm start",
+            "npm run dev",
+            "make run",
+            "cargo run",
+            "./run.sh"
+        ]
+
+        for command in run_commands:
+            if budget.expired():
+                run_log.append(f"Time budget exhausted before: {command}")
+                break
+            try:
+                # Try to run for 10 seconds to see if it starts
+                result = run_command(command.split(), cwd=project_dir, timeout=budget.limit(10), env=env)
+            except Exception:
+                continue
+            if result.timed_out:
+                run_log.append(f"Started successfully: {command}")
+                return True, "\n".join(run_log)
+            run_log.append(f"Tried: {command}")
+            run_log.append(f"Exit code: {result.returncode}")
+            if result.stdout:
+                run_log.append(f"Output: {result.stdout[:200]}...")
+            if result.returncode == 0:
+                return True, "\n".join(run_log)
+
+        return False, "\n".join(run_log)
+
+    def try_tests(self, project_dir: str, budget: Optional[TimeBudget] = None,
+                  env: Optional[Dict[str, str]] = None) -> Tuple[bool, Optional[bool], str]:
+        """Run the project's tests if it has any; returns (found, passed, log)"""
+        budget = budget or TimeBudget(TEST_SECONDS)
+        project = Path(project_dir)
+        test_commands = []
+        if (project / "tests").is_dir() or any(project.glob("test_*.py")) or any(project.glob("*/test_*.py")):
+            test_commands.append("python -m pytest -q")
+        package_json = project / "package.json"
+        if package_json.exists():
+            try:
+                test_script = json.loads(package_json.read_text(encoding='utf-8')).get("scripts", {}).get("test", "")
+            except (ValueError, AttributeError):
+                test_script = ""
+            if test_script and "no test specified" not in test_script:
+                test_commands.append("npm test")
+        if not test_commands:
+            return False, None, ""
+
+        test_log = []
+        passed = True
+        for command in test_commands:
+            if budget.expired():
+                test_log.append(f"Time budget exhausted before: {command}")
+                return True, False, "\n".join(test_log)
+            try:
+                result = run_command(command.split(), cwd=project_dir, timeout=budget.limit(TEST_SECONDS), env=env)
+            except Exception as e:
+                test_log.append(f"Failed to run {command}: {e}")
+                passed = False
+                continue
+            test_log.append(f"Ran: {command}")
+            if result.timed_out:
+                test_log.append("Timed out")
+                passed = False
+                continue
+            test_log.append(f"Exit code: {result.returncode}")
+            test_log.append((result.stdout + result.stderr)[-1000:])
+            passed = passed and result.returncode == 0
+        return True, passed, "\n".join(test_log)
+
+    def list_files(self, project_dir: str) -> List[str]:
+        """Every file in the submission, including media left out of the checkout"""
         try:
-            os.chdir(project_dir)
-            
-            # Common run patterns
-            run_commands = [
-                "python main.py",
-                "python app.py", 
-                "python -m src",
-                "npm start",
-                "npm run dev",
-                "make run",
-                "cargo run",
-                "./run.sh"
-            ]
-            
-            for command in run_commands:
-                try:
-                    # Try to run for 10 seconds to see if it starts
-                    result = subprocess.run(
-                        command.split(),
-                        capture_output=True,
-                        text=True,
-                        timeout=10
-                    )
-                    run_log.append(f"Tried: {command}")
-                    run_log.append(f"Exit code: {result.returncode}")
-                    if result.stdout:
-                        run_log.append(f"Output: {result.stdout[:200]}...")
-                    if result.returncode == 0:
-                        return True, "\n".join(run_log)
-                except subprocess.TimeoutExpired:
-                    run_log.append(f"Started successfully: {command}")
-                    return True, "\n".join(run_log)
-                except Exception:
-                    continue
-            
-            return False, "\n".join(run_log)
-            
-        finally:
-            os.chdir(original_dir)
-    
-    def judge_submission(self, repo_url: str) -> SubmissionScore:
+            result = run_command(["git", "ls-files", "-z"], cwd=project_dir, timeout=30)
+            if result.returncode == 0:
+                return [name for name in result.stdout.split("\0") if name]
+        except OSError:
+            pass
+        return sorted(str(p.relative_to(project_dir)) for p in Path(project_dir).rglob("*")
+                      if p.is_file() and ".git" not in p.parts)
+
+    def collect_evidence(self, workdir: Path, project_dir: str, budget: TimeBudget) -> Evidence:
+        """Read, set up, run and test the submission once; every subcategory is scored from the result"""
+        env, env_log = self.sandbox_env(workdir, project_dir, budget)
+        setup_success, setup_log = self.try_setup(project_dir, budget, env)
+        run_success, run_log = self.try_run_application(project_dir, budget, env)
+        tests_found, tests_passed, test_log = self.try_tests(project_dir, budget, env)
+        return Evidence(
+            readme=self.read_readme(project_dir),
+            files=self.list_files(project_dir),
+            setup_success=setup_success,
+            setup_log="\n".join(env_log + [setup_log]),
+            run_success=run_success,
+            run_log=run_log,
+            tests_found=tests_found,
+            tests_passed=tests_passed,
+            test_log=test_log,
+            cut_short=any(marker in log for log in (setup_log, test_log) for marker in CUT_SHORT_MARKERS),
+        )
+
+    def apply_scores(self, score: SubmissionScore, scores: Dict[Criterion, CriterionScore]) -> None:
+        for criterion, result in scores.items():
+            getattr(score, f"{criterion.category}_scores")[criterion.key] = result.score
+            score.rationales[criterion.key] = result.rationale
+        score.category1_total = sum(score.category1_scores.values())
+        score.category2_total = sum(score.category2_scores.values())
+        score.category3_total = sum(score.category3_scores.values())
+
+    def judge_submission(self, repo_url: str, budget: Optional[TimeBudget] = None) -> SubmissionScore:
         """Judge a single submission with 4-minute time limit"""
         start_time = time.time()
-        project_name = repo_url.split('/')[-1].replace('.git', '')
-        temp_dir = self.output_dir / f"temp_{project_name}"
-        
+        budget = TimeBudget(self.task_budget, parent=budget)
+        project_name = project_name_for(repo_url)
+
         print(f"\n🔍 Judging: {project_name}")
         print(f"Repository: {repo_url}")
-        
+
+        # Phases keep their 1:2:1 shares of a shorter or longer --task-budget, so scoring always gets its quarter
+        share = self.task_budget / TASK_BUDGET_SECONDS
+        exploration = budget.child(EXPLORATION_SECONDS * share)
+        commit = self.repo_cache.remote_commit(repo_url, exploration)
+        previous = self.previous_scores.get(repo_url)
+        if commit and previous and previous.commit == commit and not self.rejudge:
+            print(f"♻️  {project_name} is unchanged at {commit[:8]}, keeping its score")
+            return previous
+
         # Initialize scores
-        score = SubmissionScore(
-            project_name=project_name,
-            github_repo=repo_url,
-            category1_scores={"problem_definition": 1, "significance_impact": 1, "effectiveness": 1, "learning_craftsmanship": 1},
-            category2_scores={"scope_coverage": 1, "robustness_testing": 1, "documentation_reproducibility": 1, "code_quality": 1},
-            category3_scores={"originality_innovation": 1, "vibe_polish": 1, "effective_execution": 1, "storytelling_presentation": 1},
-            category1_total=4,
-            category2_total=4,
-            category3_total=4
-        )
-        
-        # 1. Repository Exploration (1 min)
-        if not self.clone_repository(repo_url, str(temp_dir)):
-            score.notes = "Failed to clone repository"
+        score = default_score(repo_url)
+
+        # Scores already cached for this commit and these rubrics need neither a fetch nor a run
+        cached = self.scoring.cached(commit) if commit and not self.rejudge else None
+        if cached is not None:
+            score.commit = commit
+            self.apply_scores(score, cached)
+            score.notes = f"Scores cached for {commit[:8]}"
+            print(f"♻️  {project_name} already scored at {commit[:8]}")
             return score
-        
-        readme_content = self.read_readme(str(temp_dir))
-        
-        # 2. Setup & Execution (2 min)
-        setup_success, setup_log = self.try_setup(str(temp_dir))
-        run_success, run_log = self.try_run_application(str(temp_dir))
-        
-        # 3. Quick Analysis and Scoring (1 min)
-        # This is where you would implement the actual scoring logic
-        # For now, we'll use placeholder scoring based on basic criteria
-        
-        # Check time limit
-        elapsed = time.time() - start_time
-        if elapsed > 240:  # 4 minutes
-            print(f"⏰ Time limit exceeded ({elapsed:.1f}s)")
-        
-        # Basic scoring logic (to be enhanced)
-        if readme_content:
-            if "problem" in readme_content.lower():
-                score.category1_scores["problem_definition"] = 6
-            if setup_success:
-                score.category2_scores["documentation_reproducibility"] = 7
-            if run_success:
-                score.category2_scores["robustness_testing"] = 7
-                score.category3_scores["effective_execution"] = 7
-        
-        # Calculate totals
-        score.category1_total = sum(score.category1_scores.values())
-        score.category2_total = sum(score.category2_scores.values())
-        score.category3_total = sum(score.category3_scores.values())
-        
-        score.notes = f"Setup: {'✅' if setup_success else '❌'}, Run: {'✅' if run_success else '❌'}, Time: {elapsed:.1f}s"
-        
-        # Cleanup
+
+        # A directory of its own, so submissions with the same name can be judged side by side
+        workdir = Path(tempfile.mkdtemp(prefix=f"temp_{project_name}_", dir=self.output_dir))
+        project_dir = str(workdir / "repo")
+
         try:
-            import shutil
-            shutil.rmtree(temp_dir)
-        except:
-            pass
-        
-        print(f"✅ Scored: Category1={score.category1_total}/40, Category2={score.category2_total}/40, Category3={score.category3_total}/40")
+            # 1. Repository Exploration (1 min)
+            fetched = self.fetch_repository(repo_url, project_dir, exploration, commit)
+            if fetched is None:
+                score.notes = "Failed to clone repository"
+                return score
+            score.commit = fetched.commit
+
+            # 2. Setup & Execution (2 min)
+            evidence = self.collect_evidence(workdir, project_dir, budget.child(SETUP_SECONDS * share))
+
+            # 3. Quick Analysis and Scoring (1 min): all twelve subcategories at once
+            self.apply_scores(score, self.scoring.score(evidence, score.commit, timeout=budget.remaining(),
+                                                        refresh=self.rejudge))
+
+            # Check time limit
+            elapsed = time.time() - start_time
+            if budget.expired():
+                print(f"⏰ Time limit reached for {project_name} ({elapsed:.1f}s)")
+
+            tests = "–" if not evidence.tests_found else "✅" if evidence.tests_passed else "❌"
+            score.notes = (f"Setup: {'✅' if evidence.setup_success else '❌'}, "
+                           f"Run: {'✅' if evidence.run_success else '❌'}, Tests: {tests}, "
+                           f"Time: {elapsed:.1f}s, Fetch: {fetched.describe()}")
+        finally:
+            self.repo_cache.release(repo_url, project_dir)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        print(f"✅ Scored {project_name}: Category1={score.category1_total}/40, Category2={score.category2_total}/40, Category3={score.category3_total}/40")
         return score
-    
-    def save_scores(self):
-        """Save scores to markdown tables"""
+
+    def record_score(self, score: SubmissionScore) -> None:
+        """Persist a finished score and add it to the leaderboard"""
+        self.store.append(score)
+        self.add_to_leaderboard(score)
+
+    def add_to_leaderboard(self, score: SubmissionScore) -> None:
+        self.scores.append(score)
+        self.leaderboard.update(score)
+        self.save_scores(force=False)
+
+    def judge_all(self, repo_urls: List[str], workers: int = DEFAULT_WORKERS,
+                  global_budget: Optional[float] = None, resume: bool = False) -> List[SubmissionScore]:
+        """
+        Judge submissions concurrently, recording each score as soon as it is ready.
+
+        The work is cloning, installing and running the submissions in child
+        processes, so threads that wait on them judge `workers` submissions at
+        once. Submissions not started before `global_budget` runs out get the
+        minimum scores, and the ones running are cut short at that point.
+
+        With `resume`, submissions that already have a score in results.jsonl
+        keep it without being looked at again, so an interrupted run picks up
+        where it stopped.
+        """
+        run_budget = TimeBudget(global_budget)
+        if resume:
+            done = [url for url in dict.fromkeys(repo_urls) if url in self.previous_scores]
+            for repo_url in done:
+                self.add_to_leaderboard(self.previous_scores[repo_url])
+            repo_urls = [url for url in repo_urls if url not in self.previous_scores]
+            print(f"⏩ Resuming: {len(done)} submissions already judged, {len(repo_urls)} to go")
+
+        def judge(repo_url: str) -> SubmissionScore:
+            if run_budget.expired():
+                return default_score(repo_url, "Not judged: global time budget exhausted")
+            try:
+                return self.judge_submission(repo_url, run_budget)
+            except Exception as e:
+                print(f"❌ Error judging {repo_url}: {e}")
+                return default_score(repo_url, f"Failed to judge: {str(e)}")
+
+        executor = ThreadPoolExecutor(max_workers=max(1, workers))
+        futures = [executor.submit(judge, repo_url) for repo_url in repo_urls]
+        try:
+            for count, future in enumerate(as_completed(futures), 1):
+                score = future.result()
+                self.record_score(score)
+                ranks = ", ".join(f"#{self.leaderboard.rank_of(score.github_repo, category)}"
+                                  for category in ("category1", "category2", "category3"))
+                print(f"📋 {count}/{len(repo_urls)} judged; {score.project_name} ranks {ranks}")
+        finally:
+            # On Ctrl-C, drop the queued submissions; the running ones stop at their deadlines
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+        return self.scores
+
+    def save_scores(self, force: bool = True):
+        """
+        Write scores.md and scores.json from the leaderboard.
+
+        While judging this runs after every result but only rewrites the
+        files when the leaderboard changed and `refresh_seconds` have passed;
+        `force` writes any change immediately.
+        """
+        if self.leaderboard.version == self._saved_version:
+            return
+        if not force and time.monotonic() - self._refreshed_at < self.refresh_seconds:
+            return
+        self._refreshed_at = time.monotonic()
+        self._saved_version = self.leaderboard.version
+
         scores_file = self.output_dir / "scores.md"
-        
-        # Sort by scores for each category
-        cat1_sorted = sorted(self.scores, key=lambda x: x.category1_total, reverse=True)
-        cat2_sorted = sorted(self.scores, key=lambda x: x.category2_total, reverse=True)
-        cat3_sorted = sorted(self.scores, key=lambda x: x.category3_total, reverse=True)
-        
-        with open(scores_file, 'w') as f:
-            f.write("# Hackathon Judging Results\n\n")
-            
-            # Category 1: Best Problem
-            f.write("## Category 1: Best Problem\n\n")
-            f.write("| Rank | Project | GitHub Repo | Problem Definition | Significance & Impact | Effectiveness | Learning & Craftsmanship | **Total** | Notes |\n")
-            f.write("|------|---------|-------------|-------------------|---------------------|---------------|------------------------|-----------|-------|\n")
-            
-            for i, score in enumerate(cat1_sorted, 1):
-                f.write(f"| {i} | {score.project_name} | {score.github_repo} | "
-                       f"{score.category1_scores['problem_definition']} | "
-                       f"{score.category1_scores['significance_impact']} | "
-                       f"{score.category1_scores['effectiveness']} | "
-                       f"{score.category1_scores['learning_craftsmanship']} | "
-                       f"**{score.category1_total}/40** | {score.notes} |\n")
-            
-            # Category 2: Most Complete
-            f.write("\n## Category 2: Most Complete\n\n")
-            f.write("| Rank | Project | GitHub Repo | Scope Coverage | Robustness & Testing | Documentation & Reproducibility | Code Quality | **Total** | Notes |\n")
-            f.write("|------|---------|-------------|----------------|-------------------|---------------------------|--------------|-----------|-------|\n")
-            
-            for i, score in enumerate(cat2_sorted, 1):
-                f.write(f"| {i} | {score.project_name} | {score.github_repo} | "
-                       f"{score.category2_scores['scope_coverage']} | "
-                       f"{score.category2_scores['robustness_testing']} | "
-                       f"{score.category2_scores['documentation_reproducibility']} | "
-                       f"{score.category2_scores['code_quality']} | "
-                       f"**{score.category2_total}/40** | {score.notes} |\n")
-            
-            # Category 3: Most Creative
-            f.write("\n## Category 3: Most Creative\n\n")
-            f.write("| Rank | Project | GitHub Repo | Originality & Innovation | Vibe & Polish | Effective Execution | Storytelling & Presentation | **Total** | Notes |\n")
-            f.write("|------|---------|-------------|-------------------------|---------------|-------------------|---------------------------|-----------|-------|\n")
-            
-            for i, score in enumerate(cat3_sorted, 1):
-                f.write(f"| {i} | {score.project_name} | {score.github_repo} | "
-                       f"{score.category3_scores['originality_innovation']} | "
-                       f"{score.category3_scores['vibe_polish']} | "
-                       f"{score.category3_scores['effective_execution']} | "
-                       f"{score.category3_scores['storytelling_presentation']} | "
-                       f"**{score.category3_total}/40** | {score.notes} |\n")
-        
-        print(f"\n📊 Scores saved to: {scores_file}")
-        
+        write_atomically(scores_file, self.leaderboard.markdown())
+
         # Also save raw JSON data
         json_file = self.output_dir / "scores.json"
-        with open(json_file, 'w') as f:
-            json.dump([asdict(score) for score in self.scores], f, indent=2)
+        write_atomically(json_file, json.dumps([asdict(score) for score in self.leaderboard.scores.values()], indent=2))
+        if force:
+            print(f"\n📊 Scores saved to: {scores_file}")
 
 def main():
-    if len(sys.argv) != 2:
-        print("Usage: python judge_submissions.py submissions.txt")
-        print("Where submissions.txt contains one GitHub repo URL per line")
-        sys.exit(1)
-    
-    submissions_file = sys.argv[1]
+    parser = argparse.ArgumentParser(description="Judge hackathon submissions")
+    parser.add_argument("submissions_file", help="File with one GitHub repo URL per line")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help=f"Submissions judged at once (default {DEFAULT_WORKERS})")
+    parser.add_argument("--task-budget", type=float, default=TASK_BUDGET_SECONDS,
+                        help=f"Seconds allowed per submission (default {TASK_BUDGET_SECONDS})")
+    parser.add_argument("--global-budget", type=float, default=None,
+                        help="Seconds allowed for the whole run (default unlimited)")
+    parser.add_argument("--output-dir", default="judging_results")
+    parser.add_argument("--cache-dir", help="Where repository mirrors are kept (default OUTPUT_DIR/repo_cache)")
+    parser.add_argument("--resume", action="store_true",
+                        help="Keep every score already in results.jsonl and judge only the rest")
+    parser.add_argument("--refresh-seconds", type=float, default=REFRESH_SECONDS,
+                        help=f"How often scores.md is rewritten while judging (default {REFRESH_SECONDS})")
+    parser.add_argument("--rejudge", action="store_true",
+                        help="Judge every submission again, even when its commit has not changed")
+    parser.add_argument("--scorer", choices=("local", "model"), default="local",
+                        help="local: deterministic offline scoring; model: the chat model at JUDGE_MODEL_URL")
+    parser.add_argument("--scoring-workers", type=int, default=16,
+                        help="Subcategories scored at once across all submissions (default 16)")
+    args = parser.parse_args()
+
+    submissions_file = args.submissions_file
     if not Path(submissions_file).exists():
         print(f"Error: {submissions_file} not found")
         sys.exit(1)
@@ -299,36 +698,24 @@ def main():
     with open(submissions_file, 'r') as f:
         repo_urls = [line.strip() for line in f if line.strip() and not line.startswith('#')]
     
-    print(f"🏆 Starting judging process for {len(repo_urls)} submissions")
-    
-    judge = HackathonJudge()
-    
-    for i, repo_url in enumerate(repo_urls, 1):
-        print(f"\n{'='*60}")
-        print(f"📋 Judging submission {i}/{len(repo_urls)}")
-        
-        try:
-            score = judge.judge_submission(repo_url)
-            judge.scores.append(score)
-        except Exception as e:
-            print(f"❌ Error judging {repo_url}: {e}")
-            # Add a failed score
-            project_name = repo_url.split('/')[-1].replace('.git', '')
-            failed_score = SubmissionScore(
-                project_name=project_name,
-                github_repo=repo_url,
-                category1_scores={"problem_definition": 1, "significance_impact": 1, "effectiveness": 1, "learning_craftsmanship": 1},
-                category2_scores={"scope_coverage": 1, "robustness_testing": 1, "documentation_reproducibility": 1, "code_quality": 1},
-                category3_scores={"originality_innovation": 1, "vibe_polish": 1, "effective_execution": 1, "storytelling_presentation": 1},
-                category1_total=4,
-                category2_total=4,
-                category3_total=4,
-                notes=f"Failed to judge: {str(e)}"
-            )
-            judge.scores.append(failed_score)
+    print(f"🏆 Starting judging process for {len(repo_urls)} submissions ({args.workers} at a time)")
     
-    judge.save_scores()
-    print(f"\n🎉 Judging complete! Results saved to judging_results/")
+    try:
+        scorer = ChatModelBackend.from_env() if args.scorer == "model" else LocalBackend()
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    judge = HackathonJudge(args.output_dir, task_budget=args.task_budget, cache_dir=args.cache_dir,
+                           rejudge=args.rejudge, scorer=scorer, scoring_workers=args.scoring_workers)
+    judge.refresh_seconds = args.refresh_seconds
+    try:
+        judge.judge_all(repo_urls, workers=args.workers, global_budget=args.global_budget, resume=args.resume)
+    finally:
+        judge.scoring.close()
+        # Whatever was judged before a crash or Ctrl-C still makes it into the tables
+        judge.save_scores()
+    print(f"\n🎉 Judging complete! Results saved to {args.output_dir}/")
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
@@ -0,0 +1,144 @@
+"""
+Judging results: the append-only results store and the live leaderboard.
+
+Every SubmissionScore is appended to results.jsonl as soon as it is ready;
+the latest line for a repository wins. The leaderboard keeps each category's
+ranking sorted as scores arrive, so adding a result costs a binary search
+rather than a re-sort, and scores.md/scores.json are only regenerated when
+something changed and someone asks for them.
+"""
+
+import json
+import os
+from bisect import bisect_left, insort
+from dataclasses import asdict, dataclass, field, fields
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+@dataclass
+class SubmissionScore:
+    project_name: str
+    github_repo: str
+    category1_scores: Dict[str, int]  # subcategory -> score
+    category2_scores: Dict[str, int]
+    category3_scores: Dict[str, int]
+    category1_total: int
+    category2_total: int
+    category3_total: int
+    notes: str = ""
+    commit: str = ""  # the commit that was judged
+    rationales: Dict[str, str] = field(default_factory=dict)  # subcategory -> why it got its score
+
+class ResultsStore:
+    """Append-only JSONL file of SubmissionScores"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+
+    def append(self, score: SubmissionScore) -> None:
+        """Append a finished score, flushed to disk so a crash later in the run cannot lose it"""
+        line = (json.dumps(asdict(score), ensure_ascii=False) + "\n").encode('utf-8')
+        with open(self.path, 'ab+') as f:
+            # Start on a fresh line if a crash left the last one unfinished
+            if f.seek(0, os.SEEK_END) > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    line = b"\n" + line
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def load(self) -> Dict[str, SubmissionScore]:
+        """The latest recorded score of each repository"""
+        known = {f.name for f in fields(SubmissionScore)}
+        latest = {}
+        if not self.path.exists():
+            return latest
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    continue  # a line cut short by a crash
+                latest[row["github_repo"]] = SubmissionScore(**{k: v for k, v in row.items() if k in known})
+        return latest
+
+# Each category's markdown table: heading, (subcategory, column) pairs and the separator row
+CATEGORY_TABLES = [
+    ("category1", "Category 1: Best Problem",
+     [("problem_definition", "Problem Definition"), ("significance_impact", "Significance & Impact"),
+      ("effectiveness", "Effectiveness"), ("learning_craftsmanship", "Learning & Craftsmanship")],
+     "|------|---------|-------------|-------------------|---------------------|---------------|------------------------|-----------|-------|"),
+    ("category2", "Category 2: Most Complete",
+     [("scope_coverage", "Scope Coverage"), ("robustness_testing", "Robustness & Testing"),
+      ("documentation_reproducibility", "Documentation & Reproducibility"), ("code_quality", "Code Quality")],
+     "|------|---------|-------------|----------------|-------------------|---------------------------|--------------|-----------|-------|"),
+    ("category3", "Category 3: Most Creative",
+     [("originality_innovation", "Originality & Innovation"), ("vibe_polish", "Vibe & Polish"),
+      ("effective_execution", "Effective Execution"), ("storytelling_presentation", "Storytelling & Presentation")],
+     "|------|---------|-------------|-------------------------|---------------|-------------------|---------------------------|-----------|-------|"),
+]
+
+class Leaderboard:
+    """
+    Per-category rankings kept sorted as scores arrive.
+
+    Each category is a sorted list of (-total, project, repo) entries:
+    adding or replacing a repository's score is a binary search plus a list
+    insert, and the markdown is rendered only when asked for and only if
+    something changed since the last time.
+    """
+
+    def __init__(self):
+        self.scores: Dict[str, SubmissionScore] = {}
+        self.rankings: Dict[str, List[Tuple[int, str, str]]] = {category: [] for category, *_ in CATEGORY_TABLES}
+        self.version = 0
+        self._rendered: Tuple[int, str] = (-1, "")
+
+    @staticmethod
+    def _entry(score: SubmissionScore, category: str) -> Tuple[int, str, str]:
+        return (-getattr(score, f"{category}_total"), score.project_name, score.github_repo)
+
+    def update(self, score: SubmissionScore) -> None:
+        """Add a repository's score, replacing any earlier score for it"""
+        previous = self.scores.get(score.github_repo)
+        for category, ranking in self.rankings.items():
+            if previous is not None:
+                del ranking[bisect_left(ranking, self._entry(previous, category))]
+            insort(ranking, self._entry(score, category))
+        self.scores[score.github_repo] = score
+        self.version += 1
+
+    def ranked(self, category: str) -> List[SubmissionScore]:
+        return [self.scores[repo] for _, _, repo in self.rankings[category]]
+
+    def rank_of(self, repo_url: str, category: str) -> int:
+        """1-based rank of a repository in a category"""
+        return bisect_left(self.rankings[category], self._entry(self.scores[repo_url], category)) + 1
+
+    def markdown(self) -> str:
+        version, text = self._rendered
+        if version == self.version:
+            return text
+        lines = ["# Hackathon Judging Results", ""]
+        for category, heading, columns, separator in CATEGORY_TABLES:
+            if lines[-1] != "":
+                lines.append("")
+            lines += [f"## {heading}", "",
+                      "| Rank | Project | GitHub Repo | " + " | ".join(title for _, title in columns)
+                      + " | **Total** | Notes |",
+                      separator]
+            for i, score in enumerate(self.ranked(category), 1):
+                subscores = getattr(score, f"{category}_scores")
+                lines.append(f"| {i} | {score.project_name} | {score.github_repo} | "
+                             + " | ".join(str(subscores[key]) for key, _ in columns)
+                             + f" | **{getattr(score, f'{category}_total')}/40** | {score.notes} |")
+        text = "\n".join(lines) + "\n"
+        self._rendered = (self.version, text)
+        return text
+
+def write_atomically(path: Path, text: str) -> None:
+    """Replace a file in one step, so anyone watching it never reads half of it"""
+    partial = path.with_name(path.name + ".partial")
+    partial.write_text(text, encoding='utf-8')
+    os.replace(partial, path)
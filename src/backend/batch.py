@@ -0,0 +1,257 @@
+"""
+Batch analysis for catalog ingestion.
+
+A batch is a set of images (uploaded bytes or files named in a manifest).
+Images are deduplicated by content digest, analyzed with bounded
+concurrency, and every finished image is appended to a per-job JSONL log.
+Re-running a batch with the same job ID replays the logged results instead
+of analyzing those images again, so an interrupted nightly job picks up
+where it stopped.
+
+Results are produced as an async iterator of plain dicts, which the API
+streams back as NDJSON and Python callers can consume directly.
+"""
+
+import asyncio
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import time
+import uuid
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import AsyncIterator, Awaitable, BinaryIO, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from src.backend.cache import image_digest
+
+_JOB_ID = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+_HASH_CHUNK = 1024 * 1024
+
+
+class BatchInputError(ValueError):
+    """Raised for invalid batch input, such as a manifest path outside the allowed root."""
+
+
+@dataclass
+class BatchImage:
+    digest: str
+    content_type: str
+    sources: List[str] = field(default_factory=list)
+    # The bytes themselves, or a (spooled upload) file or path to read them from when needed
+    content: Optional[bytes] = None
+    path: Optional[str] = None
+    file: Optional[BinaryIO] = None
+
+    def load(self) -> bytes:
+        if self.content is not None:
+            return self.content
+        if self.file is not None:
+            self.file.seek(0)
+            return self.file.read()
+        with open(self.path, "rb") as f:
+            return f.read()
+
+
+def _file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def dedupe_uploads(uploads: Iterable[Tuple[str, Union[bytes, BinaryIO], str]]) -> List[BatchImage]:
+    """
+    Group (source name, bytes or binary file, content type) uploads by content digest.
+
+    Files, such as spooled uploads, are hashed in chunks and only read whole
+    when their image is analyzed.
+    """
+    images: Dict[str, BatchImage] = {}
+    for source, content, content_type in uploads:
+        digest = image_digest(content)
+        if digest not in images:
+            if isinstance(content, bytes):
+                images[digest] = BatchImage(digest=digest, content_type=content_type, content=content)
+            else:
+                images[digest] = BatchImage(digest=digest, content_type=content_type, file=content)
+        images[digest].sources.append(source)
+    return list(images.values())
+
+
+def parse_manifest(text: str) -> List[str]:
+    """
+    Read image paths from a manifest: a JSON list, or one path per line ('#' starts a comment).
+    """
+    stripped = text.strip()
+    if stripped.startswith("["):
+        paths = json.loads(stripped)
+        if not all(isinstance(p, str) for p in paths):
+            raise BatchInputError("Manifest JSON must be a list of path strings")
+        return paths
+    return [line.strip() for line in text.splitlines() if line.strip() and not line.strip().startswith("#")]
+
+
+def dedupe_paths(paths: Iterable[str], root: Optional[str] = None) -> List[BatchImage]:
+    """
+    Hash the files named in a manifest and group them by content digest.
+
+    Relative paths are resolved against `root`; when `root` is given, paths
+    that resolve outside it are rejected. Files are only hashed here and read
+    again when their turn comes, so memory does not grow with batch size.
+    """
+    base = Path(root).resolve() if root else None
+    images: Dict[str, BatchImage] = {}
+    for source in paths:
+        path = Path(source)
+        if base is not None:
+            path = (base / path).resolve()
+            if base not in path.parents:
+                raise BatchInputError(f"Manifest path is outside the allowed directory: {source}")
+        if not path.is_file():
+            raise BatchInputError(f"Manifest path does not exist: {source}")
+        digest = _file_digest(str(path))
+        if digest not in images:
+            content_type = mimetypes.guess_type(path.name)[0] or "image/jpeg"
+            images[digest] = BatchImage(digest=digest, content_type=content_type, path=str(path))
+        images[digest].sources.append(source)
+    return list(images.values())
+
+
+class BatchJobStore:
+    """
+    Append-only JSONL progress logs, one file per job.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+
+    def new_job_id(self) -> str:
+        return uuid.uuid4().hex
+
+    def _path(self, job_id: str) -> Path:
+        if not _JOB_ID.match(job_id):
+            raise BatchInputError(f"Invalid job ID: {job_id!r}")
+        return self.directory / f"{job_id}.jsonl"
+
+    def exists(self, job_id: str) -> bool:
+        return self._path(job_id).exists()
+
+    def append(self, job_id: str, record: dict) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(self._path(job_id), "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    def records(self, job_id: str) -> List[dict]:
+        path = self._path(job_id)
+        if not path.exists():
+            return []
+        records = []
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # A crash mid-write leaves at most one partial line at the end
+                    continue
+        return records
+
+    def completed(self, job_id: str) -> Dict[str, dict]:
+        """
+        Return the successful result records of a job, keyed by digest.
+        """
+        return {
+            record["digest"]: record
+            for record in self.records(job_id)
+            if record.get("type") == "result" and record.get("status") == "ok"
+        }
+
+    def progress(self, job_id: str) -> dict:
+        records = self.records(job_id)
+        results = [r for r in records if r.get("type") == "result"]
+        succeeded = {r["digest"] for r in results if r.get("status") == "ok"}
+        failed = {r["digest"] for r in results if r.get("status") != "ok"} - succeeded
+        runs = [r for r in records if r.get("type") == "run"]
+        return {
+            "jobId": job_id,
+            "total": runs[-1]["total"] if runs else 0,
+            "completed": len(succeeded),
+            "failed": len(failed),
+            "runs": len(runs),
+            "updatedAt": os.path.getmtime(self._path(job_id)) if records else None,
+        }
+
+
+AnalyzeFn = Callable[[bytes, str], Awaitable[dict]]
+
+
+async def run_batch(
+    images: List[BatchImage],
+    analyze: AnalyzeFn,
+    store: BatchJobStore,
+    job_id: Optional[str] = None,
+    concurrency: int = 8,
+) -> AsyncIterator[dict]:
+    """
+    Analyze `images` and yield one NDJSON-ready record per unique image.
+
+    The first record describes the job (`type: "job"`), the last one
+    summarizes it (`type: "summary"`). Images already completed under
+    `job_id` are replayed from the log with `resumed: true`. Failed images
+    are logged and reported but retried on the next run of the same job.
+    """
+    job_id = job_id or store.new_job_id()
+    done = store.completed(job_id)
+    pending = [image for image in images if image.digest not in done]
+    started = time.monotonic()
+
+    store.append(job_id, {"type": "run", "total": len(images), "pending": len(pending), "startedAt": time.time()})
+    yield {"type": "job", "jobId": job_id, "total": len(images), "resumed": len(images) - len(pending)}
+
+    for image in images:
+        if image.digest in done:
+            record = dict(done[image.digest], sources=image.sources, resumed=True)
+            yield record
+
+    queue: asyncio.Queue = asyncio.Queue()
+    todo = iter(pending)
+    succeeded = failed = 0
+
+    async def worker() -> None:
+        for image in todo:
+            try:
+                content = await asyncio.to_thread(image.load)
+                result = await analyze(content, image.content_type)
+                record = {"type": "result", "digest": image.digest, "sources": image.sources,
+                          "status": "ok", "result": result}
+            except Exception as e:
+                detail = getattr(e, "detail", None) or str(e) or type(e).__name__
+                record = {"type": "result", "digest": image.digest, "sources": image.sources,
+                          "status": "error", "error": detail}
+            store.append(job_id, record)
+            await queue.put(record)
+
+    workers = [asyncio.create_task(worker()) for _ in range(max(1, min(concurrency, len(pending))))]
+    try:
+        for _ in range(len(pending)):
+            record = await queue.get()
+            if record["status"] == "ok":
+                succeeded += 1
+            else:
+                failed += 1
+            yield record
+    finally:
+        for task in workers:
+            task.cancel()
+
+    yield {
+        "type": "summary",
+        "jobId": job_id,
+        "total": len(images),
+        "analyzed": succeeded,
+        "failed": failed,
+        "resumed": len(images) - len(pending),
+        "elapsedSeconds": round(time.monotonic() - started, 3),
+    }
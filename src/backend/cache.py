@@ -0,0 +1,186 @@
+"""
+Content-addressed cache for outfit analysis results.
+
+Entries are keyed by a digest of the uploaded image together with everything
+else that affects the model output (deployment, prompt version, max_tokens),
+so a hit is always safe to return verbatim. Results live in a bounded
+in-memory LRU tier and, optionally, in a SQLite file that survives restarts.
+The async `aget`/`aset` used by the API look at the LRU on the event loop
+and do SQLite reads and commits (an fsync each) in a worker thread, so a
+disk lookup or write never stalls other requests.
+"""
+
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import BinaryIO, Optional, Union
+
+_HASH_CHUNK = 64 * 1024
+
+
+def image_digest(image_content: Union[bytes, BinaryIO]) -> str:
+    """
+    Return the hex SHA-256 digest of the image bytes, or of a binary file
+    read in fixed-size chunks (leaving it rewound).
+    """
+    if isinstance(image_content, (bytes, bytearray, memoryview)):
+        return hashlib.sha256(image_content).hexdigest()
+    digest = hashlib.sha256()
+    image_content.seek(0)
+    for chunk in iter(lambda: image_content.read(_HASH_CHUNK), b""):
+        digest.update(chunk)
+    image_content.seek(0)
+    return digest.hexdigest()
+
+
+def make_cache_key(digest: str, deployment: str, prompt_version: str, max_tokens: int) -> str:
+    """
+    Combine the image digest with the request parameters that shape the result.
+    """
+    return f"{digest}:{deployment}:{prompt_version}:{max_tokens}"
+
+
+class ResultCache:
+    def __init__(self, max_entries: int = 1024, ttl: Optional[float] = 86400.0, path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        # key -> (stored_at, serialized result)
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Separate from the LRU's lock, so the event loop never waits behind a disk operation
+        self._db_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, stored_at REAL NOT NULL)"
+            )
+            self._db.commit()
+
+    def _expired(self, stored_at: float, now: float) -> bool:
+        return self.ttl is not None and now - stored_at > self.ttl
+
+    def _remember(self, key: str, stored_at: float, value: str) -> None:
+        self._memory[key] = (stored_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.evictions += 1
+
+    def _get_memory(self, key: str, now: float) -> Optional[str]:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if not self._expired(entry[0], now):
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._memory[key]
+                self.expirations += 1
+            if self._db is None:
+                self.misses += 1
+            return None
+
+    def _get_disk(self, key: str, now: float) -> Optional[str]:
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT value, stored_at FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            expired = row is not None and self._expired(row[1], now)
+            if expired:
+                self._db.execute("DELETE FROM results WHERE key = ?", (key,))
+                self._db.commit()
+        with self._lock:
+            if row is not None and not expired:
+                self._remember(key, row[1], row[0])
+                self.hits += 1
+                self.disk_hits += 1
+                return row[0]
+            if expired:
+                self.expirations += 1
+            self.misses += 1
+            return None
+
+    def _store(self, key: str, value: str, stored_at: float) -> None:
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO results (key, value, stored_at) VALUES (?, ?, ?)",
+                (key, value, stored_at),
+            )
+            self._db.commit()
+
+    def get(self, key: str) -> Optional[dict]:
+        """
+        Return the cached result for `key`, or None on a miss.
+        """
+        now = time.time()
+        value = self._get_memory(key, now)
+        if value is None and self._db is not None:
+            value = self._get_disk(key, now)
+        return json.loads(value) if value is not None else None
+
+    async def aget(self, key: str) -> Optional[dict]:
+        """
+        `get` for the event loop: a miss in memory is looked up on disk in a worker thread.
+        """
+        now = time.time()
+        value = self._get_memory(key, now)
+        if value is None and self._db is not None:
+            value = await asyncio.to_thread(self._get_disk, key, now)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key: str, result: dict) -> None:
+        """
+        Store `result` under `key` in every configured tier.
+        """
+        value = json.dumps(result, separators=(",", ":"))
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, value)
+        if self._db is not None:
+            self._store(key, value, now)
+
+    async def aset(self, key: str, result: dict) -> None:
+        """
+        `set` for the event loop: the result is in memory at once and written to disk in a worker thread.
+        """
+        value = json.dumps(result, separators=(",", ":"))
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, value)
+        if self._db is not None:
+            await asyncio.to_thread(self._store, key, value, now)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+        if self._db is not None:
+            with self._db_lock:
+                self._db.execute("DELETE FROM results")
+                self._db.commit()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._memory),
+            "maxEntries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "diskHits": self.disk_hits,
+            "hitRate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "persistent": self._db is not None,
+        }
@@ -0,0 +1,386 @@
+"""
+Local product catalog for matching suggested items to real products.
+
+A product feed (CSV or JSONL) is compiled once into an on-disk index
+directory: an inverted index whose postings carry precomputed BM25 impacts,
+per-product attribute columns (category, color, price) and the product
+records themselves. Everything is stored as flat NumPy arrays and a JSONL
+file that are memory-mapped on open, so startup does not depend on catalog
+size and a query only touches the postings of its own terms.
+
+Build an index with:
+
+    python -m src.backend.catalog feed.csv catalog_index/
+
+and point CATALOG_INDEX_PATH at the directory.
+"""
+
+import argparse
+import csv
+import json
+import mmap
+import re
+import threading
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+INDEX_VERSION = 1
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+# Name terms count double: the model describes items the way products are named
+NAME_WEIGHT = 2
+
+# Postings are stored best impact first; a query reads at most this many per
+# term, which bounds its cost for common words like "black" or "dress"
+MAX_POSTINGS_PER_TERM = 1024
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+_PRICE = re.compile(r"\$?\s*(\d+(?:[.,]\d+)?)")
+_STOPWORDS = frozenset(
+    "a an and as at by for from in into of on or the to with this that these those is are be it its".split()
+)
+
+# Feed columns accepted for each product field, in order of preference
+_FIELD_ALIASES = {
+    "id": ("id", "sku", "product_id", "productId"),
+    "name": ("name", "title", "product_name"),
+    "description": ("description", "desc"),
+    "category": ("category", "product_type", "type"),
+    "color": ("color", "colour"),
+    "price": ("price", "sale_price"),
+    "imageUrl": ("imageUrl", "image_url", "image_link", "image"),
+    "productUrl": ("productUrl", "product_url", "link", "url"),
+}
+
+# Named price bands for the `price_band` filter, in dollars
+PRICE_BANDS = {
+    "budget": (0.0, 50.0),
+    "mid": (50.0, 150.0),
+    "premium": (150.0, 500.0),
+    "luxury": (500.0, float("inf")),
+}
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lowercase word tokens with stopwords dropped and plurals folded.
+    """
+    tokens = []
+    for token in _TOKEN.findall(text.lower()):
+        if token in _STOPWORDS:
+            continue
+        if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+            # "dresses" -> "dress", "boxes" -> "box", "shoes" -> "shoe"
+            token = token[:-2] if token.endswith(("sses", "xes", "zes", "ches", "shes")) else token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+def parse_price(value) -> Optional[float]:
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = _PRICE.search(str(value))
+    return float(match.group(1).replace(",", "")) if match else None
+
+
+def parse_price_range(text: str) -> Optional[Tuple[float, float]]:
+    """
+    Read a price range such as "$80 - $120" or "around $60" from free text.
+    """
+    prices = [float(p.replace(",", "")) for p in re.findall(r"\$\s*(\d+(?:[.,]\d+)?)", text or "")]
+    if not prices:
+        return None
+    return min(prices), max(prices)
+
+
+def _normalize(record: dict) -> dict:
+    product = {}
+    for field, aliases in _FIELD_ALIASES.items():
+        value = next((record[a] for a in aliases if record.get(a) not in (None, "")), "")
+        product[field] = value if field == "price" else str(value).strip()
+    product["price"] = parse_price(product["price"])
+    product["category"] = product["category"].lower()
+    product["color"] = product["color"].lower()
+    return product
+
+
+def read_feed(path: str) -> Iterable[dict]:
+    """
+    Yield normalized products from a CSV or JSONL feed.
+    """
+    with open(path, encoding="utf-8", newline="") as f:
+        if path.endswith((".jsonl", ".ndjson", ".json")):
+            for line in f:
+                if line.strip():
+                    yield _normalize(json.loads(line))
+        else:
+            for row in csv.DictReader(f):
+                yield _normalize(row)
+
+
+def build_index(products: Iterable[dict], directory: str) -> int:
+    """
+    Compile products into an index directory and return the product count.
+    """
+    out = Path(directory)
+    out.mkdir(parents=True, exist_ok=True)
+
+    terms: Dict[str, int] = {}
+    postings: List[List[Tuple[int, int]]] = []
+    doc_lengths = []
+    prices, categories, colors = [], [], []
+    category_ids: Dict[str, int] = {}
+    color_ids: Dict[str, int] = {}
+    offsets = [0]
+
+    with open(out / "products.jsonl", "wb") as records:
+        for doc, product in enumerate(products):
+            counts = Counter(tokenize(product["name"]) * NAME_WEIGHT)
+            counts.update(tokenize(" ".join((product["description"], product["category"], product["color"]))))
+            for term, tf in counts.items():
+                term_id = terms.setdefault(term, len(terms))
+                if term_id == len(postings):
+                    postings.append([])
+                postings[term_id].append((doc, tf))
+            doc_lengths.append(sum(counts.values()))
+            prices.append(np.nan if product["price"] is None else product["price"])
+            categories.append(category_ids.setdefault(product["category"], len(category_ids)) if product["category"] else -1)
+            colors.append(color_ids.setdefault(product["color"], len(color_ids)) if product["color"] else -1)
+
+            record = json.dumps(product, separators=(",", ":")).encode("utf-8") + b"\n"
+            records.write(record)
+            offsets.append(offsets[-1] + len(record))
+
+    n_docs = len(doc_lengths)
+    lengths = np.asarray(doc_lengths, dtype=np.float32)
+    avgdl = float(lengths.mean()) if n_docs else 0.0
+
+    term_offsets = np.zeros(len(postings) + 1, dtype=np.int64)
+    doc_ids = np.empty(sum(len(p) for p in postings), dtype=np.int32)
+    impacts = np.empty(len(doc_ids), dtype=np.float32)
+    position = 0
+    for term_id, plist in enumerate(postings):
+        docs = np.fromiter((d for d, _ in plist), dtype=np.int32, count=len(plist))
+        tf = np.fromiter((t for _, t in plist), dtype=np.float32, count=len(plist))
+        idf = np.log(1 + (n_docs - len(plist) + 0.5) / (len(plist) + 0.5))
+        norm = K1 * (1 - B + B * lengths[docs] / avgdl)
+        # The whole BM25 term weight is fixed at build time, so a query only sums impacts
+        impact = idf * tf * (K1 + 1) / (tf + norm)
+        order = np.argsort(-impact, kind="stable")
+        doc_ids[position:position + len(plist)] = docs[order]
+        impacts[position:position + len(plist)] = impact[order]
+        position += len(plist)
+        term_offsets[term_id + 1] = position
+
+    np.save(out / "term_offsets.npy", term_offsets)
+    np.save(out / "doc_ids.npy", doc_ids)
+    np.save(out / "impacts.npy", impacts)
+    np.save(out / "prices.npy", np.asarray(prices, dtype=np.float32))
+    np.save(out / "categories.npy", np.asarray(categories, dtype=np.int16))
+    np.save(out / "colors.npy", np.asarray(colors, dtype=np.int16))
+    np.save(out / "product_offsets.npy", np.asarray(offsets, dtype=np.int64))
+    with open(out / "meta.json", "w", encoding="utf-8") as f:
+        json.dump({
+            "version": INDEX_VERSION,
+            "products": n_docs,
+            "terms": terms,
+            "categories": list(category_ids),
+            "colors": list(color_ids),
+        }, f)
+    return n_docs
+
+
+class CatalogIndex:
+    def __init__(self, directory: str, max_postings: int = MAX_POSTINGS_PER_TERM):
+        path = Path(directory)
+        self.max_postings = max_postings
+        with open(path / "meta.json", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != INDEX_VERSION:
+            raise ValueError(f"Unsupported catalog index version: {meta.get('version')}")
+        self.size = meta["products"]
+        self._terms: Dict[str, int] = meta["terms"]
+        self.categories: List[str] = meta["categories"]
+        self.colors: List[str] = meta["colors"]
+        self._category_ids = {name: i for i, name in enumerate(self.categories)}
+        self._color_ids = {name: i for i, name in enumerate(self.colors)}
+
+        def load(name):
+            # Plain ndarray views of the mapping skip np.memmap's per-slice overhead
+            return np.asarray(np.load(path / name, mmap_mode="r"))
+
+        self._term_offsets = load("term_offsets.npy")
+        self._doc_ids = load("doc_ids.npy")
+        self._impacts = load("impacts.npy")
+        self._prices = load("prices.npy")
+        self._category_codes = load("categories.npy")
+        self._color_codes = load("colors.npy")
+        self._product_offsets = load("product_offsets.npy")
+        self._records_file = open(path / "products.jsonl", "rb")
+        self._records = (
+            mmap.mmap(self._records_file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b""
+        )
+        # Per-thread score accumulator, cleared after each query at the touched positions only
+        self._local = threading.local()
+
+    def _scores(self) -> np.ndarray:
+        scores = getattr(self._local, "scores", None)
+        if scores is None:
+            scores = self._local.scores = np.zeros(self.size, dtype=np.float32)
+        return scores
+
+    @classmethod
+    def open(cls, directory: str) -> "CatalogIndex":
+        return cls(directory)
+
+    def close(self) -> None:
+        if isinstance(self._records, mmap.mmap):
+            self._records.close()
+        self._records_file.close()
+
+    def product(self, doc: int) -> dict:
+        start, end = self._product_offsets[doc], self._product_offsets[doc + 1]
+        return json.loads(self._records[start:end])
+
+    def search(
+        self,
+        query: str,
+        k: int = 1,
+        category: Optional[str] = None,
+        color: Optional[str] = None,
+        price_band=None,
+    ) -> List[Tuple[dict, float]]:
+        """
+        Return up to `k` (product, BM25 score) pairs for `query`, best first.
+
+        `category` and `color` must match exactly (case-insensitive);
+        `price_band` is a name from PRICE_BANDS or a (low, high) tuple.
+        Only the `max_postings` best postings of each term are scored.
+        """
+        term_ids = {self._terms[t] for t in tokenize(query) if t in self._terms}
+        if not term_ids:
+            return []
+
+        scores = self._scores()
+        touched = []
+        for term_id in term_ids:
+            start = int(self._term_offsets[term_id])
+            end = min(int(self._term_offsets[term_id + 1]), start + self.max_postings)
+            docs = np.asarray(self._doc_ids[start:end])
+            # Each document appears at most once per posting list, so fancy-index addition is exact
+            scores[docs] += self._impacts[start:end]
+            touched.append(docs)
+        # A document matching several terms appears once per term; duplicates are
+        # dropped after ranking, which is cheaper than deduplicating every candidate
+        candidates = np.concatenate(touched) if len(touched) > 1 else touched[0]
+        try:
+            return self._rank(candidates, scores[candidates], k * len(touched), k, category, color, price_band)
+        finally:
+            scores[candidates] = 0
+
+    def _rank(self, candidates, candidate_scores, window, k, category, color, price_band) -> List[Tuple[dict, float]]:
+        keep = np.ones(len(candidates), dtype=bool)
+
+        if category is not None:
+            code = self._category_ids.get(category.lower())
+            if code is None:
+                return []
+            keep &= self._category_codes[candidates] == code
+        if color is not None:
+            code = self._color_ids.get(color.lower())
+            if code is None:
+                return []
+            keep &= self._color_codes[candidates] == code
+        if price_band is not None:
+            low, high = PRICE_BANDS[price_band] if isinstance(price_band, str) else price_band
+            prices = self._prices[candidates]
+            keep &= (prices >= low) & (prices <= high)
+        candidates, candidate_scores = candidates[keep], candidate_scores[keep]
+        if not len(candidates):
+            return []
+
+        if len(candidates) > window:
+            top = np.argpartition(-candidate_scores, window - 1)[:window]
+            candidates, candidate_scores = candidates[top], candidate_scores[top]
+        results, seen = [], set()
+        for i in np.argsort(-candidate_scores, kind="stable"):
+            doc = int(candidates[i])
+            if doc not in seen:
+                seen.add(doc)
+                results.append((self.product(doc), float(candidate_scores[i])))
+                if len(results) == k:
+                    break
+        return results
+
+    def _mentioned(self, tokens: List[str], names: List[str]) -> Optional[str]:
+        # Attribute values named in the item text, longest first so "light blue" beats "blue"
+        joined = " " + " ".join(tokens) + " "
+        for name in sorted(names, key=len, reverse=True):
+            if name and f" {' '.join(tokenize(name))} " in joined:
+                return name
+        return None
+
+    def match(self, name: str, description: str = "", price_text: str = "") -> Optional[dict]:
+        """
+        Find the best product for an item the model suggested.
+
+        Category and color filters are inferred from the item's own wording,
+        and a price range in its text narrows the price. Filters are dropped
+        one at a time when they leave nothing to match.
+        """
+        text = f"{name} {description}"
+        tokens = tokenize(text)
+        price_range = parse_price_range(f"{description} {price_text}")
+        filters = {
+            "category": self._mentioned(tokenize(name), self.categories),
+            "color": self._mentioned(tokens, self.colors),
+            # Model price estimates are rough; allow a quarter either side
+            "price_band": (price_range[0] * 0.75, price_range[1] * 1.25) if price_range else None,
+        }
+        # Price is the least reliable hint, then color, then category
+        for relax in ((), ("price_band",), ("price_band", "color"), ("price_band", "color", "category")):
+            active = {key: value for key, value in filters.items() if value is not None and key not in relax}
+            hits = self.search(text, k=1, **active)
+            if hits:
+                return hits[0][0]
+        return None
+
+    def match_items(self, items: List[dict]) -> List[dict]:
+        """
+        Replace the search URLs of suggested items with matched catalog products.
+        Items without a match are returned unchanged.
+        """
+        matched = []
+        for item in items:
+            product = self.match(item.get("name", ""), item.get("description", ""))
+            if product is None:
+                matched.append(item)
+                continue
+            matched.append({
+                "name": product["name"] or item.get("name", ""),
+                "description": item.get("description") or product["description"],
+                "imageUrl": product["imageUrl"],
+                "productUrl": product["productUrl"],
+            })
+        return matched
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Build a product catalog index from a CSV or JSONL feed.")
+    parser.add_argument("feed", help="Product feed (.csv or .jsonl)")
+    parser.add_argument("output", help="Index directory to write")
+    args = parser.parse_args(argv)
+    count = build_index(read_feed(args.feed), args.output)
+    print(f"Indexed {count} products into {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+Response compression negotiated from `Accept-Encoding`.
+
+Analysis payloads are a few KB of repetitive JSON and compress 2-3x. The
+middleware compresses complete responses (one body message) whose content
+type is text-like and whose body is at least `minimum_size` bytes; below
+that the saving is smaller than the headers and the CPU is wasted. Brotli is
+used when the `brotli` package is installed and the client prefers it, gzip
+otherwise. Streamed responses (server-sent events, NDJSON) pass through
+untouched so every event still reaches the client as soon as it is written.
+"""
+
+import gzip
+from typing import Dict, Optional, Sequence, Tuple
+
+from src.backend.metrics import COMPRESSION_BYTES
+
+try:  # Brotli support is optional
+    import brotli
+except ImportError:
+    brotli = None
+
+_COMPRESSIBLE_TYPES = ("application/json", "text/", "application/javascript", "image/svg+xml")
+
+
+def _gzip(body: bytes, level: int) -> bytes:
+    # mtime=0 keeps the output deterministic for identical bodies
+    return gzip.compress(body, compresslevel=level, mtime=0)
+
+
+def _brotli(body: bytes, level: int) -> bytes:
+    return brotli.compress(body, quality=level, mode=brotli.MODE_TEXT)
+
+
+# Encoding -> (compress function, default level); levels favour speed, as bodies are compressed per request
+COMPRESSORS = {"gzip": (_gzip, 6)}
+if brotli is not None:
+    COMPRESSORS["br"] = (_brotli, 4)
+
+
+def choose_encoding(accept_encoding: str, offered: Sequence[str]) -> Optional[str]:
+    """
+    Pick the content coding to use from an `Accept-Encoding` header.
+
+    The client's highest q-value wins; ties go to the first of `offered`.
+    Returns None when the client accepts none of them.
+    """
+    weights: Dict[str, float] = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[name] = q
+
+    best, best_q = None, 0.0
+    for name in offered:
+        q = weights.get(name, weights.get("*", 0.0))
+        if q > best_q:
+            best, best_q = name, q
+    return best
+
+
+def _compressible(content_type: bytes) -> bool:
+    return content_type.decode("latin-1").lower().startswith(_COMPRESSIBLE_TYPES)
+
+
+class CompressionMiddleware:
+    """
+    ASGI middleware compressing complete text-like responses.
+
+    Compressed responses get `Content-Encoding` and a corrected
+    `Content-Length`, and a strong `ETag` is weakened (the bytes differ from
+    the identity representation the tag was computed for). Every response
+    that could be compressed carries `Vary: Accept-Encoding`, so shared
+    caches keep the variants apart.
+    """
+
+    def __init__(self, app, minimum_size: int = 512, encodings: Sequence[str] = ("br", "gzip")):
+        self.app = app
+        self.minimum_size = minimum_size
+        # Only the codings this process can produce, in server preference order
+        self.encodings = tuple(name for name in encodings if name in COMPRESSORS)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.encodings:
+            await self.app(scope, receive, send)
+            return
+
+        accept_encoding = dict(scope["headers"]).get(b"accept-encoding", b"").decode("latin-1")
+        encoding = choose_encoding(accept_encoding, self.encodings) if accept_encoding else None
+        start = None
+        passthrough = False
+
+        async def compressing_send(message):
+            nonlocal start, passthrough
+            if passthrough:
+                await send(message)
+                return
+            if message["type"] == "http.response.start":
+                # Held back until the body shows whether it can be compressed
+                start = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            passthrough = True
+            if message.get("more_body", False):
+                # Streamed: send as is
+                await send(start)
+                await send(message)
+                return
+
+            headers, body = self._encode(start, message.get("body", b""), encoding)
+            await send({**start, "headers": headers})
+            await send({**message, "body": body})
+
+        await self.app(scope, receive, compressing_send)
+
+    def _encode(self, start: dict, body: bytes, encoding: Optional[str]) -> Tuple[list, bytes]:
+        headers = list(start.get("headers", []))
+        names = {key.lower(): value for key, value in headers}
+        if (len(body) < self.minimum_size or start["status"] in (204, 206, 304)
+                or b"content-encoding" in names or not _compressible(names.get(b"content-type", b""))):
+            return headers, body
+
+        vary = names.get(b"vary")
+        if vary is None:
+            headers.append((b"vary", b"Accept-Encoding"))
+        elif b"accept-encoding" not in vary.lower() and vary != b"*":
+            headers = [(k, v + b", Accept-Encoding" if k.lower() == b"vary" else v) for k, v in headers]
+        if encoding is None:
+            return headers, body
+
+        compress, level = COMPRESSORS[encoding]
+        compressed = compress(body, level)
+        if len(compressed) >= len(body):
+            return headers, body
+        COMPRESSION_BYTES.labels(encoding, "original").inc(len(body))
+        COMPRESSION_BYTES.labels(encoding, "sent").inc(len(compressed))
+
+        encoded = []
+        for key, value in headers:
+            lower = key.lower()
+            if lower == b"content-length":
+                value = str(len(compressed)).encode("latin-1")
+            elif lower == b"etag" and not value.startswith(b"W/"):
+                value = b"W/" + value
+            encoded.append((key, value))
+        encoded.append((b"content-encoding", encoding.encode("latin-1")))
+        return encoded, compressed
@@ -0,0 +1,299 @@
+"""
+Asynchronous analysis jobs backed by a SQLite queue.
+
+`POST /api/jobs` stores the upload as a queued job and answers right away;
+a pool of worker tasks claims queued jobs, analyzes them and writes the
+result (or error) back to the same row. Clients poll the job or subscribe to
+its events, and a client that reconnects later reads the stored result
+instead of paying for the analysis again.
+
+The queue lives in one SQLite file, so jobs survive restarts and several
+server processes can share it: a job is claimed inside an IMMEDIATE
+transaction, so exactly one worker gets it. Jobs left running for longer
+than `stale_after` (by a process that died) are queued again. Each claim is
+numbered by the job's attempt count, and only the latest claim may finish
+the job: a worker that was merely slow, not dead, has its late result
+discarded instead of overwriting the retry's.
+"""
+
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class JobStore:
+    """
+    Jobs table in a SQLite file, opened on first use.
+
+    The image is kept only until its job finishes; the result is kept until
+    the job is purged.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            # Autocommit, so transactions are only the ones opened explicitly
+            db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, status TEXT NOT NULL, content_type TEXT NOT NULL, image BLOB, "
+                "result TEXT, error TEXT, attempts INTEGER NOT NULL DEFAULT 0, "
+                "created_at REAL NOT NULL, started_at REAL, finished_at REAL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, created_at)")
+            self._db = db
+        return self._db
+
+    def submit(self, content: bytes, content_type: str) -> str:
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._connect().execute(
+                "INSERT INTO jobs (id, status, content_type, image, created_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, QUEUED, content_type, content, time.time()),
+            )
+        return job_id
+
+    def claim(self) -> Optional[Tuple[str, bytes, str, int]]:
+        """
+        Mark the oldest queued job as running and return (id, image, content
+        type, attempt); the attempt number is the claim's token for `finish`.
+        """
+        with self._lock:
+            db = self._connect()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute(
+                    "SELECT id, image, content_type, attempts FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1",
+                    (QUEUED,),
+                ).fetchone()
+                if row is not None:
+                    db.execute(
+                        "UPDATE jobs SET status = ?, started_at = ?, attempts = attempts + 1 WHERE id = ?",
+                        (RUNNING, time.time(), row[0]),
+                    )
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        return row[0], row[1], row[2], row[3] + 1
+
+    def finish(self, job_id: str, attempt: int, result: Optional[dict] = None, error: Optional[dict] = None) -> bool:
+        """
+        Record the outcome of claim `attempt`. Returns False, leaving the job
+        alone, when that claim is no longer current: the job was queued again
+        as stale and claimed anew, or failed after too many attempts.
+        """
+        with self._lock:
+            return self._connect().execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, image = NULL, finished_at = ? "
+                "WHERE id = ? AND status = ? AND attempts = ?",
+                (
+                    FAILED if error is not None else DONE,
+                    json.dumps(result) if result is not None else None,
+                    json.dumps(error) if error is not None else None,
+                    time.time(),
+                    job_id,
+                    RUNNING,
+                    attempt,
+                ),
+            ).rowcount == 1
+
+    def get(self, job_id: str) -> Optional[dict]:
+        """
+        Return the job as served by the API, or None if it does not exist.
+        """
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT id, status, result, error, attempts, created_at, started_at, finished_at FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        job = {
+            "jobId": row[0],
+            "status": row[1],
+            "attempts": row[4],
+            "createdAt": row[5],
+            "startedAt": row[6],
+            "finishedAt": row[7],
+        }
+        if row[2] is not None:
+            job["result"] = json.loads(row[2])
+        if row[3] is not None:
+            job["error"] = json.loads(row[3])
+        return job
+
+    def recover(self, stale_after: float, max_attempts: int) -> int:
+        """
+        Queue again jobs that have been running for longer than `stale_after`
+        seconds, failing those that already used `max_attempts`.
+        """
+        cutoff = time.time() - stale_after
+        with self._lock:
+            db = self._connect()
+            db.execute(
+                "UPDATE jobs SET status = ?, image = NULL, finished_at = ?, error = ? "
+                "WHERE status = ? AND started_at < ? AND attempts >= ?",
+                (FAILED, time.time(), json.dumps({"status": 500, "detail": "Analysis was interrupted"}),
+                 RUNNING, cutoff, max_attempts),
+            )
+            return db.execute(
+                "UPDATE jobs SET status = ? WHERE status = ? AND started_at < ?",
+                (QUEUED, RUNNING, cutoff),
+            ).rowcount
+
+    def purge(self, older_than: float) -> int:
+        """
+        Delete finished jobs older than `older_than` seconds.
+        """
+        with self._lock:
+            return self._connect().execute(
+                "DELETE FROM jobs WHERE status IN (?, ?) AND finished_at < ?",
+                (DONE, FAILED, time.time() - older_than),
+            ).rowcount
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+def describe_error(error: Exception) -> dict:
+    """
+    Turn a failed analysis into the `error` payload of a job.
+    """
+    detail = getattr(error, "detail", None) or str(error) or type(error).__name__
+    return {"status": getattr(error, "status_code", 500), "detail": detail}
+
+
+AnalyzeFn = Callable[[bytes, str], Awaitable[dict]]
+
+
+class JobQueue:
+    """
+    Worker tasks draining a JobStore, plus in-process change notifications.
+
+    Workers are woken immediately by jobs submitted to this process and poll
+    every `poll_interval` seconds for jobs submitted by other processes.
+    """
+
+    def __init__(self, store: JobStore, analyze: AnalyzeFn, workers: int = 4, poll_interval: float = 1.0,
+                 stale_after: float = 600.0, max_attempts: int = 3, retention: float = 7 * 86400.0):
+        self.store = store
+        self.analyze = analyze
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.max_attempts = max_attempts
+        self.retention = retention
+        self._tasks = []
+        self._recovered_at = 0.0
+        self._wakeup: Optional[asyncio.Event] = None
+        # job ID -> event set on its next status change, and how many wait() calls hold it
+        self._changes: Dict[str, asyncio.Event] = {}
+        self._waiters: Dict[str, int] = {}
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+
+    async def start(self) -> None:
+        if self._tasks:
+            return
+        await self._recover()
+        if self.retention > 0:
+            await asyncio.to_thread(self.store.purge, self.retention)
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(max(1, self.workers))]
+
+    async def stop(self) -> None:
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Jobs cancelled mid-analysis stay running and are recovered on the next start
+
+    async def submit(self, content: bytes, content_type: str) -> str:
+        job_id = await asyncio.to_thread(self.store.submit, content, content_type)
+        self.submitted += 1
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job_id
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        return await asyncio.to_thread(self.store.get, job_id)
+
+    async def wait(self, job_id: str, timeout: float) -> None:
+        """
+        Return when the job changes status in this process, or after `timeout` seconds.
+        """
+        event = self._changes.setdefault(job_id, asyncio.Event())
+        self._waiters[job_id] = self._waiters.get(job_id, 0) + 1
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            # The last waiter drops the entry, so jobs finished elsewhere (or never) leave nothing behind
+            self._waiters[job_id] -= 1
+            if not self._waiters[job_id]:
+                del self._waiters[job_id]
+                self._changes.pop(job_id, None)
+
+    async def _recover(self) -> None:
+        self._recovered_at = time.monotonic()
+        recovered = await asyncio.to_thread(self.store.recover, self.stale_after, self.max_attempts)
+        if recovered:
+            logger.info("Queued %d interrupted analysis jobs again", recovered)
+
+    def _notify(self, job_id: str) -> None:
+        event = self._changes.pop(job_id, None)
+        if event is not None:
+            event.set()
+
+    async def _work(self) -> None:
+        while True:
+            claimed = await asyncio.to_thread(self.store.claim)
+            if claimed is None:
+                if time.monotonic() - self._recovered_at > min(60.0, self.stale_after):
+                    await self._recover()
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            job_id, content, content_type, attempt = claimed
+            self._notify(job_id)
+            result = error = None
+            try:
+                result = await self.analyze(content, content_type)
+            except Exception as e:
+                error = describe_error(e)
+            if not await asyncio.to_thread(self.store.finish, job_id, attempt, result, error):
+                logger.warning("Discarded the result of job %s attempt %d, which was claimed again", job_id, attempt)
+            elif error is None:
+                self.completed += 1
+            else:
+                self.failed += 1
+            self._notify(job_id)
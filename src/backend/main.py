@@ -1,11 +1,61 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import APIRouter, FastAPI, UploadFile, File, Form, Header, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
-from openai import AzureOpenAI
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 import os
-import base64
+import asyncio
 from dotenv import load_dotenv
-import sys
 import json
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import lru_cache, partial
+from typing import List, Optional
+
+from src.backend.batch import (
+    BatchInputError,
+    BatchJobStore,
+    dedupe_paths,
+    dedupe_uploads,
+    parse_manifest,
+    run_batch,
+)
+from src.backend.cache import ResultCache, image_digest, make_cache_key
+from src.backend.catalog import CatalogIndex
+from src.backend.compression import CompressionMiddleware
+from src.backend.encoding import AnalysisJSONResponse, body_etag, encode_analysis, etag_matches
+from src.backend.jobs import DONE, FAILED, JobQueue, JobStore
+from src.backend.vectors import VectorIndex, item_text, make_embedder
+from src.backend.metrics import ERRORS, REGISTRY, MetricsMiddleware, observe_stage, stage
+from src.backend.parsing import StreamingAnalysisParser, parse_model_output, result_events
+from src.backend.phash import NearDuplicateIndex
+from src.backend.providers import (
+    AzureOpenAIBackend,
+    BackendRouter,
+    Completion,
+    GeminiBackend,
+    VisionRequest,
+)
+from src.backend.prompts import DEFAULT_TEMPLATES, MULTI_IMAGE_PREAMBLE, TEMPLATES, MaxTokensTuner, get_template
+from src.backend.preprocess import PreparedImage, prepare_image, sample_jpeg, server_timing
+from src.backend.scheduler import AnalysisScheduler, SchedulerOverloaded, SchedulerTimeout
+from src.backend.schemas import AnalysisResponse, response_format
+from src.backend.singleflight import SingleFlight
+from src.backend.uploads import BodySizeLimitMiddleware
+from src.backend.usage import UsageLedger, request_cost
+from src.backend.upstream import (
+    CircuitBreaker,
+    UpstreamClient,
+    UpstreamRateLimited,
+    UpstreamUnavailable,
+    PROMPT_TOKEN_ALLOWANCE,
+    choose_detail,
+    choose_detail_levels,
+    estimate_image_tokens,
+    estimate_request_tokens,
+    pool_stats,
+    pooled_http_client,
+)
 
 # Load environment variables from .env file
 load_dotenv()
@@ -15,198 +65,1134 @@ api_key = os.getenv("AZURE_OPENAI_API_KEY")
 endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
 deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT", "GPT4-Vision")
 api_version = os.getenv("AZURE_OPENAI_API_VERSION", "2024-12-01-preview")
-max_tokens = 1000
+# Most tokens an analysis may use; with ADAPTIVE_MAX_TOKENS, calls reserve only what answers actually need
+max_tokens = int(os.getenv("ANALYSIS_MAX_TOKENS", "1000"))
+adaptive_max_tokens = os.getenv("ADAPTIVE_MAX_TOKENS", "true").lower() == "true"
+# "markdown" keeps the '###' section format every deployment supports; "json_schema" asks for
+# structured JSON, which needs a model and API version with structured-output support
+output_mode = os.getenv("ANALYSIS_OUTPUT_MODE", "markdown")
+prompt_template = get_template(os.getenv("ANALYSIS_PROMPT_TEMPLATE", DEFAULT_TEMPLATES.get(output_mode, "markdown-v1")))
+# Images no larger than this on their long edge are sent at low detail (0 = always high)
+image_low_detail_max_edge = int(os.getenv("IMAGE_LOW_DETAIL_MAX_EDGE", "512"))
+# Part of every cache key, so results from another prompt or detail rule are not reused
+PROMPT_VERSION = f"{prompt_template.key}-d{image_low_detail_max_edge}"
+
+# Per-request usage accounting: SQLite file (empty disables) and prices per 1K tokens
+usage_db_path = os.getenv("USAGE_DB_PATH", "usage.sqlite3")
+prompt_token_price = float(os.getenv("PROMPT_TOKEN_PRICE_PER_1K", "0"))
+completion_token_price = float(os.getenv("COMPLETION_TOKEN_PRICE_PER_1K", "0"))
+
+# Concurrency limits for upstream analysis calls
+max_in_flight = int(os.getenv("ANALYZE_MAX_IN_FLIGHT", "32"))
+max_queue = int(os.getenv("ANALYZE_MAX_QUEUE", "256"))
+analyze_timeout = float(os.getenv("ANALYZE_TIMEOUT_SECONDS", "60"))
+
+# Result cache settings
+cache_size = int(os.getenv("ANALYSIS_CACHE_SIZE", "1024"))
+cache_ttl = float(os.getenv("ANALYSIS_CACHE_TTL_SECONDS", "86400"))
+cache_path = os.getenv("ANALYSIS_CACHE_PATH")
+# Maximum perceptual-hash Hamming distance treated as the same photo (negative disables)
+near_duplicate_distance = int(os.getenv("NEAR_DUPLICATE_MAX_DISTANCE", "6"))
+
+# Image preprocessing settings
+image_max_edge = int(os.getenv("IMAGE_MAX_EDGE", "2048"))
+image_max_short_edge = int(os.getenv("IMAGE_MAX_SHORT_EDGE", "768"))
+image_quality = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+preprocess_workers = int(os.getenv("IMAGE_PREPROCESS_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Request body limits in bytes (0 disables); larger uploads are rejected with 413
+max_upload_bytes = int(os.getenv("MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+batch_max_upload_bytes = int(os.getenv("BATCH_MAX_UPLOAD_BYTES", str(512 * 1024 * 1024)))
+# Photos of one outfit analyzed together, and the image tokens their detail levels must fit (0 = always high)
+multi_image_max_images = int(os.getenv("MULTI_IMAGE_MAX_IMAGES", "4"))
+multi_image_token_budget = int(os.getenv("MULTI_IMAGE_TOKEN_BUDGET", "2500"))
+# Response compression: smallest body worth compressing, and the codings offered in order of preference
+compression_min_bytes = int(os.getenv("COMPRESSION_MIN_BYTES", "512"))
+compression_encodings = [name.strip() for name in os.getenv("COMPRESSION_ENCODINGS", "br,gzip").split(",") if name.strip()]
+
+# Upstream quota and failure handling (0 disables the corresponding budget)
+upstream_rpm = float(os.getenv("AZURE_OPENAI_RPM", "0"))
+upstream_tpm = float(os.getenv("AZURE_OPENAI_TPM", "0"))
+upstream_max_retries = int(os.getenv("UPSTREAM_MAX_RETRIES", "3"))
+breaker_failures = int(os.getenv("CIRCUIT_BREAKER_FAILURES", "5"))
+breaker_reset = float(os.getenv("CIRCUIT_BREAKER_RESET_SECONDS", "30"))
+
+# HTTP connection pool per Azure backend ("auto" uses HTTP/2 when the h2 package is installed).
+# One HTTP/1.1 connection per concurrent call, with room for hedged requests
+upstream_max_connections = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", str(max(2 * max_in_flight, 16))))
+upstream_max_keepalive = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", str(upstream_max_connections)))
+upstream_keepalive_expiry = float(os.getenv("UPSTREAM_KEEPALIVE_SECONDS", "30"))
+upstream_connect_timeout = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT_SECONDS", "5"))
+upstream_read_timeout = float(os.getenv("UPSTREAM_READ_TIMEOUT_SECONDS", str(analyze_timeout)))
+upstream_pool_timeout = float(os.getenv("UPSTREAM_POOL_TIMEOUT_SECONDS", "10"))
+upstream_http2 = os.getenv("UPSTREAM_HTTP2", "auto").lower()
+
+# Extra vision backends (JSON list, or a path to a JSON file) and how requests are spread across them
+vision_backends = os.getenv("VISION_BACKENDS", "")
+routing_strategy = os.getenv("ROUTING_STRATEGY", "least_outstanding")
+hedge_requests = os.getenv("HEDGE_REQUESTS", "true").lower() == "true"
+hedge_quantile = float(os.getenv("HEDGE_QUANTILE", "0.95"))
+
+# Batch analysis settings
+batch_concurrency = int(os.getenv("BATCH_CONCURRENCY", "8"))
+batch_jobs_dir = os.getenv("BATCH_JOBS_DIR", "batch_jobs")
+batch_manifest_root = os.getenv("BATCH_MANIFEST_ROOT")
+
+# Asynchronous jobs (POST /api/jobs): SQLite queue file and worker tasks per process
+jobs_db_path = os.getenv("JOBS_DB_PATH", "jobs.sqlite3")
+job_workers = int(os.getenv("JOB_WORKERS", "8"))
+job_retention = float(os.getenv("JOB_RETENTION_SECONDS", str(7 * 86400)))
+# A job running longer than this is presumed dead and queued again, so an attempt stops
+# backing off early enough for its last analysis to finish before then
+job_stale_after = max(analyze_timeout * 5, 60)
+job_max_wait = job_stale_after - 2 * analyze_timeout
+
+# Product catalog index built with `python -m src.backend.catalog`; unset keeps search URLs
+catalog_index_path = os.getenv("CATALOG_INDEX_PATH")
+# IVF partitions scanned per query when the catalog has an embedding index
+catalog_n_probe = int(os.getenv("CATALOG_NPROBE", "8"))
+
+# Log a per-request trace (ID plus stage spans) as one JSON line
+tracing_enabled = os.getenv("TRACING_ENABLED", "false").lower() == "true"
 
-if not all([api_key, endpoint, deployment]):
-    print("Error: Azure OpenAI configuration not found in environment variables!")
-    print("Please make sure you have created a .env file in the project root with your Azure OpenAI configuration:")
-    print("AZURE_OPENAI_API_KEY=your_api_key_here")
-    print("AZURE_OPENAI_ENDPOINT=your_endpoint_here")
-    print("AZURE_OPENAI_DEPLOYMENT=your_deployment_here")
-    print("AZURE_OPENAI_API_VERSION=2024-12-01-preview (optional)")
-    sys.exit(1)
+# Readiness: how often /readyz re-checks that the model endpoints answer, and how long it waits
+ready_check_interval = float(os.getenv("READY_CHECK_INTERVAL_SECONDS", "10"))
+upstream_probe_timeout = float(os.getenv("UPSTREAM_PROBE_TIMEOUT_SECONDS", "5"))
 
-# Initialize Azure OpenAI client
-client = AzureOpenAI(
-    api_key=api_key,
-    api_version=api_version,
-    azure_endpoint=endpoint,
+CONFIG_HELP = """Azure OpenAI configuration not found in environment variables!
+Please make sure you have created a .env file in the project root with your Azure OpenAI configuration:
+AZURE_OPENAI_API_KEY=your_api_key_here
+AZURE_OPENAI_ENDPOINT=your_endpoint_here
+AZURE_OPENAI_DEPLOYMENT=your_deployment_here
+AZURE_OPENAI_API_VERSION=2024-12-01-preview (optional)"""
+
+def check_config() -> None:
+    """
+    Fail with setup instructions when the Azure OpenAI settings are missing.
+
+    Checked when the app starts or the client is first needed rather than at
+    import, so tooling can import this module without credentials.
+    """
+    if not all([api_key, endpoint, deployment]):
+        raise RuntimeError(CONFIG_HELP)
+
+# Backend name -> the HTTP client holding its connection pool
+http_pools = {}
+
+def new_azure_client(name: str, key: str, version: str, azure_endpoint: str):
+    # The SDK is imported on first use; it accounts for about half of the import time of this module
+    from openai import AsyncAzureOpenAI
+
+    http_pools[name] = pooled_http_client(
+        max_connections=upstream_max_connections,
+        max_keepalive_connections=upstream_max_keepalive,
+        keepalive_expiry=upstream_keepalive_expiry,
+        connect_timeout=upstream_connect_timeout,
+        read_timeout=upstream_read_timeout,
+        pool_timeout=upstream_pool_timeout,
+        http2=None if upstream_http2 == "auto" else upstream_http2 == "true",
+    )
+    return AsyncAzureOpenAI(
+        api_key=key,
+        api_version=version,
+        azure_endpoint=azure_endpoint,
+        max_retries=0,  # retries are handled by the upstream layer
+        http_client=http_pools[name],
+    )
+
+@lru_cache(maxsize=None)
+def get_client():
+    """
+    Return the primary Azure OpenAI client, creating it on first use.
+    """
+    check_config()
+    return new_azure_client("primary", api_key, api_version, endpoint)
+
+def __getattr__(name: str):
+    # `main.client` still names the primary client, for callers and tests that patch it
+    if name == "client":
+        return get_client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# Backend name -> factory of its Azure OpenAI client, for connection warm-up and readiness probes
+upstream_clients = {"primary": get_client}
+
+# Keeps calls within the deployment's RPM/TPM quota, retries transient
+# failures and trips a circuit breaker when the upstream keeps failing
+upstream = UpstreamClient(
+    lambda **kwargs: get_client().chat.completions.create(**kwargs),
+    requests_per_minute=upstream_rpm,
+    tokens_per_minute=upstream_tpm,
+    max_retries=upstream_max_retries,
+    breaker=CircuitBreaker(failure_threshold=breaker_failures, reset_timeout=breaker_reset),
+    default_timeout=analyze_timeout,
 )
 
-app = FastAPI(
-    title="Style-Finder API",
-    description="API for analyzing fashion outfits from images.",
-    version="0.1.0",
+def build_backends() -> list:
+    """
+    Create the primary Azure backend plus any configured in VISION_BACKENDS.
+
+    Each entry is an object with a "type" of "azure" (endpoint, deployment,
+    apiKey or apiKeyEnv, apiVersion, rpm, tpm) or "gemini" (model, apiKey or
+    apiKeyEnv) and an optional "name".
+    """
+    backends = [AzureOpenAIBackend("primary", upstream, deployment)]
+    if not vision_backends.strip():
+        return backends
+
+    if vision_backends.lstrip().startswith("["):
+        specs = json.loads(vision_backends)
+    else:
+        with open(vision_backends) as f:
+            specs = json.load(f)
+
+    for i, spec in enumerate(specs, 1):
+        kind = spec.get("type", "azure")
+        name = spec.get("name", f"{kind}-{i}")
+        key = spec.get("apiKey") or os.getenv(spec.get("apiKeyEnv", ""), "")
+        if kind == "azure":
+            backend_client = lru_cache(maxsize=None)(
+                partial(new_azure_client, name, key, spec.get("apiVersion", api_version), spec["endpoint"])
+            )
+            upstream_clients[name] = backend_client
+            backend_upstream = UpstreamClient(
+                lambda backend_client=backend_client, **kwargs: backend_client().chat.completions.create(**kwargs),
+                requests_per_minute=spec.get("rpm", 0),
+                tokens_per_minute=spec.get("tpm", 0),
+                max_retries=upstream_max_retries,
+                breaker=CircuitBreaker(failure_threshold=breaker_failures, reset_timeout=breaker_reset),
+                default_timeout=analyze_timeout,
+            )
+            backends.append(AzureOpenAIBackend(name, backend_upstream, spec.get("deployment", deployment)))
+        elif kind == "gemini":
+            backends.append(GeminiBackend(name, spec.get("model", "gemini-1.5-flash"), key))
+        else:
+            raise ValueError(f"Unknown vision backend type: {kind}")
+    return backends
+
+# Spreads requests across backends, skipping unhealthy ones and hedging slow calls
+router = BackendRouter(
+    build_backends(),
+    strategy=routing_strategy,
+    hedge=hedge_requests,
+    hedge_quantile=hedge_quantile,
 )
 
-# --- CORS Middleware ---
-# This allows the frontend (running on a different port) to communicate with the backend.
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # Allows all origins
-    allow_credentials=True,
-    allow_methods=["*"],  # Allows all methods
-    allow_headers=["*"],  # Allows all headers
+# Bounds how many analyses may hit the upstream at once, per worker
+scheduler = AnalysisScheduler(
+    max_in_flight=max_in_flight,
+    max_queue=max_queue,
+    timeout=analyze_timeout,
 )
 
-def analyze_image_with_gpt4v(image_content: bytes) -> dict:
+# Identical uploads are served from here instead of paying for another GPT-4V call
+result_cache = ResultCache(
+    max_entries=cache_size,
+    ttl=cache_ttl or None,
+    path=cache_path or None,
+)
+
+# Concurrent uploads of the same image share one upstream call
+analysis_flights = SingleFlight()
+
+# Recompressed, resized or screenshotted copies of a cached photo reuse its result
+near_duplicates = NearDuplicateIndex(max_distance=max(near_duplicate_distance, 0))
+
+# Real products for suggested items, memory-mapped from a prebuilt index
+catalog = CatalogIndex.open(catalog_index_path) if catalog_index_path else None
+
+# Embedding retrieval replaces keyword matching when the catalog has an embedding index
+catalog_vectors = None
+catalog_embedder = None
+if catalog_index_path and VectorIndex.exists(catalog_index_path):
+    catalog_vectors = VectorIndex.open(catalog_index_path, n_probe=catalog_n_probe)
+    catalog_embedder = make_embedder(catalog_vectors.embedder, lambda **kwargs: get_client().embeddings.create(**kwargs))
+
+# Persisted progress of batch jobs, so interrupted jobs can resume
+batch_store = BatchJobStore(batch_jobs_dir)
+
+# Analysis jobs submitted to /api/jobs; workers are started with the app
+job_queue = JobQueue(
+    JobStore(jobs_db_path),
+    lambda content, content_type: analyze_job(content, content_type),
+    workers=job_workers,
+    stale_after=job_stale_after,
+    retention=job_retention,
+)
+
+# Image decoding and re-encoding is CPU-bound, so it runs here rather than on the event loop
+preprocess_executor = ThreadPoolExecutor(max_workers=preprocess_workers, thread_name_prefix="preprocess")
+
+# Reject oversized uploads before their bodies are read into the form parser
+upload_limits = {
+    "/api/analyze": max_upload_bytes,
+    "/api/analyze/stream": max_upload_bytes,
+    "/api/analyze/multi": max_upload_bytes * multi_image_max_images,
+    "/api/analyze/batch": batch_max_upload_bytes,
+    "/api/jobs": max_upload_bytes,
+}
+
+# Endpoints, mounted on the application built by create_app()
+api = APIRouter()
+
+# Export state the components already track; read only when /metrics is scraped
+REGISTRY.callback(
+    "stylefinder_scheduler_requests", "Analyses holding or waiting for an upstream slot",
+    lambda: [(("in_flight",), scheduler.in_flight), (("queued",), scheduler.queued)], ("state",),
+)
+REGISTRY.callback(
+    "stylefinder_scheduler_rejected_total", "Analyses rejected or timed out by the scheduler",
+    lambda: [(("overloaded",), scheduler.rejected), (("timeout",), scheduler.timed_out)], ("reason",), type="counter",
+)
+REGISTRY.callback(
+    "stylefinder_cache_lookups_total", "Result cache lookups by outcome",
+    lambda: [(("hit",), result_cache.hits), (("miss",), result_cache.misses), (("disk_hit",), result_cache.disk_hits),
+             (("near_duplicate_hit",), near_duplicates.hits)],
+    ("result",), type="counter",
+)
+REGISTRY.callback(
+    "stylefinder_coalesced_requests_total", "Analyses that waited for an identical in-flight upstream call",
+    lambda: [((), analysis_flights.coalesced)], type="counter",
+)
+REGISTRY.callback(
+    "stylefinder_jobs_total", "Analysis jobs handled by this process's workers",
+    lambda: [(("submitted",), job_queue.submitted), (("done",), job_queue.completed), (("failed",), job_queue.failed)],
+    ("outcome",), type="counter",
+)
+def pool_samples(field: str) -> list:
+    samples = []
+    for name, http_client in list(http_pools.items()):
+        stats = pool_stats(http_client)
+        if stats is not None:
+            samples.append(((name,), stats[field]))
+    return samples
+
+REGISTRY.callback(
+    "stylefinder_upstream_pool_connections", "Open connections in each backend's HTTP pool",
+    lambda: pool_samples("connections"), ("backend",),
+)
+REGISTRY.callback(
+    "stylefinder_upstream_pool_active_connections", "Pooled connections currently serving a request",
+    lambda: pool_samples("active"), ("backend",),
+)
+REGISTRY.callback(
+    "stylefinder_upstream_pool_waiting_requests", "Requests waiting for a pooled connection",
+    lambda: pool_samples("waiting"), ("backend",),
+)
+REGISTRY.callback(
+    "stylefinder_cache_entries", "Entries held in the in-memory result cache",
+    lambda: [((), result_cache.stats()["entries"])],
+)
+
+async def preprocess_image(image_content: bytes, content_type: str):
+    """
+    Downscale and re-encode an upload in the preprocessing thread pool.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        preprocess_executor,
+        partial(
+            prepare_image,
+            image_content,
+            content_type,
+            max_edge=image_max_edge,
+            max_short_edge=image_max_short_edge,
+            quality=image_quality,
+            fingerprint=near_duplicate_distance >= 0,
+        ),
+    )
+
+# The streaming endpoint parses '###' sections as they arrive, so it always uses the markdown prompt
+STREAM_TEMPLATE = TEMPLATES["markdown-v1"]
+# Cache key part for streamed results, which come from STREAM_TEMPLATE whatever the configured prompt
+STREAM_PROMPT_VERSION = f"{STREAM_TEMPLATE.key}-d{image_low_detail_max_edge}"
+
+# Precomputed once; sent with every structured-output request
+RESPONSE_FORMAT = response_format()
+
+# max_tokens per prompt template, sized from the completion lengths observed
+max_tokens_tuner = MaxTokensTuner(ceiling=max_tokens, enabled=adaptive_max_tokens)
+usage_ledger = UsageLedger(usage_db_path)
+
+async def analyze_image_with_gpt4v(image_content: bytes, mime_type: str = "image/jpeg", image_size: tuple = (None, None)) -> dict:
     """
     Send the image to GPT-4V for analysis and get fashion insights.
     """
+    return await analyze_images_with_gpt4v([(image_content, mime_type)], [image_size])
+
+async def analyze_images_with_gpt4v(images: list, image_sizes: list, details: list = None) -> dict:
+    """
+    Send one or more photos of an outfit to GPT-4V in a single request and get one analysis.
+
+    `images` holds (bytes, mime type) pairs and `image_sizes` their (width,
+    height). `details` gives each image's detail level ("low" or "high"); by
+    default it is chosen from the image's size.
+    """
     try:
-        # Convert image to base64
-        base64_image = base64.b64encode(image_content).decode('utf-8')
-        
-        # Prepare the messages with a more structured prompt
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": """Analyze this outfit and provide a structured response with the following:
-1. Description: Overall style and vibe
-2. Color Tones: Main colors and their combinations
-3. Core Apparel: Main clothing pieces
-4. Accessories: Any accessories or additional items
-5. Fashion Tips: Styling suggestions and recommendations
-6. Similar Items: Suggest 3 similar items that could be found on Nordstrom, including name, brief description, and estimated price range"""
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}"
-                        }
-                    }
-                ]
-            }
-        ]
-        
-        # Make the API call with the required parameters
-        response = client.chat.completions.create(
-            model=deployment,  # Use the deployment name as the model
-            messages=messages,
-            max_tokens=max_tokens,
-            temperature=0.7
+        template = prompt_template
+        prompt = template.text
+        if len(images) > 1:
+            prompt = MULTI_IMAGE_PREAMBLE.format(count=len(images)) + prompt
+        if details is None:
+            details = [choose_detail(width, height, image_low_detail_max_edge) for width, height in image_sizes]
+        image_tokens = sum(
+            estimate_image_tokens(width, height, detail) for (width, height), detail in zip(image_sizes, details)
         )
-        
-        # Extract the raw response
-        result = response.choices[0].message.content
-        
-        # Initialize the response structure
-        analysis = {
-            'description': '',
-            'colorTones': '',
-            'coreApparel': '',
-            'accessories': ''
-        }
-        fashion_tips = []
-        suggested_items = []
-        
-        # Split into sections by markdown headers
-        sections = result.split('###')
-        
-        for section in sections:
-            if not section.strip():
-                continue
-                
-            # Clean up the section
-            section = section.strip()
-            
-            # Extract the section title and content
-            lines = section.split('\n')
-            title = lines[0].strip().lower()
-            content = '\n'.join(lines[1:]).strip()
-            
-            # Remove any remaining markdown formatting
-            content = content.replace('*', '').replace('---', '').strip()
-            
-            # Parse each section based on its title
-            if 'description' in title or '1.' in title:
-                analysis['description'] = content
-            elif 'color' in title or '2.' in title:
-                analysis['colorTones'] = content
-            elif 'core' in title or 'apparel' in title or '3.' in title:
-                analysis['coreApparel'] = content
-            elif 'accessories' in title or '4.' in title:
-                analysis['accessories'] = content
-            elif 'fashion tips' in title or '5.' in title:
-                # Split tips into a list
-                tips = [tip.strip('- ').strip() for tip in content.split('\n') if tip.strip().startswith('-')]
-                fashion_tips = tips
-            elif 'similar items' in title or '6.' in title:
-                # Parse suggested items
-                items = []
-                current_item = {}
-                
-                for line in content.split('\n'):
-                    line = line.strip()
-                    if not line:
-                        continue
-                        
-                    if line.startswith('1.') or line.startswith('2.') or line.startswith('3.'):
-                        if current_item:
-                            items.append(current_item)
-                        # Extract name more safely
-                        name = line.split('.')[1].strip()  # Remove the number
-                        if '**' in name:
-                            name = name.split('**')[1].strip()  # Extract from bold if present
-                        else:
-                            name = name.strip()  # Just clean up whitespace
-                            
-                        current_item = {
-                            'name': name,
-                            'description': '',
-                            'imageUrl': f"https://www.nordstrom.com/s/{name.lower().replace(' ', '-')}",
-                            'productUrl': f"https://www.nordstrom.com/s/{name.lower().replace(' ', '-')}"
-                        }
-                    elif line.startswith('-'):
-                        line = line.strip('- ').strip()
-                        if 'Price Range' in line or 'Estimated Price' in line or 'price range' in line.lower():
-                            continue
-                        if 'Description:' in line:
-                            current_item['description'] = line.split('Description:')[1].strip()
-                        else:
-                            current_item['description'] = line
-                
-                if current_item:
-                    items.append(current_item)
-                suggested_items = items
-        
-        # Create the final response
-        response_data = {
-            'analysis': analysis,
-            'fashionTips': fashion_tips,
-            'suggestedItems': suggested_items
-        }
-        
-        return response_data
-        
+        request = VisionRequest(
+            prompt=prompt,
+            images=images,
+            max_tokens=max_tokens_tuner.max_tokens(template.key),
+            temperature=0.7,
+            # Ask for schema-conforming JSON when enabled
+            response_format=RESPONSE_FORMAT if template.structured else None,
+            details=details,
+        )
+        request.estimated_tokens = image_tokens + PROMPT_TOKEN_ALLOWANCE + request.max_tokens
+
+        # Make the API call on the best available backend, within its quota
+        completion = await complete_and_account(request, template.key)
+        if completion.finish_reason == "length" and request.max_tokens < max_tokens:
+            # Cut short by a tuned budget: ask again with the full one rather than lose sections
+            request.max_tokens = max_tokens
+            request.estimated_tokens = image_tokens + PROMPT_TOKEN_ALLOWANCE + max_tokens
+            completion = await complete_and_account(request, template.key)
+
+        # Parse the raw response (JSON, or markdown as a fallback)
+        with stage("parse"):
+            return parse_model_output(completion.text)
+
+    except (UpstreamRateLimited, UpstreamUnavailable):
+        raise
     except Exception as e:
+        ERRORS.labels(type(e).__name__).inc()
         raise HTTPException(
             status_code=500,
             detail=f"API call failed: {str(e)}"
         )
 
-@app.post("/api/analyze")
+async def complete_and_account(request: VisionRequest, template: str):
+    """
+    Make one model call, feeding its completion length to the max_tokens
+    tuner and recording its tokens, cost and latency in the usage ledger.
+    """
+    started = time.perf_counter()
+    completion = await router.complete(request)
+    account_completion(request, template, completion, time.perf_counter() - started)
+    return completion
+
+def account_completion(request: VisionRequest, template: str, completion: Completion, latency: float) -> None:
+    """
+    Feed a finished call's completion length to the max_tokens tuner and
+    record it in the usage ledger.
+    """
+    max_tokens_tuner.observe(template, completion.completion_tokens, truncated=completion.finish_reason == "length")
+    usage_ledger.record(
+        template=template,
+        backend=completion.backend,
+        details=request.details or [],
+        max_tokens=request.max_tokens,
+        prompt_tokens=completion.prompt_tokens,
+        completion_tokens=completion.completion_tokens,
+        finish_reason=completion.finish_reason,
+        latency=latency,
+        cost=request_cost(completion.prompt_tokens, completion.completion_tokens,
+                          prompt_token_price, completion_token_price),
+    )
+
+def stream_image_analysis(image_content: bytes, mime_type: str = "image/jpeg", image_size: tuple = (None, None),
+                          usage: Optional[Completion] = None):
+    """
+    Stream the GPT-4V analysis, yielding text deltas as the model produces them.
+
+    When `usage` is given, it receives the backend, token counts and finish
+    reason of the call once the stream has ended.
+    """
+    detail = choose_detail(*image_size, image_low_detail_max_edge)
+    request = VisionRequest(
+        prompt=STREAM_TEMPLATE.text,
+        images=[(image_content, mime_type)],
+        max_tokens=max_tokens,
+        temperature=0.7,
+        estimated_tokens=estimate_request_tokens(*image_size, max_tokens, detail),
+        details=[detail],
+    )
+    return request, router.stream(request, usage)
+
+def cache_key_for(digest: str, prompt_version: Optional[str] = None) -> str:
+    return make_cache_key(digest, deployment, prompt_version or PROMPT_VERSION, max_tokens)
+
+async def find_cached_analysis(image_contents, content_type: str):
+    """
+    Look an upload up in the result cache, by exact digest and then by perceptual hash.
+
+    `image_contents` is the image bytes or a binary file such as a spooled
+    upload, which is hashed and decoded in chunks rather than read whole.
+    Returns (cached result or None, image digest, preprocessed image or None).
+    The image is only preprocessed when the exact lookup misses.
+    """
+    with stage("read"):
+        if isinstance(image_contents, bytes):
+            digest = image_digest(image_contents)
+        else:
+            loop = asyncio.get_running_loop()
+            digest = await loop.run_in_executor(preprocess_executor, image_digest, image_contents)
+    cached = await result_cache.aget(cache_key_for(digest))
+    if cached is not None:
+        return cached, digest, None
+
+    # Decode once: downscale, strip metadata and fingerprint in the thread pool
+    prepared = await preprocess_image(image_contents, content_type)
+
+    # Fall back to a perceptual match against previously analyzed photos
+    if prepared.fingerprint is not None:
+        similar_digest = near_duplicates.lookup(prepared.fingerprint)
+        if similar_digest is not None:
+            cached = await result_cache.aget(cache_key_for(similar_digest))
+            if cached is not None:
+                await result_cache.aset(cache_key_for(digest), cached)
+    return cached, digest, prepared
+
+async def remember_analysis(digest: str, prepared, analysis: dict, prompt_version: Optional[str] = None) -> None:
+    """
+    Store a fresh analysis for exact and near-duplicate lookups, under the
+    prompt version it was produced with (the configured one by default).
+    """
+    await result_cache.aset(cache_key_for(digest, prompt_version), analysis)
+    if prepared.fingerprint is not None:
+        near_duplicates.add(prepared.fingerprint, digest)
+
+async def match_catalog_items(items: list) -> list:
+    """
+    Replace suggested items with real catalog products: nearest neighbours by
+    embedding when the catalog has an embedding index, BM25 matches otherwise.
+    """
+    if catalog is None or not items:
+        return items
+    if catalog_vectors is None:
+        with stage("catalog"):
+            return catalog.match_items(items)
+    # One embedding call and one batched index query for all items
+    query_vectors = await catalog_embedder.embed([item_text(item) for item in items])
+    with stage("catalog"):
+        return catalog_vectors.match_items(items, query_vectors, catalog)
+
+async def with_catalog_products(analysis: dict) -> dict:
+    """
+    Point suggested items at matching catalog products, when a catalog is configured.
+
+    Applied on the way out rather than before caching, so cached results pick
+    up catalog updates.
+    """
+    if catalog is None or not analysis.get("suggestedItems"):
+        return analysis
+    return {**analysis, "suggestedItems": await match_catalog_items(analysis["suggestedItems"])}
+
+async def analyze_upload(image_contents, content_type: str, timings: dict = None) -> dict:
+    """
+    Analyze an uploaded image, serving it from the cache when possible.
+
+    Stage timings in milliseconds are added to `timings` when given. Raises
+    SchedulerOverloaded/SchedulerTimeout when no upstream slot is available.
+    """
+    _, analysis = await analyze_upload_keyed(image_contents, content_type, timings)
+    return analysis
+
+async def analyze_upload_keyed(image_contents, content_type: str, timings: dict = None):
+    """
+    `analyze_upload`, returning (image digest, analysis): the digest names the
+    cached result at /api/analysis/{digest}.
+    """
+    # Serve repeat uploads (or near-duplicates) of the same image from the cache
+    cached, digest, prepared = await find_cached_analysis(image_contents, content_type)
+    if prepared is not None:
+        for name, elapsed in prepared.timings.items():
+            observe_stage(name, elapsed / 1000)
+        if timings is not None:
+            timings.update(prepared.timings)
+    if cached is not None:
+        return digest, await with_catalog_products(cached)
+
+    async def analyze_and_remember() -> dict:
+        analysis = await scheduler.run(
+            lambda: analyze_image_with_gpt4v(prepared.content, prepared.mime_type, (prepared.width, prepared.height))
+        )
+        await remember_analysis(digest, prepared, analysis)
+        return analysis
+
+    analysis = await run_analysis(digest, analyze_and_remember, timings)
+    return digest, await with_catalog_products(analysis)
+
+async def run_analysis(digest: str, analyze_and_remember, timings: dict = None) -> dict:
+    """
+    Run the model call for `digest` once however many requests ask for it at
+    the same time, recording its latency as the `llm` stage.
+    """
+    started = time.perf_counter()
+    try:
+        # Identical uploads arriving before the first result is cached wait for the same call
+        analysis = await analysis_flights.do(cache_key_for(digest), analyze_and_remember)
+    except (SchedulerOverloaded, SchedulerTimeout, UpstreamRateLimited, UpstreamUnavailable) as e:
+        ERRORS.labels(type(e).__name__).inc()
+        raise
+    elapsed = time.perf_counter() - started
+    observe_stage("llm", elapsed, started)
+    if timings is not None:
+        timings["llm"] = elapsed * 1000
+    return analysis
+
+def photo_set_digest(digests: List[str]) -> str:
+    """
+    Name an ordered set of photos in the result cache. The detail budget is
+    part of the name, because it changes what the model is shown.
+    """
+    return image_digest(f"multi:{multi_image_token_budget}:{','.join(digests)}".encode())
+
+async def analyze_uploads_keyed(uploads: list, timings: dict = None):
+    """
+    Analyze several photos of one outfit with a single model call.
+
+    `uploads` holds (image bytes or file, content type) pairs. The photos are
+    hashed and then preprocessed in parallel, and each one's detail level is
+    chosen so that together they fit `multi_image_token_budget`. Returns
+    (digest naming the set, analysis), like `analyze_upload_keyed`, which
+    handles a single photo.
+    """
+    if len(uploads) == 1:
+        return await analyze_upload_keyed(*uploads[0], timings)
+
+    loop = asyncio.get_running_loop()
+    with stage("read"):
+        digests = await asyncio.gather(*(
+            loop.run_in_executor(preprocess_executor, image_digest, contents) for contents, _ in uploads
+        ))
+    digest = photo_set_digest(digests)
+    cached = await result_cache.aget(cache_key_for(digest))
+    if cached is not None:
+        return digest, await with_catalog_products(cached)
+
+    prepared: List[PreparedImage] = await asyncio.gather(*(
+        preprocess_image(contents, content_type) for contents, content_type in uploads
+    ))
+    for image in prepared:
+        for name, elapsed in image.timings.items():
+            observe_stage(name, elapsed / 1000)
+            if timings is not None:
+                # The photos are prepared side by side, so a stage takes as long as its slowest photo
+                timings[name] = max(timings.get(name, 0.0), elapsed)
+    sizes = [(image.width, image.height) for image in prepared]
+    details = choose_detail_levels(sizes, multi_image_token_budget, image_low_detail_max_edge)
+
+    async def analyze_and_remember() -> dict:
+        analysis = await scheduler.run(lambda: analyze_images_with_gpt4v(
+            [(image.content, image.mime_type) for image in prepared], sizes, details
+        ))
+        await result_cache.aset(cache_key_for(digest), analysis)
+        return analysis
+
+    analysis = await run_analysis(digest, analyze_and_remember, timings)
+    return digest, await with_catalog_products(analysis)
+
+def http_error_for(error: Exception) -> HTTPException:
+    """
+    The HTTP error reported when no upstream slot or quota is available for an analysis.
+    """
+    if isinstance(error, SchedulerOverloaded):
+        return HTTPException(status_code=503, detail=str(error), headers={"Retry-After": "1"})
+    if isinstance(error, SchedulerTimeout):
+        return HTTPException(status_code=504, detail=str(error))
+    status_code = 429 if isinstance(error, UpstreamRateLimited) else 503
+    return HTTPException(status_code=status_code, detail=str(error),
+                         headers={"Retry-After": str(math.ceil(error.retry_after))})
+
+def analysis_response(digest: str, analysis: dict, timings: dict) -> AnalysisJSONResponse:
+    headers = {"Content-Location": f"/api/analysis/{digest}"}
+    if timings:
+        headers["Server-Timing"] = server_timing(timings)
+    with stage("serialize"):
+        body = encode_analysis(analysis)
+    return AnalysisJSONResponse(body, headers=headers)
+
+@api.post("/api/analyze", response_model=AnalysisResponse, response_class=AnalysisJSONResponse)
 async def analyze_outfit(file: UploadFile = File(...)):
     """
     Endpoint to analyze an outfit image using GPT-4V and return fashion insights.
+
+    The response carries an ETag and, as Content-Location, the URL the same
+    result can be fetched (and revalidated) from without re-uploading.
     """
     if not file.content_type.startswith('image/'):
         raise HTTPException(status_code=400, detail="File provided is not an image.")
 
-    # Read the image content
-    image_contents = await file.read()
-    
-    # Get analysis from GPT-4V
-    analysis = analyze_image_with_gpt4v(image_contents)
-    
-    return analysis
+    # Get analysis from the cache or GPT-4V, waiting for a free upstream slot if needed.
+    # The upload is passed as its (possibly disk-spooled) file, never read into memory whole.
+    timings = {}
+    try:
+        digest, analysis = await analyze_upload_keyed(file.file, file.content_type, timings)
+    except (SchedulerOverloaded, SchedulerTimeout, UpstreamRateLimited, UpstreamUnavailable) as e:
+        raise http_error_for(e)
+    return analysis_response(digest, analysis, timings)
+
+@api.post("/api/analyze/multi", response_model=AnalysisResponse, response_class=AnalysisJSONResponse)
+async def analyze_outfit_photos(files: List[UploadFile] = File(...)):
+    """
+    Analyze several photos of one outfit (front, back, details) with a single model call.
+
+    Returns one analysis in the same shape as /api/analyze. Sending all the
+    photos in one request costs one call's latency and prompt overhead,
+    rather than one per photo.
+    """
+    if len(files) > multi_image_max_images:
+        raise HTTPException(status_code=400, detail=f"At most {multi_image_max_images} images can be analyzed together.")
+    if not all(file.content_type.startswith('image/') for file in files):
+        raise HTTPException(status_code=400, detail="File provided is not an image.")
+
+    timings = {}
+    try:
+        digest, analysis = await analyze_uploads_keyed([(file.file, file.content_type) for file in files], timings)
+    except (SchedulerOverloaded, SchedulerTimeout, UpstreamRateLimited, UpstreamUnavailable) as e:
+        raise http_error_for(e)
+    return analysis_response(digest, analysis, timings)
+
+@api.get("/api/analysis/{digest}", response_model=AnalysisResponse, response_class=AnalysisJSONResponse)
+async def get_analysis(digest: str, if_none_match: Optional[str] = Header(None)):
+    """
+    Fetch the cached analysis of a previously uploaded image by its digest.
+
+    Answers 304 Not Modified when `If-None-Match` holds the current ETag, so
+    clients that re-fetch a result they already have pay for headers only.
+    """
+    analysis = None
+    if len(digest) == 64:
+        analysis = (await result_cache.aget(cache_key_for(digest))
+                    or await result_cache.aget(cache_key_for(digest, STREAM_PROMPT_VERSION)))
+    if analysis is None:
+        raise HTTPException(status_code=404, detail="No cached analysis for this image.")
+    with stage("serialize"):
+        body = encode_analysis(await with_catalog_products(analysis))
+    etag = body_etag(body)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return AnalysisJSONResponse(body, headers=headers)
+
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@api.post("/api/analyze/stream")
+async def analyze_outfit_stream(file: UploadFile = File(...)):
+    """
+    Streaming variant of /api/analyze using Server-Sent Events.
+
+    Emits a `section` event for each analysis field, a `fashionTip` event per
+    tip and a `suggestedItem` event per item as soon as the model has finished
+    writing it, then a `result` event with the complete payload. Failures after
+    the stream has started are reported as an `error` event.
+    """
+    if not file.content_type.startswith('image/'):
+        raise HTTPException(status_code=400, detail="File provided is not an image.")
+
+    cached, digest, prepared = await find_cached_analysis(file.file, file.content_type)
+    if cached is None:
+        # A result streamed earlier, when the configured prompt is not the streaming one
+        cached = await result_cache.aget(cache_key_for(digest, STREAM_PROMPT_VERSION))
+
+    async def events():
+        if cached is not None:
+            result = await with_catalog_products(cached)
+            for event, data in result_events(result):
+                yield sse_event(event, data)
+            yield sse_event("result", result)
+            return
+
+        parser = StreamingAnalysisParser()
+        usage = Completion(text="")
+        try:
+            async with scheduler.slot() as deadline:
+                started = time.perf_counter()
+                request, stream = stream_image_analysis(
+                    prepared.content, prepared.mime_type, (prepared.width, prepared.height), usage
+                )
+                try:
+                    while True:
+                        try:
+                            delta = await asyncio.wait_for(stream.__anext__(), deadline - time.monotonic())
+                        except StopAsyncIteration:
+                            break
+                        for event, data in parser.feed(delta):
+                            if event == "suggestedItem":
+                                data = (await match_catalog_items([data]))[0]
+                            yield sse_event(event, data)
+                finally:
+                    await stream.aclose()
+                account_completion(request, STREAM_TEMPLATE.key, usage, time.perf_counter() - started)
+        except SchedulerOverloaded as e:
+            ERRORS.labels(type(e).__name__).inc()
+            yield sse_event("error", {"status": 503, "detail": str(e)})
+            return
+        except (SchedulerTimeout, asyncio.TimeoutError) as e:
+            ERRORS.labels(type(e).__name__).inc()
+            yield sse_event("error", {"status": 504, "detail": "Analysis did not complete within the deadline"})
+            return
+        except UpstreamRateLimited as e:
+            ERRORS.labels(type(e).__name__).inc()
+            yield sse_event("error", {"status": 429, "detail": str(e), "retryAfter": e.retry_after})
+            return
+        except UpstreamUnavailable as e:
+            ERRORS.labels(type(e).__name__).inc()
+            yield sse_event("error", {"status": 503, "detail": str(e), "retryAfter": e.retry_after})
+            return
+        except Exception as e:
+            ERRORS.labels(type(e).__name__).inc()
+            yield sse_event("error", {"status": 500, "detail": f"API call failed: {str(e)}"})
+            return
+
+        final_events, analysis = parser.close()
+        for event, data in final_events:
+            if event == "suggestedItem":
+                data = (await match_catalog_items([data]))[0]
+            yield sse_event(event, data)
+        await remember_analysis(digest, prepared, analysis, STREAM_PROMPT_VERSION)
+        yield sse_event("result", await with_catalog_products(analysis))
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+async def analyze_for_batch(image_contents: bytes, content_type: str, max_wait: Optional[float] = None) -> dict:
+    """
+    Batch variant of analyze_upload that waits out a full scheduler queue or
+    an exhausted quota instead of failing, so bulk jobs back off rather than erroring.
+
+    With `max_wait`, the error is raised instead once backing off again
+    would take longer than `max_wait` seconds in all.
+    """
+    deadline = None if max_wait is None else time.monotonic() + max_wait
+    delay = 0.5
+    while True:
+        try:
+            return await analyze_upload(image_contents, content_type)
+        except (SchedulerOverloaded, UpstreamRateLimited) as e:
+            if isinstance(e, UpstreamRateLimited):
+                wait = e.retry_after
+            else:
+                wait, delay = delay, min(delay * 2, 10.0)
+            if deadline is not None and time.monotonic() + wait > deadline:
+                raise
+            await asyncio.sleep(wait)
+
+def analyze_batch(images, job_id: str = None):
+    """
+    Python-callable batch analysis: an async iterator of result records.
+
+    `images` is a list of BatchImage, e.g. from `dedupe_paths(paths)`.
+    """
+    return run_batch(images, analyze_for_batch, batch_store, job_id=job_id, concurrency=batch_concurrency)
+
+@api.post("/api/analyze/batch")
+async def analyze_outfit_batch(
+    files: List[UploadFile] = File(None),
+    manifest: UploadFile = File(None),
+    job_id: Optional[str] = Form(None),
+):
+    """
+    Analyze many images at once and stream one NDJSON record per unique image.
+
+    Accepts uploaded `files`, a `manifest` of image paths under
+    BATCH_MANIFEST_ROOT, or both. Passing the `job_id` of an earlier run
+    replays its completed results and only analyzes the rest.
+    """
+    uploads = []
+    for upload in files or []:
+        if not upload.content_type.startswith('image/'):
+            raise HTTPException(status_code=400, detail=f"File provided is not an image: {upload.filename}")
+        # Kept spooled: hashed in chunks here, read whole only by the worker analyzing it
+        uploads.append((upload.filename, upload.file, upload.content_type))
+
+    try:
+        images = await asyncio.to_thread(dedupe_uploads, uploads)
+        if manifest is not None:
+            if not batch_manifest_root:
+                raise BatchInputError("Manifests are disabled; set BATCH_MANIFEST_ROOT to enable them")
+            paths = parse_manifest((await manifest.read()).decode("utf-8"))
+            known = {image.digest for image in images}
+            for image in await asyncio.to_thread(dedupe_paths, paths, batch_manifest_root):
+                if image.digest not in known:
+                    images.append(image)
+        if job_id is not None and not batch_store.exists(job_id):
+            raise BatchInputError(f"Unknown job ID: {job_id}")
+    except (BatchInputError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not images:
+        raise HTTPException(status_code=400, detail="No images provided.")
+
+    async def lines():
+        async for record in analyze_batch(images, job_id):
+            yield json.dumps(record) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+@api.get("/api/analyze/batch/{job_id}")
+def batch_progress(job_id: str):
+    """
+    Report the persisted progress of a batch job.
+    """
+    try:
+        if not batch_store.exists(job_id):
+            raise HTTPException(status_code=404, detail="Unknown job ID.")
+    except BatchInputError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return batch_store.progress(job_id)
 
-@app.get("/")
+async def analyze_job(image_contents: bytes, content_type: str) -> dict:
+    """
+    Analyze a queued job, waiting for capacity like a batch image and
+    reporting failures with the status /api/analyze would have answered.
+
+    The wait is capped at `job_max_wait`, so the attempt fails before the
+    job is presumed dead and a second worker runs it again.
+    """
+    try:
+        return await analyze_for_batch(image_contents, content_type, max_wait=job_max_wait)
+    except (SchedulerOverloaded, SchedulerTimeout, UpstreamRateLimited, UpstreamUnavailable) as e:
+        raise http_error_for(e)
+
+@api.post("/api/jobs", status_code=202)
+async def submit_job(file: UploadFile = File(...)):
+    """
+    Queue an outfit analysis and return its job ID without waiting for the result.
+    """
+    if not file.content_type.startswith('image/'):
+        raise HTTPException(status_code=400, detail="File provided is not an image.")
+
+    job_id = await job_queue.submit(await file.read(), file.content_type)
+    location = f"/api/jobs/{job_id}"
+    return JSONResponse(
+        status_code=202,
+        content={"jobId": job_id, "status": "queued", "statusUrl": location, "eventsUrl": f"{location}/events"},
+        headers={"Location": location},
+    )
+
+@api.get("/api/jobs/{job_id}")
+async def job_status(job_id: str):
+    """
+    Report a job's status, with its `result` once done or its `error` once failed.
+    """
+    job = await job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job ID.")
+    return job
+
+@api.get("/api/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """
+    Server-Sent Events for a job: a `status` event per status change, then a
+    `result` event with the analysis or an `error` event. A finished job
+    answers straight from the stored result.
+    """
+    job = await job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job ID.")
+
+    async def events():
+        current, last_status, last_sent = job, None, time.monotonic()
+        while True:
+            if current is None:
+                yield sse_event("error", {"status": 404, "detail": "Unknown job ID."})
+                return
+            if current["status"] != last_status:
+                last_status, last_sent = current["status"], time.monotonic()
+                yield sse_event("status", {"jobId": job_id, "status": last_status})
+            if last_status == DONE:
+                yield sse_event("result", current["result"])
+                return
+            if last_status == FAILED:
+                yield sse_event("error", current["error"])
+                return
+            if time.monotonic() - last_sent > 15:
+                # Comment line, so proxies do not close an idle stream
+                last_sent = time.monotonic()
+                yield ": keepalive\n\n"
+            # Woken by this process's workers; the re-read also sees other processes' updates
+            await job_queue.wait(job_id, timeout=1.0)
+            current = await job_queue.get(job_id)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@api.get("/api/cache/stats")
+def cache_stats():
+    """
+    Report hit/miss counters for the analysis result cache.
+    """
+    return {
+        **result_cache.stats(),
+        "nearDuplicates": near_duplicates.stats(),
+        "singleFlight": analysis_flights.stats(),
+    }
+
+@api.get("/api/upstream/stats")
+def upstream_stats():
+    """
+    Report routing, latency, quota, circuit breaker and connection pool state per vision backend.
+    """
+    stats = router.stats()
+    for name, http_client in list(http_pools.items()):
+        if name in stats["backends"]:
+            stats["backends"][name]["pool"] = pool_stats(http_client)
+    return stats
+
+@api.get("/api/usage/stats")
+def usage_stats(since: float = 0.0):
+    """
+    Report tokens, cost and latency per prompt template since `since` (a Unix time), and the current max_tokens.
+    """
+    return {
+        "template": prompt_template.key,
+        **usage_ledger.summary(since),
+        "maxTokens": max_tokens_tuner.stats(),
+    }
+
+@api.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """
+    Expose stage latencies, token usage, cache, scheduler and error metrics in Prometheus text format.
+    """
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@api.get("/")
 def read_root():
     return {"message": "Welcome to the Style-Finder API"}
 
+# Last probe result per backend, and the background warm-up started with the app
+upstream_probes = {}
+upstream_probed_at = 0.0
+readiness_flights = SingleFlight()
+warmup_task = None
+
+async def probe_upstream(make_client) -> dict:
+    """
+    Check that a backend's endpoint answers, leaving a pooled connection open.
+
+    Any HTTP response counts as reachable, even an error status; only
+    connection failures and timeouts do not.
+    """
+    started = time.perf_counter()
+    try:
+        probe_client = make_client().with_options(timeout=upstream_probe_timeout)
+        await probe_client.models.list()
+    except Exception as e:
+        if getattr(e, "status_code", None) is None:
+            return {"reachable": False, "error": str(e) or type(e).__name__}
+    return {"reachable": True, "latencyMs": round((time.perf_counter() - started) * 1000, 1)}
+
+async def probe_upstreams() -> dict:
+    global upstream_probed_at
+    results = await asyncio.gather(*(probe_upstream(factory) for factory in upstream_clients.values()))
+    upstream_probes.update(zip(upstream_clients, results))
+    upstream_probed_at = time.monotonic()
+    return upstream_probes
+
+async def warm_up() -> None:
+    """
+    Do the one-off work of the first request ahead of it: import the SDK,
+    connect to every backend, and initialize the image codecs.
+    """
+    started = time.perf_counter()
+    # Importing the SDK takes a while; doing it in a thread keeps the event loop free to finish startup
+    await asyncio.to_thread(lambda: [make_client() for make_client in upstream_clients.values()])
+    await asyncio.gather(
+        readiness_flights.do("probe", probe_upstreams),
+        # Limits below the sample's size, so decode, resize, fingerprint and encode all run
+        asyncio.get_running_loop().run_in_executor(
+            preprocess_executor,
+            partial(prepare_image, sample_jpeg(), "image/jpeg", max_edge=32, max_short_edge=24,
+                    fingerprint=near_duplicate_distance >= 0),
+        ),
+    )
+    observe_stage("warmup", time.perf_counter() - started)
+
+@api.get("/healthz")
+def healthz():
+    """
+    Liveness: the process is up and its event loop answers.
+    """
+    return {"status": "ok"}
+
+@api.get("/readyz")
+async def readyz():
+    """
+    Readiness: warm-up has finished and at least one backend is reachable
+    and not cooling down after failures. Probes are refreshed at most every
+    READY_CHECK_INTERVAL_SECONDS.
+    """
+    if warmup_task is None or not warmup_task.done():
+        return JSONResponse(status_code=503, content={"status": "starting"})
+    if time.monotonic() - upstream_probed_at > ready_check_interval:
+        await readiness_flights.do("probe", probe_upstreams)
+
+    routing = router.stats()["backends"]
+    backends = {
+        name: {**upstream_probes.get(name, {"reachable": None}), "healthy": state["healthy"]}
+        for name, state in routing.items()
+    }
+    # Backends without a probe (e.g. Gemini) count as reachable while healthy
+    ready = any(backend["reachable"] is not False and backend["healthy"] for backend in backends.values())
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"status": "ready" if ready else "unavailable", "backends": backends},
+    )
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global warmup_task
+    check_config()
+    # Warm up in the background: /healthz answers at once, /readyz once this is done
+    warmup_task = asyncio.create_task(warm_up())
+    await job_queue.start()
+    try:
+        yield
+    finally:
+        warmup_task.cancel()
+        await job_queue.stop()
+        usage_ledger.close()
+
+def create_app() -> FastAPI:
+    """
+    Build the ASGI application: middleware, routes and startup/shutdown hooks.
+
+    Also usable as `uvicorn src.backend.main:create_app --factory`.
+    """
+    application = FastAPI(
+        title="Style-Finder API",
+        description="API for analyzing fashion outfits from images.",
+        version="0.1.0",
+        lifespan=lifespan,
+    )
+    application.add_middleware(BodySizeLimitMiddleware, limits=upload_limits)
+    application.add_middleware(CompressionMiddleware, minimum_size=compression_min_bytes,
+                               encodings=compression_encodings)
+
+    # --- CORS Middleware ---
+    # This allows the frontend (running on a different port) to communicate with the backend.
+    application.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],  # Allows all origins
+        allow_credentials=True,
+        allow_methods=["*"],  # Allows all methods
+        allow_headers=["*"],  # Allows all headers
+        expose_headers=["Server-Timing", "X-Request-ID", "ETag", "Content-Location"],  # Lets the frontend read per-stage timings
+    )
+
+    # Request counters and latency per route, plus optional tracing
+    application.add_middleware(MetricsMiddleware, tracing=tracing_enabled)
+    application.include_router(api)
+    return application
+
+app = create_app()
+
 # To run this app:
 # uvicorn src.backend.main:app --reload 
\ No newline at end of file
@@ -0,0 +1,344 @@
+"""
+Minimal Prometheus-compatible metrics and request tracing.
+
+Metrics are plain Python objects whose label children are created once and
+then only have numbers incremented, so recording on the hot path costs a
+dict lookup and an addition. `REGISTRY.render()` produces the text
+exposition format served at /metrics. Values that other components already
+track (cache hit counters, scheduler queue depth) are exported through
+callbacks evaluated at scrape time instead of being duplicated.
+
+Tracing is opt-in: when enabled, each request carries a trace ID (taken from
+an incoming `traceparent`/`X-Request-ID` header or generated) and records
+the spans of its stages, which are logged as one JSON line per request.
+"""
+
+import json
+import logging
+import math
+import time
+import uuid
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Latency buckets in seconds, from sub-millisecond parsing to minute-long calls
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 30, 60)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+
+    def labels(self, *values: str):
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.labels().inc(amount)
+
+    def _samples(self):
+        for values, child in self._children.items():
+            yield f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.labels().dec(amount)
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def _samples(self):
+        for values, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), child.counts):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, values, le)} {cumulative}"
+            labels = _format_labels(self.labelnames, values)
+            yield f"{self.name}_sum{labels} {_format_value(child.sum)}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class CallbackMetric(_Metric):
+    """
+    A counter or gauge whose samples come from `collect()` at scrape time,
+    as (label values, value) pairs.
+    """
+
+    def __init__(self, name: str, help: str, collect: Callable[[], Iterable[Tuple[Tuple[str, ...], float]]],
+                 labelnames: Sequence[str] = (), type: str = "gauge"):
+        super().__init__(name, help, labelnames)
+        self.type = type
+        self._collect = collect
+
+    def _samples(self):
+        for values, value in self._collect():
+            if value is None:
+                continue
+            yield f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(value)}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def callback(self, name: str, help: str, collect, labelnames: Sequence[str] = (), type: str = "gauge") -> CallbackMetric:
+        return self.register(CallbackMetric(name, help, collect, labelnames, type))
+
+    def get(self, name: str) -> Optional[_Metric]:
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+REGISTRY = Registry()
+
+# Shared metrics recorded across modules
+STAGE_SECONDS = REGISTRY.histogram(
+    "stylefinder_stage_seconds", "Time spent in each stage of the analyze path", ("stage",)
+)
+UPSTREAM_SECONDS = REGISTRY.histogram(
+    "stylefinder_upstream_seconds", "Vision model call latency per backend", ("backend", "outcome")
+)
+UPSTREAM_TOKENS = REGISTRY.counter(
+    "stylefinder_upstream_tokens_total", "Tokens reported by the vision model per backend", ("backend", "kind")
+)
+ERRORS = REGISTRY.counter(
+    "stylefinder_errors_total", "Failed analyses by error class", ("error",)
+)
+COMPRESSION_BYTES = REGISTRY.counter(
+    "stylefinder_compression_bytes_total", "Compressed response bodies, bytes before and after", ("encoding", "kind")
+)
+
+
+# --- Tracing ---
+
+logger = logging.getLogger("stylefinder.trace")
+
+
+class Trace:
+    __slots__ = ("trace_id", "started", "spans")
+
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.started = time.perf_counter()
+        self.spans: List[tuple] = []
+
+    def record(self, name: str, started: float, duration: float) -> None:
+        self.spans.append((name, round((started - self.started) * 1000, 3), round(duration * 1000, 3)))
+
+    def log(self, **fields) -> None:
+        logger.info(json.dumps({
+            "traceId": self.trace_id,
+            "durationMs": round((time.perf_counter() - self.started) * 1000, 3),
+            "spans": [{"name": n, "startMs": s, "durationMs": d} for n, s, d in self.spans],
+            **fields,
+        }))
+
+
+current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+
+
+def trace_id_from_headers(traceparent: Optional[str], request_id: Optional[str]) -> str:
+    """
+    Reuse the caller's W3C trace ID or request ID when present.
+    """
+    if traceparent:
+        parts = traceparent.split("-")
+        if len(parts) == 4 and len(parts[1]) == 32:
+            return parts[1]
+    if request_id:
+        return request_id[:64]
+    return uuid.uuid4().hex
+
+
+def observe_stage(stage: str, seconds: float, started: Optional[float] = None) -> None:
+    """
+    Record a stage duration in the histogram and, when tracing, as a span.
+    """
+    STAGE_SECONDS.labels(stage).observe(seconds)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.record(stage, started if started is not None else time.perf_counter() - seconds, seconds)
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Time the enclosed block as analyze-path stage `name`.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - started, started)
+
+
+HTTP_REQUESTS = REGISTRY.counter(
+    "stylefinder_http_requests_total", "HTTP requests by route and status", ("method", "route", "status")
+)
+HTTP_SECONDS = REGISTRY.histogram(
+    "stylefinder_http_request_seconds", "HTTP request latency by route, including streamed bodies", ("route",)
+)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware counting requests per route template and, when
+    `tracing` is on, opening a trace for each request and echoing its ID
+    back in an `X-Request-ID` header.
+    """
+
+    def __init__(self, app, tracing: bool = False):
+        self.app = app
+        self.tracing = tracing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
+        trace = token = None
+        if self.tracing:
+            headers = dict(scope["headers"])
+            traceparent = headers.get(b"traceparent", b"").decode("latin-1") or None
+            request_id = headers.get(b"x-request-id", b"").decode("latin-1") or None
+            trace = Trace(trace_id_from_headers(traceparent, request_id))
+            token = current_trace.set(trace)
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if trace is not None:
+                    message["headers"] = list(message.get("headers", [])) + [(b"x-request-id", trace.trace_id.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # Label by route template, not raw path, to keep label cardinality bounded
+            route = getattr(scope.get("route"), "path", "unmatched")
+            HTTP_REQUESTS.labels(scope["method"], route, str(status)).inc()
+            HTTP_SECONDS.labels(route).observe(time.perf_counter() - started)
+            if trace is not None:
+                trace.log(method=scope["method"], route=route, status=status)
+                current_trace.reset(token)
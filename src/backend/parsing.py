@@ -0,0 +1,296 @@
+"""
+Parsing of the analysis returned by the vision model.
+
+`parse_model_output` turns a complete response into the API payload. In
+structured-output mode the response is JSON validated against
+`StructuredAnalysis` in a single pass; anything else (or JSON too broken to
+salvage) goes through the markdown parser, `parse_analysis_text`.
+`StreamingAnalysisParser` consumes the same text in arbitrary chunks as the
+model streams it and reports each part of the payload as soon as it is
+complete, so clients can render the description while tips are still being
+generated.
+"""
+
+from typing import List, Optional, Tuple
+
+from pydantic import ValidationError
+from pydantic_core import from_json
+
+from src.backend.schemas import StructuredAnalysis
+
+# Keys of the 'analysis' object, in the order the prompt asks for them
+ANALYSIS_FIELDS = ("description", "colorTones", "coreApparel", "accessories")
+
+
+def search_url(name: str) -> str:
+    """
+    Nordstrom search URL for an item name.
+    """
+    return f"https://www.nordstrom.com/s/{name.lower().replace(' ', '-')}"
+
+
+def classify_section(title: str) -> Optional[str]:
+    """
+    Map a section title to the payload field it fills, or None if unknown.
+    """
+    title = title.strip().lower()
+    if 'description' in title or '1.' in title:
+        return 'description'
+    elif 'color' in title or '2.' in title:
+        return 'colorTones'
+    elif 'core' in title or 'apparel' in title or '3.' in title:
+        return 'coreApparel'
+    elif 'accessories' in title or '4.' in title:
+        return 'accessories'
+    elif 'fashion tips' in title or '5.' in title:
+        return 'fashionTips'
+    elif 'similar items' in title or '6.' in title:
+        return 'suggestedItems'
+    return None
+
+
+def clean_content(content: str) -> str:
+    """
+    Remove any remaining markdown formatting from a section body.
+    """
+    return content.replace('*', '').replace('---', '').strip()
+
+
+def parse_fashion_tip(line: str) -> Optional[str]:
+    """
+    Return the tip text for a bullet line, or None for any other line.
+    """
+    if line.strip().startswith('-'):
+        return line.strip('- ').strip()
+    return None
+
+
+def parse_fashion_tips(content: str) -> List[str]:
+    tips = [parse_fashion_tip(line) for line in content.split('\n')]
+    return [tip for tip in tips if tip is not None]
+
+
+class SuggestedItemsParser:
+    """
+    Line-by-line parser for the suggested items section.
+
+    `line()` returns the previous item once a new one starts, and `close()`
+    the last one, so a stream can report each item as soon as it is finished.
+    """
+
+    def __init__(self):
+        self._current_item = {}
+
+    def line(self, line: str) -> Optional[dict]:
+        line = line.strip()
+        if not line:
+            return None
+
+        if line.startswith('1.') or line.startswith('2.') or line.startswith('3.'):
+            finished = self._current_item or None
+            # Extract name more safely
+            name = line.split('.')[1].strip()  # Remove the number
+            if '**' in name:
+                name = name.split('**')[1].strip()  # Extract from bold if present
+            else:
+                name = name.strip()  # Just clean up whitespace
+
+            self._current_item = {
+                'name': name,
+                'description': '',
+                'imageUrl': search_url(name),
+                'productUrl': search_url(name)
+            }
+            return finished
+        elif line.startswith('-'):
+            line = line.strip('- ').strip()
+            if 'Price Range' in line or 'Estimated Price' in line or 'price range' in line.lower():
+                return None
+            if 'Description:' in line:
+                self._current_item['description'] = line.split('Description:')[1].strip()
+            else:
+                self._current_item['description'] = line
+        return None
+
+    def close(self) -> Optional[dict]:
+        finished, self._current_item = self._current_item or None, {}
+        return finished
+
+
+def parse_suggested_items(content: str) -> List[dict]:
+    parser = SuggestedItemsParser()
+    items = [parser.line(line) for line in content.split('\n')] + [parser.close()]
+    return [item for item in items if item is not None]
+
+
+def parse_analysis_text(result: str) -> dict:
+    """
+    Parse a complete markdown response into the API payload.
+    """
+    analysis = {field: '' for field in ANALYSIS_FIELDS}
+    fashion_tips = []
+    suggested_items = []
+
+    # Split into sections by markdown headers
+    for section in result.split('###'):
+        if not section.strip():
+            continue
+
+        # Extract the section title and content
+        lines = section.strip().split('\n')
+        content = clean_content('\n'.join(lines[1:]))
+
+        field = classify_section(lines[0])
+        if field in ANALYSIS_FIELDS:
+            analysis[field] = content
+        elif field == 'fashionTips':
+            fashion_tips = parse_fashion_tips(content)
+        elif field == 'suggestedItems':
+            suggested_items = parse_suggested_items(content)
+
+    return {
+        'analysis': analysis,
+        'fashionTips': fashion_tips,
+        'suggestedItems': suggested_items
+    }
+
+
+def _strip_code_fence(text: str) -> str:
+    text = text.strip()
+    if text.startswith('```'):
+        text = text[text.find('\n') + 1:]
+        if text.rstrip().endswith('```'):
+            text = text.rstrip()[:-3]
+    return text
+
+
+def parse_structured_analysis(text: str) -> Optional[dict]:
+    """
+    Parse a structured-output (JSON) response into the API payload.
+
+    Truncated JSON, e.g. when the model hits max_tokens, is recovered up to
+    the last complete value. Returns None when the text is not JSON at all.
+    """
+    text = _strip_code_fence(text)
+    try:
+        structured = StructuredAnalysis.model_validate_json(text)
+    except ValidationError:
+        try:
+            structured = StructuredAnalysis.model_validate(from_json(text, allow_partial=True))
+        except (ValueError, ValidationError):
+            return None
+
+    return {
+        'analysis': {
+            'description': structured.description,
+            'colorTones': structured.colorTones,
+            'coreApparel': structured.coreApparel,
+            'accessories': structured.accessories,
+        },
+        'fashionTips': structured.fashionTips,
+        'suggestedItems': [
+            {
+                'name': item.name,
+                'description': item.description,
+                'imageUrl': search_url(item.name),
+                'productUrl': search_url(item.name),
+            }
+            for item in structured.similarItems
+            if item.name
+        ],
+    }
+
+
+def parse_model_output(text: str) -> dict:
+    """
+    Parse a complete model response, structured or markdown, into the API payload.
+    """
+    if text.lstrip().startswith(('{', '```')):
+        parsed = parse_structured_analysis(text)
+        if parsed is not None:
+            return parsed
+    return parse_analysis_text(text)
+
+
+# (event name, data) pairs produced by the streaming parser
+Event = Tuple[str, object]
+
+
+def result_events(result: dict) -> List[Event]:
+    """
+    Express an already complete payload as the events a stream would have produced.
+    """
+    events = [("section", {"name": field, "content": result['analysis'][field]}) for field in ANALYSIS_FIELDS]
+    events += [("fashionTip", tip) for tip in result['fashionTips']]
+    events += [("suggestedItem", item) for item in result['suggestedItems']]
+    return events
+
+
+class StreamingAnalysisParser:
+    """
+    Incremental counterpart of `parse_analysis_text`.
+
+    Feed it text deltas as they arrive; each call returns the events that
+    became complete. Analysis sections are emitted when the next header
+    arrives, fashion tips line by line, and suggested items once the next
+    item (or the end of the section) shows they are finished. Each line is
+    looked at once, as it completes. `close()` flushes the last section and
+    returns the full payload, parsed from the complete text so it is
+    identical to the non-streaming response.
+    """
+
+    def __init__(self):
+        self._chunks: List[str] = []
+        self._partial = ''
+        self._field: Optional[str] = None
+        # Lines of the current analysis section, kept until its end gives its content
+        self._section_lines: List[str] = []
+        self._items = SuggestedItemsParser()
+
+    def feed(self, text: str) -> List[Event]:
+        self._chunks.append(text)
+        lines = (self._partial + text).split('\n')
+        self._partial = lines.pop()
+        events = []
+        for line in lines:
+            events += self._line(line)
+        return events
+
+    def close(self) -> Tuple[List[Event], dict]:
+        events = []
+        if self._partial:
+            events += self._line(self._partial)
+            self._partial = ''
+        events += self._finish_section()
+        return events, parse_analysis_text(''.join(self._chunks))
+
+    def _line(self, line: str) -> List[Event]:
+        if line.strip().startswith('###'):
+            events = self._finish_section()
+            self._field = classify_section(line.strip().lstrip('#'))
+            return events
+
+        if self._field in ANALYSIS_FIELDS:
+            self._section_lines.append(line)
+        elif self._field == 'fashionTips':
+            tip = parse_fashion_tip(clean_content(line))
+            if tip is not None:
+                return [("fashionTip", tip)]
+        elif self._field == 'suggestedItems':
+            # A new item means the previous one is complete
+            item = self._items.line(clean_content(line))
+            if item is not None:
+                return [("suggestedItem", item)]
+        return []
+
+    def _finish_section(self) -> List[Event]:
+        events = []
+        if self._field in ANALYSIS_FIELDS:
+            events.append(("section", {"name": self._field, "content": clean_content('\n'.join(self._section_lines))}))
+        elif self._field == 'suggestedItems':
+            item = self._items.close()
+            if item is not None:
+                events.append(("suggestedItem", item))
+        self._field = None
+        self._section_lines = []
+        return events
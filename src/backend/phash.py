@@ -0,0 +1,221 @@
+"""
+Perceptual hashing and near-duplicate lookup for uploaded images.
+
+A 64-bit pHash survives recompression, screenshots and moderate resizing, so
+copies of the same photo land within a small Hamming distance of each other.
+`HammingIndex` answers "is there a fingerprint within distance r?" using
+multi-index hashing: the 64 bits are split into four 16-bit chunks, and by the
+pigeonhole principle any match within r must agree with the query to within
+r // 4 bits on at least one chunk. Each chunk is kept as a sorted NumPy array,
+so a query is a handful of binary searches plus a vectorized popcount over the
+few candidates instead of a scan of every stored fingerprint.
+"""
+
+import io
+from itertools import combinations
+from typing import Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+HASH_SIZE = 8
+_SAMPLE_SIZE = 32
+_CHUNKS = 4
+_CHUNK_BITS = 64 // _CHUNKS
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    matrix[0] /= np.sqrt(2.0)
+    return matrix
+
+
+_DCT = _dct_matrix(_SAMPLE_SIZE)
+_BIT_WEIGHTS = np.uint64(1) << np.arange(63, -1, -1, dtype=np.uint64)
+
+
+def phash_image(image: Image.Image) -> Optional[int]:
+    """
+    Return the 64-bit DCT perceptual hash of a decoded image.
+
+    Returns None for (near) flat images, whose hash carries no information
+    and would otherwise collide with every other flat image.
+    """
+    gray = image.convert("L").resize((_SAMPLE_SIZE, _SAMPLE_SIZE), Image.Resampling.LANCZOS)
+    pixels = np.asarray(gray, dtype=np.float64)
+    coefficients = (_DCT @ pixels @ _DCT.T)[:HASH_SIZE, :HASH_SIZE].ravel()
+    low_freq = coefficients[1:]  # the DC term only reflects overall brightness
+    if np.std(low_freq) < 1e-6:
+        return None
+    bits = coefficients > np.median(low_freq)
+    bits[0] = False
+    return int(np.sum(_BIT_WEIGHTS[bits], dtype=np.uint64))
+
+
+def phash_bytes(image_content: bytes) -> Optional[int]:
+    """
+    Decode `image_content` and return its perceptual hash, or None if it is not a readable image.
+    """
+    try:
+        with Image.open(io.BytesIO(image_content)) as image:
+            image.draft("L", (_SAMPLE_SIZE * 4, _SAMPLE_SIZE * 4))  # cheap JPEG downscale during decode
+            return phash_image(image)
+    except Exception:
+        return None
+
+
+if hasattr(np, "bitwise_count"):
+    def _popcount(values: np.ndarray) -> np.ndarray:
+        return np.bitwise_count(values)
+else:  # NumPy < 2.0
+    _BYTE_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def _popcount(values: np.ndarray) -> np.ndarray:
+        as_bytes = values.view(np.uint8).reshape(-1, 8)
+        return _BYTE_POPCOUNT[as_bytes].sum(axis=1)
+
+
+def _chunk_masks(radius: int) -> np.ndarray:
+    masks = [0]
+    for bits in range(1, radius + 1):
+        for positions in combinations(range(_CHUNK_BITS), bits):
+            masks.append(sum(1 << p for p in positions))
+    return np.array(masks, dtype=np.uint16)
+
+
+class HammingIndex:
+    """
+    Append-only index of 64-bit fingerprints supporting radius queries.
+
+    New fingerprints land in an unsorted tail that is scanned directly; once
+    the tail grows past a fraction of the index it is merged into the sorted
+    chunk tables, keeping inserts amortized O(log n).
+    """
+
+    def __init__(self, initial_capacity: int = 1024, min_merge: int = 4096):
+        self._fps = np.zeros(initial_capacity, dtype=np.uint64)
+        self._size = 0
+        self._indexed = 0
+        self._min_merge = min_merge
+        self._chunk_keys = [np.zeros(0, dtype=np.uint16) for _ in range(_CHUNKS)]
+        self._chunk_ids = [np.zeros(0, dtype=np.uint32) for _ in range(_CHUNKS)]
+        self._masks = {}
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, fingerprint: int) -> int:
+        """
+        Store `fingerprint` and return its id.
+        """
+        if self._size == len(self._fps):
+            grown = np.zeros(len(self._fps) * 2, dtype=np.uint64)
+            grown[: self._size] = self._fps[: self._size]
+            self._fps = grown
+        self._fps[self._size] = np.uint64(fingerprint)
+        self._size += 1
+        if self._size - self._indexed >= max(self._min_merge, self._indexed // 4):
+            self._merge()
+        return self._size - 1
+
+    def fingerprint(self, item_id: int) -> int:
+        return int(self._fps[item_id])
+
+    def _merge(self) -> None:
+        fps = self._fps[: self._size]
+        for chunk in range(_CHUNKS):
+            shift = np.uint64(_CHUNK_BITS * chunk)
+            keys = ((fps >> shift) & np.uint64(0xFFFF)).astype(np.uint16)
+            order = np.argsort(keys, kind="stable")
+            self._chunk_keys[chunk] = keys[order]
+            self._chunk_ids[chunk] = order.astype(np.uint32)
+        self._indexed = self._size
+
+    def _candidates(self, fingerprint: int, max_distance: int) -> np.ndarray:
+        chunk_radius = max_distance // _CHUNKS
+        masks = self._masks.get(chunk_radius)
+        if masks is None:
+            masks = self._masks[chunk_radius] = _chunk_masks(chunk_radius)
+        found = []
+        for chunk in range(_CHUNKS):
+            keys = self._chunk_keys[chunk]
+            if not len(keys):
+                continue
+            probe = (fingerprint >> (_CHUNK_BITS * chunk)) & 0xFFFF
+            probes = masks ^ np.uint16(probe)
+            lo = np.searchsorted(keys, probes, side="left")
+            hi = np.searchsorted(keys, probes, side="right")
+            for start, end in zip(lo[hi > lo], hi[hi > lo]):
+                found.append(self._chunk_ids[chunk][start:end])
+        if not found:
+            return np.zeros(0, dtype=np.uint32)
+        return np.unique(np.concatenate(found))
+
+    def nearest(self, fingerprint: int, max_distance: int) -> Optional[Tuple[int, int]]:
+        """
+        Return (id, distance) of the closest fingerprint within `max_distance`, or None.
+        """
+        query = np.uint64(fingerprint)
+        best_id, best_distance = -1, max_distance + 1
+
+        candidates = self._candidates(fingerprint, max_distance)
+        if len(candidates):
+            distances = _popcount(self._fps[candidates] ^ query)
+            i = int(np.argmin(distances))
+            if distances[i] < best_distance:
+                best_id, best_distance = int(candidates[i]), int(distances[i])
+
+        if self._size > self._indexed:
+            distances = _popcount(self._fps[self._indexed : self._size] ^ query)
+            i = int(np.argmin(distances))
+            if distances[i] < best_distance:
+                best_id, best_distance = self._indexed + i, int(distances[i])
+
+        if best_id < 0:
+            return None
+        return best_id, best_distance
+
+
+class NearDuplicateIndex:
+    """
+    Maps perceptual fingerprints to the SHA-256 digest of the image they came from.
+    """
+
+    def __init__(self, max_distance: int = 6):
+        self.max_distance = max_distance
+        self._index = HammingIndex()
+        self._digests = np.zeros(1024, dtype="S32")
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def add(self, fingerprint: int, digest: str) -> None:
+        item_id = self._index.add(fingerprint)
+        if item_id >= len(self._digests):
+            grown = np.zeros(len(self._digests) * 2, dtype="S32")
+            grown[: len(self._digests)] = self._digests
+            self._digests = grown
+        self._digests[item_id] = bytes.fromhex(digest)
+
+    def lookup(self, fingerprint: int) -> Optional[str]:
+        """
+        Return the digest of a previously seen near-duplicate image, or None.
+        """
+        match = self._index.nearest(fingerprint, self.max_distance)
+        if match is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self._digests[match[0]].ljust(32, b"\0").hex()
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._index),
+            "maxDistance": self.max_distance,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,168 @@
+"""
+Image preprocessing applied before an upload is sent to the vision model.
+
+Phone photos arrive as multi-megabyte JPEG/PNG/HEIC files, but GPT-4V never
+looks at more than 2048px on the long edge and 768px on the short edge. The
+upload is decoded once, rotated according to its EXIF orientation, downscaled
+to those limits, fingerprinted for near-duplicate lookup, and re-encoded with
+all metadata dropped. These functions are CPU-bound and are meant to run in a
+thread pool, off the event loop.
+"""
+
+import io
+import time
+from dataclasses import dataclass, field
+from typing import BinaryIO, Dict, Optional, Union
+
+from PIL import Image, ImageOps
+
+from src.backend.phash import phash_image
+from src.backend.uploads import read_all
+
+try:  # HEIC/HEIF support is optional
+    import pillow_heif
+
+    pillow_heif.register_heif_opener()
+except ImportError:
+    pass
+
+# Formats the model accepts that we can send without re-encoding
+_PASSTHROUGH_FORMATS = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+# Decoder info that describes how to render the pixels; anything else (EXIF,
+# XMP, comments, PNG text chunks) is metadata and forces a re-encode
+_RENDERING_INFO = {
+    "jfif", "jfif_version", "jfif_unit", "jfif_density", "dpi", "adobe", "adobe_transform", "progressive",
+    "progression", "icc_profile", "gamma", "srgb", "chromaticity", "transparency", "aspect", "interlace",
+    "background", "loop", "duration", "timestamp",
+}
+# JPEG application segments that carry no metadata: JFIF header, ICC profile, Adobe colour transform
+_RENDERING_SEGMENTS = {("APP0", b"JFIF"), ("APP2", b"ICC_PROFILE"), ("APP14", b"Adobe")}
+
+
+def _has_metadata(image: Image.Image) -> bool:
+    if any(key not in _RENDERING_INFO for key in image.info):
+        return True
+    for marker, data in getattr(image, "applist", ()):
+        if not any(marker == name and data.startswith(prefix) for name, prefix in _RENDERING_SEGMENTS):
+            return True
+    return False
+
+
+@dataclass
+class PreparedImage:
+    content: bytes
+    mime_type: str
+    width: Optional[int] = None
+    height: Optional[int] = None
+    fingerprint: Optional[int] = None
+    # Milliseconds spent in each stage, in execution order
+    timings: Dict[str, float] = field(default_factory=dict)
+
+
+def _target_size(width: int, height: int, max_edge: int, max_short_edge: int) -> tuple:
+    scale = min(1.0, max_edge / max(width, height), max_short_edge / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def prepare_image(
+    image_content: Union[bytes, BinaryIO],
+    content_type: str = "image/jpeg",
+    max_edge: int = 2048,
+    max_short_edge: int = 768,
+    quality: int = 85,
+    fingerprint: bool = True,
+) -> PreparedImage:
+    """
+    Decode, orient, downscale and re-encode an uploaded image.
+
+    `image_content` may be a binary file (e.g. a spooled upload), which is
+    decoded directly so a large upload is never read into memory whole.
+    Bytes that cannot be decoded are passed through unchanged with the
+    content type the client declared, leaving the model to reject them.
+    """
+    timings = {}
+    started = time.perf_counter()
+
+    def lap(stage: str) -> None:
+        nonlocal started
+        now = time.perf_counter()
+        timings[stage] = (now - started) * 1000
+        started = now
+
+    try:
+        if isinstance(image_content, (bytes, bytearray)):
+            source = io.BytesIO(image_content)
+        else:
+            source = image_content
+            source.seek(0)
+        image = Image.open(source)
+        source_format = image.format
+        width, height = image.size
+        target = _target_size(width, height, max_edge, max_short_edge)
+        # Let the JPEG decoder do most of the downscaling via DCT scaling
+        image.draft("RGB", target)
+        image.load()
+    except Exception:
+        lap("decode")
+        return PreparedImage(content=read_all(image_content), mime_type=content_type or "image/jpeg", timings=timings)
+    lap("decode")
+
+    has_metadata = _has_metadata(image)
+    image = ImageOps.exif_transpose(image)
+    target = _target_size(image.width, image.height, max_edge, max_short_edge)
+    resized = image.size != target
+    if resized:
+        image = image.resize(target, Image.Resampling.LANCZOS)
+    lap("resize")
+
+    image_hash = phash_image(image) if fingerprint else None
+    lap("fingerprint")
+
+    if not resized and not has_metadata and source_format in _PASSTHROUGH_FORMATS and (width, height) == image.size:
+        lap("encode")
+        return PreparedImage(
+            content=read_all(image_content),
+            mime_type=_PASSTHROUGH_FORMATS[source_format],
+            width=image.width,
+            height=image.height,
+            fingerprint=image_hash,
+            timings=timings,
+        )
+
+    # Pillow writes some info keys (e.g. the JPEG comment) back out on save
+    image.info = {key: value for key, value in image.info.items() if key in _RENDERING_INFO}
+    output = io.BytesIO()
+    has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+    if has_alpha:
+        image.save(output, format="PNG", optimize=False)
+        mime_type = "image/png"
+    else:
+        image.convert("RGB").save(output, format="JPEG", quality=quality)
+        mime_type = "image/jpeg"
+    lap("encode")
+
+    return PreparedImage(
+        content=output.getvalue(),
+        mime_type=mime_type,
+        width=image.width,
+        height=image.height,
+        fingerprint=image_hash,
+        timings=timings,
+    )
+
+
+def sample_jpeg(width: int = 64, height: int = 48) -> bytes:
+    """
+    A small solid-colour JPEG, e.g. for warming up the codecs at startup.
+    """
+    output = io.BytesIO()
+    Image.new("RGB", (width, height), (128, 96, 64)).save(output, format="JPEG")
+    return output.getvalue()
+
+
+def server_timing(timings: Dict[str, float]) -> str:
+    """
+    Format stage timings as a Server-Timing header value.
+    """
+    return ", ".join(f"{stage};dur={duration:.1f}" for stage, duration in timings.items())
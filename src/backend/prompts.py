@@ -0,0 +1,115 @@
+"""
+Versioned prompt templates and the completion budget sent with each.
+
+Every prompt the backend sends is a `PromptTemplate` with a version; the
+template key is part of the result cache key, so editing a prompt means
+adding a new version rather than changing one in place. `MaxTokensTuner`
+sizes `max_tokens` per template from the completion lengths actually
+observed: reserving 1000 tokens for an answer that never exceeds 400 makes
+every call count 600 phantom tokens against the deployment's TPM quota.
+"""
+
+import math
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict, Optional
+
+
+@dataclass(frozen=True)
+class PromptTemplate:
+    name: str
+    version: int
+    text: str
+    # Whether the answer is requested as JSON matching the response schema
+    structured: bool = False
+
+    @property
+    def key(self) -> str:
+        return f"{self.name}-v{self.version}"
+
+
+# Put in front of the prompt when one request carries several photos of the outfit
+MULTI_IMAGE_PREAMBLE = """These {count} photos show the same outfit, for example from the front, from the back and in close-up. Combine what they show into a single analysis of the whole outfit.
+
+"""
+
+TEMPLATES: Dict[str, PromptTemplate] = {template.key: template for template in (
+    PromptTemplate("markdown", 1, """Analyze this outfit and provide a structured response with the following:
+1. Description: Overall style and vibe
+2. Color Tones: Main colors and their combinations
+3. Core Apparel: Main clothing pieces
+4. Accessories: Any accessories or additional items
+5. Fashion Tips: Styling suggestions and recommendations
+6. Similar Items: Suggest 3 similar items that could be found on Nordstrom, including name, brief description, and estimated price range"""),
+    PromptTemplate("structured", 2, """Analyze this outfit and describe its overall style and vibe, its main colors and how they combine, the core clothing pieces and any accessories. Give styling suggestions as a list of short tips, and suggest 3 similar items that could be found on Nordstrom, each with a name, a brief description and an estimated price range.""", structured=True),
+    # The response schema already describes every field, so the prompt only sets length and scope
+    PromptTemplate("structured", 3, """Analyze the outfit in the photo and fill in every field. Keep each text field to one or two sentences, give 3 to 5 short styling tips and suggest 3 similar items that could be found on Nordstrom.""", structured=True),
+)}
+
+# Template used for each ANALYSIS_OUTPUT_MODE unless one is configured
+DEFAULT_TEMPLATES = {"json_schema": "structured-v3", "markdown": "markdown-v1"}
+
+
+def get_template(key: str) -> PromptTemplate:
+    try:
+        return TEMPLATES[key]
+    except KeyError:
+        raise ValueError(f"Unknown prompt template {key!r}; available: {', '.join(sorted(TEMPLATES))}") from None
+
+
+class MaxTokensTuner:
+    """
+    Per-template `max_tokens` from the `quantile` of recent completion lengths.
+
+    Until `min_samples` completions have been seen for a template it gets
+    `ceiling`. After that it gets the quantile times `headroom`, rounded up
+    to a multiple of 64, kept between `floor` and `ceiling`. A truncated
+    completion (finish reason "length") clears the template's history, so it
+    goes back to the ceiling until enough new lengths are observed.
+    """
+
+    def __init__(self, ceiling: int, floor: int = 256, quantile: float = 0.99, headroom: float = 1.25,
+                 window: int = 500, min_samples: int = 20, enabled: bool = True):
+        self.ceiling = ceiling
+        self.floor = min(floor, ceiling)
+        self.quantile = quantile
+        self.headroom = headroom
+        self.window = window
+        self.min_samples = min_samples
+        self.enabled = enabled
+        self._samples: Dict[str, Deque[int]] = {}
+        self._current: Dict[str, int] = {}
+        self.truncations: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def max_tokens(self, template: str) -> int:
+        return self._current.get(template, self.ceiling) if self.enabled else self.ceiling
+
+    def observe(self, template: str, completion_tokens: Optional[int], truncated: bool = False) -> None:
+        with self._lock:
+            samples = self._samples.setdefault(template, deque(maxlen=self.window))
+            if truncated:
+                self.truncations[template] = self.truncations.get(template, 0) + 1
+                samples.clear()
+                self._current.pop(template, None)
+                return
+            if completion_tokens is None:
+                return
+            samples.append(completion_tokens)
+            if len(samples) < self.min_samples:
+                return
+            ordered = sorted(samples)
+            observed = ordered[min(len(ordered) - 1, math.ceil(self.quantile * len(ordered)) - 1)]
+            budget = 64 * math.ceil(observed * self.headroom / 64)
+            self._current[template] = max(self.floor, min(self.ceiling, budget))
+
+    def stats(self) -> dict:
+        return {
+            template: {
+                "maxTokens": self.max_tokens(template),
+                "samples": len(self._samples.get(template, ())),
+                "truncations": self.truncations.get(template, 0),
+            }
+            for template in sorted(set(self._samples) | set(self.truncations))
+        }
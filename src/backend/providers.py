@@ -0,0 +1,410 @@
+"""
+Vision model backends and the router that spreads requests across them.
+
+Each backend wraps one deployment (an Azure OpenAI deployment in some
+region, or a Gemini model) behind the same two calls: `complete` for a whole
+response and `stream` for text deltas. `BackendRouter` picks a backend per
+request (least outstanding requests, or latency-weighted), tracks health so a
+failing deployment is skipped for a while, fails over when a backend is
+rate limited or unavailable, and hedges slow requests by firing a second
+call at another backend once the first runs past its p95 latency.
+"""
+
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from src.backend.metrics import UPSTREAM_SECONDS, UPSTREAM_TOKENS, observe_stage
+from src.backend.upstream import UpstreamClient, UpstreamRateLimited, UpstreamUnavailable
+from src.backend.uploads import data_url
+
+
+@dataclass
+class VisionRequest:
+    prompt: str
+    # (bytes, mime type) for each image
+    images: List[Tuple[bytes, str]]
+    max_tokens: int
+    temperature: float = 0.7
+    response_format: Optional[dict] = None
+    estimated_tokens: int = 0
+    # "low" or "high" for each image; None lets the model decide
+    details: Optional[List[str]] = None
+
+
+@dataclass
+class Completion:
+    text: str
+    backend: str = ""
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    # "stop", or "length" when the answer was cut off by max_tokens
+    finish_reason: Optional[str] = None
+
+
+def openai_messages(prompt: str, images: List[Tuple[bytes, str]], details: Optional[List[str]] = None) -> list:
+    """
+    Build the chat messages carrying the prompt and the base64-encoded images,
+    with each image's detail level when `details` is given.
+    """
+    started = time.perf_counter()
+    content = [{"type": "text", "text": prompt}]
+    for i, (image_content, mime_type) in enumerate(images):
+        image_url = {"url": data_url(image_content, mime_type)}
+        if details is not None:
+            image_url["detail"] = details[i]
+        content.append({"type": "image_url", "image_url": image_url})
+    observe_stage("base64", time.perf_counter() - started, started)
+    return [{"role": "user", "content": content}]
+
+
+class VisionBackend:
+    name = "backend"
+
+    def healthy(self) -> bool:
+        return True
+
+    async def complete(self, request: VisionRequest) -> Completion:
+        raise NotImplementedError
+
+    def stream(self, request: VisionRequest, usage: Optional[Completion] = None) -> AsyncIterator[str]:
+        """
+        Yield text deltas; when `usage` is given, fill in its token counts and
+        finish reason as the provider reports them.
+        """
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        return {}
+
+
+class AzureOpenAIBackend(VisionBackend):
+    def __init__(self, name: str, upstream: UpstreamClient, deployment: str):
+        self.name = name
+        self.upstream = upstream
+        self.deployment = deployment
+
+    def healthy(self) -> bool:
+        return self.upstream.breaker.state != "open"
+
+    def _arguments(self, request: VisionRequest) -> dict:
+        arguments = {
+            "model": self.deployment,  # Use the deployment name as the model
+            "messages": openai_messages(request.prompt, request.images, request.details),
+            "max_tokens": request.max_tokens,
+            "temperature": request.temperature,
+        }
+        if request.response_format is not None:
+            arguments["response_format"] = request.response_format
+        return arguments
+
+    async def complete(self, request: VisionRequest) -> Completion:
+        response = await self.upstream.create(estimated_tokens=request.estimated_tokens, **self._arguments(request))
+        usage = getattr(response, "usage", None)
+        prompt_tokens = getattr(usage, "prompt_tokens", None)
+        completion_tokens = getattr(usage, "completion_tokens", None)
+        finish_reason = getattr(response.choices[0], "finish_reason", None)
+        return Completion(
+            text=response.choices[0].message.content,
+            backend=self.name,
+            prompt_tokens=prompt_tokens if isinstance(prompt_tokens, int) else None,
+            completion_tokens=completion_tokens if isinstance(completion_tokens, int) else None,
+            finish_reason=finish_reason if isinstance(finish_reason, str) else None,
+        )
+
+    async def stream(self, request: VisionRequest, usage: Optional[Completion] = None) -> AsyncIterator[str]:
+        stream = await self.upstream.create(
+            estimated_tokens=request.estimated_tokens, stream=True,
+            # The last chunk then carries the token counts, with no choices
+            stream_options={"include_usage": True},
+            **self._arguments(request),
+        )
+        async for chunk in stream:
+            if usage is not None:
+                chunk_usage = getattr(chunk, "usage", None)
+                prompt_tokens = getattr(chunk_usage, "prompt_tokens", None)
+                completion_tokens = getattr(chunk_usage, "completion_tokens", None)
+                if isinstance(prompt_tokens, int):
+                    usage.prompt_tokens = prompt_tokens
+                if isinstance(completion_tokens, int):
+                    usage.completion_tokens = completion_tokens
+                if chunk.choices and isinstance(chunk.choices[0].finish_reason, str):
+                    usage.finish_reason = chunk.choices[0].finish_reason
+            # Azure sends content-filter chunks without choices
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    def stats(self) -> dict:
+        return self.upstream.stats()
+
+
+class GeminiBackend(VisionBackend):
+    """
+    Google Gemini via google-generativeai, imported on first use.
+    """
+
+    def __init__(self, name: str, model: str, api_key: str):
+        self.name = name
+        self.model_name = model
+        self.api_key = api_key
+        self._model = None
+
+    def _get_model(self):
+        if self._model is None:
+            import google.generativeai as genai
+
+            genai.configure(api_key=self.api_key)
+            self._model = genai.GenerativeModel(self.model_name)
+        return self._model
+
+    def _arguments(self, request: VisionRequest) -> dict:
+        parts = [request.prompt] + [{"mime_type": mime, "data": data} for data, mime in request.images]
+        config = {"max_output_tokens": request.max_tokens, "temperature": request.temperature}
+        if request.response_format is not None:
+            config["response_mime_type"] = "application/json"
+        return {"contents": parts, "generation_config": config}
+
+    async def complete(self, request: VisionRequest) -> Completion:
+        response = await self._get_model().generate_content_async(**self._arguments(request))
+        usage = getattr(response, "usage_metadata", None)
+        return Completion(
+            text=response.text,
+            backend=self.name,
+            prompt_tokens=getattr(usage, "prompt_token_count", None),
+            completion_tokens=getattr(usage, "candidates_token_count", None),
+        )
+
+    async def stream(self, request: VisionRequest, usage: Optional[Completion] = None) -> AsyncIterator[str]:
+        response = await self._get_model().generate_content_async(stream=True, **self._arguments(request))
+        async for chunk in response:
+            metadata = getattr(chunk, "usage_metadata", None)
+            if usage is not None and metadata is not None:
+                usage.prompt_tokens = getattr(metadata, "prompt_token_count", usage.prompt_tokens)
+                usage.completion_tokens = getattr(metadata, "candidates_token_count", usage.completion_tokens)
+            if chunk.text:
+                yield chunk.text
+
+
+# Failures that say "try somewhere else" rather than "this request is bad"
+FAILOVER_ERRORS = (UpstreamRateLimited, UpstreamUnavailable)
+
+
+@dataclass
+class BackendState:
+    backend: VisionBackend
+    outstanding: int = 0
+    requests: int = 0
+    failures: int = 0
+    hedges: int = 0
+    consecutive_failures: int = 0
+    unhealthy_until: float = 0.0
+    ewma_latency: Optional[float] = None
+    latencies: deque = field(default_factory=lambda: deque(maxlen=256))
+
+    def healthy(self, now: float) -> bool:
+        return now >= self.unhealthy_until and self.backend.healthy()
+
+    def quantile(self, q: float) -> Optional[float]:
+        if len(self.latencies) < 20:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class BackendRouter:
+    def __init__(
+        self,
+        backends: List[VisionBackend],
+        strategy: str = "least_outstanding",
+        hedge: bool = True,
+        hedge_quantile: float = 0.95,
+        hedge_min_delay: float = 1.0,
+        max_hedge_ratio: float = 0.1,
+        failure_threshold: int = 3,
+        cooldown: float = 30.0,
+    ):
+        if not backends:
+            raise ValueError("At least one vision backend is required")
+        if strategy not in ("least_outstanding", "latency"):
+            raise ValueError(f"Unknown routing strategy: {strategy}")
+        self.states: Dict[str, BackendState] = {b.name: BackendState(b) for b in backends}
+        self.strategy = strategy
+        self.hedge = hedge and len(backends) > 1
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay
+        self.max_hedge_ratio = max_hedge_ratio
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._requests = 0
+        self._hedges = 0
+
+    def _score(self, state: BackendState) -> tuple:
+        latency = state.ewma_latency or 0.0
+        if self.strategy == "latency":
+            return (latency * (state.outstanding + 1), state.outstanding)
+        return (state.outstanding, latency)
+
+    def select(self, exclude: Tuple[str, ...] = ()) -> Optional[BackendState]:
+        now = time.monotonic()
+        candidates = [s for name, s in self.states.items() if name not in exclude]
+        healthy = [s for s in candidates if s.healthy(now)]
+        # With nothing healthy, the least bad backend is better than a certain failure
+        pool = healthy or candidates
+        if not pool:
+            return None
+        return min(pool, key=self._score)
+
+    def _record(self, state: BackendState, started: float, error: Optional[BaseException]) -> None:
+        latency = time.monotonic() - started
+        if isinstance(error, asyncio.CancelledError):
+            UPSTREAM_SECONDS.labels(state.backend.name, "cancelled").observe(latency)
+            return
+        UPSTREAM_SECONDS.labels(state.backend.name, "error" if error is not None else "ok").observe(latency)
+        if error is None:
+            state.latencies.append(latency)
+            state.ewma_latency = latency if state.ewma_latency is None else 0.8 * state.ewma_latency + 0.2 * latency
+            state.consecutive_failures = 0
+            return
+        state.failures += 1
+        if isinstance(error, FAILOVER_ERRORS):
+            state.consecutive_failures += 1
+            if state.consecutive_failures >= self.failure_threshold:
+                state.unhealthy_until = time.monotonic() + self.cooldown
+
+    async def _call(self, state: BackendState, request: VisionRequest) -> Completion:
+        state.outstanding += 1
+        state.requests += 1
+        started = time.monotonic()
+        error = None
+        try:
+            completion = await state.backend.complete(request)
+            if completion.prompt_tokens is not None:
+                UPSTREAM_TOKENS.labels(state.backend.name, "prompt").inc(completion.prompt_tokens)
+            if completion.completion_tokens is not None:
+                UPSTREAM_TOKENS.labels(state.backend.name, "completion").inc(completion.completion_tokens)
+            return completion
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            state.outstanding -= 1
+            self._record(state, started, error)
+
+    def _hedge_delay(self, state: BackendState) -> Optional[float]:
+        if not self.hedge or self._hedges >= self.max_hedge_ratio * self._requests:
+            return None
+        threshold = state.quantile(self.hedge_quantile)
+        if threshold is None:
+            return None
+        return max(self.hedge_min_delay, threshold)
+
+    async def complete(self, request: VisionRequest) -> Completion:
+        """
+        Run the request on the best backend, hedging or failing over as needed.
+        """
+        self._requests += 1
+        tried: Tuple[str, ...] = ()
+        while True:
+            primary = self.select(tried)
+            tried += (primary.backend.name,)
+            try:
+                return await self._complete_hedged(primary, request, tried)
+            except FAILOVER_ERRORS:
+                if self.select(tried) is None:
+                    raise
+
+    async def _complete_hedged(self, primary: BackendState, request: VisionRequest, tried: Tuple[str, ...]) -> Completion:
+        first = asyncio.ensure_future(self._call(primary, request))
+        second = None
+        try:
+            delay = self._hedge_delay(primary)
+            if delay is None:
+                return await first
+
+            done, _ = await asyncio.wait({first}, timeout=delay)
+            secondary = None if done else self.select(tried)
+            if secondary is None:
+                return await first
+
+            self._hedges += 1
+            secondary.hedges += 1
+            second = asyncio.ensure_future(self._call(secondary, request))
+        except BaseException:
+            # asyncio.wait does not cancel what it waits on: a caller cancelled
+            # during the hedge delay must not leave the upstream call running
+            first.cancel()
+            if second is not None:
+                second.cancel()
+            raise
+        pending = {first, second}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                if not pending:
+                    # Both failed; report the primary's error
+                    return first.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def stream(self, request: VisionRequest, usage: Optional[Completion] = None) -> AsyncIterator[str]:
+        """
+        Stream from the best backend. Streams are not hedged; once the first
+        delta has arrived the request is committed to that backend. `usage`,
+        when given, receives the backend that answered and the token counts
+        and finish reason it reported.
+        """
+        self._requests += 1
+        tried: Tuple[str, ...] = ()
+        while True:
+            state = self.select(tried)
+            tried += (state.backend.name,)
+            state.outstanding += 1
+            state.requests += 1
+            started = time.monotonic()
+            error = None
+            received = False
+            if usage is not None:
+                usage.backend = state.backend.name
+            try:
+                async for delta in state.backend.stream(request, usage):
+                    received = True
+                    yield delta
+                if usage is not None:
+                    if usage.prompt_tokens is not None:
+                        UPSTREAM_TOKENS.labels(state.backend.name, "prompt").inc(usage.prompt_tokens)
+                    if usage.completion_tokens is not None:
+                        UPSTREAM_TOKENS.labels(state.backend.name, "completion").inc(usage.completion_tokens)
+                return
+            except FAILOVER_ERRORS as e:
+                error = e
+                if received or self.select(tried) is None:
+                    raise
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                state.outstanding -= 1
+                self._record(state, started, error)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        backends = {}
+        for name, state in self.states.items():
+            p95 = state.quantile(0.95)
+            backends[name] = {
+                "healthy": state.healthy(now),
+                "outstanding": state.outstanding,
+                "requests": state.requests,
+                "failures": state.failures,
+                "hedges": state.hedges,
+                "ewmaLatencyMs": round(state.ewma_latency * 1000, 1) if state.ewma_latency is not None else None,
+                "p95LatencyMs": round(p95 * 1000, 1) if p95 is not None else None,
+                **state.backend.stats(),
+            }
+        return {"strategy": self.strategy, "hedging": self.hedge, "hedgedRequests": self._hedges, "backends": backends}
@@ -0,0 +1,138 @@
+"""
+In-process scheduler that bounds the number of concurrent upstream LLM calls.
+
+Requests beyond `max_in_flight` wait in a FIFO queue; once the queue holds
+`max_queue` waiters, new requests are rejected immediately instead of piling
+up behind a saturated upstream. Every admitted request runs under a deadline
+that covers both its time in the queue and the upstream call itself.
+"""
+
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Awaitable, Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+# Absolute deadline (time.monotonic()) of the request being run, for code
+# further down the call chain (e.g. upstream retries) that must respect it
+current_deadline: ContextVar[Optional[float]] = ContextVar("current_deadline", default=None)
+
+
+class SchedulerOverloaded(Exception):
+    """Raised when the wait queue is full and a request is rejected."""
+
+
+class SchedulerTimeout(Exception):
+    """Raised when a request does not finish within its deadline."""
+
+
+class AnalysisScheduler:
+    def __init__(self, max_in_flight: int = 32, max_queue: int = 256, timeout: Optional[float] = 60.0):
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1")
+        if max_queue < 0:
+            raise ValueError("max_queue must not be negative")
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._in_flight = 0
+        self._waiters: deque = deque()
+        self.rejected = 0
+        self.timed_out = 0
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    async def _acquire(self) -> None:
+        if self._in_flight < self.max_in_flight and not self._waiters:
+            self._in_flight += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            raise SchedulerOverloaded(
+                f"Too many pending analyses ({self._in_flight} running, {len(self._waiters)} queued)"
+            )
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed to us just as we were cancelled; pass it on.
+                self._release()
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            raise
+
+    def _release(self) -> None:
+        # Hand the slot directly to the next live waiter so the in-flight
+        # count never dips below the limit while work is queued.
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._in_flight -= 1
+
+    async def run(self, func: Callable[[], Awaitable[T]], timeout: Optional[float] = None) -> T:
+        """
+        Run `func()` once a slot is available, enforcing the request deadline.
+        """
+        deadline = self.timeout if timeout is None else timeout
+        started = time.monotonic()
+
+        async def admitted() -> T:
+            await self._acquire()
+            current_deadline.set(started + deadline)
+            try:
+                return await func()
+            finally:
+                self._release()
+
+        try:
+            return await asyncio.wait_for(admitted(), deadline)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            raise SchedulerTimeout(
+                f"Analysis did not complete within {deadline:.1f}s "
+                f"(waited {time.monotonic() - started:.1f}s)"
+            )
+
+    @asynccontextmanager
+    async def slot(self, timeout: Optional[float] = None) -> AsyncIterator[float]:
+        """
+        Hold a slot for work that cannot be expressed as a single awaitable,
+        such as relaying a stream. Yields the request's absolute deadline
+        (in `time.monotonic()` terms), which the caller is expected to honour.
+        """
+        deadline = self.timeout if timeout is None else timeout
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(self._acquire(), deadline)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            raise SchedulerTimeout(f"No analysis slot became free within {deadline:.1f}s")
+        token = current_deadline.set(started + deadline)
+        try:
+            yield started + deadline
+        finally:
+            current_deadline.reset(token)
+            self._release()
+
+    def stats(self) -> dict:
+        return {
+            "inFlight": self._in_flight,
+            "queued": len(self._waiters),
+            "maxInFlight": self.max_in_flight,
+            "maxQueue": self.max_queue,
+            "rejected": self.rejected,
+            "timedOut": self.timed_out,
+        }
@@ -0,0 +1,86 @@
+"""
+Typed models for the analysis payload and for the model's structured output.
+
+`StructuredAnalysis` mirrors the JSON the vision model is asked to return in
+structured-output mode; its JSON schema is what we send as `response_format`.
+Validation is lenient (missing fields default to empty, unknown keys are
+ignored) so a slightly off-schema answer still yields everything it contains.
+"""
+
+from typing import List
+
+from pydantic import BaseModel, ConfigDict, Field
+
+# Schema-only settings: OpenAI strict mode needs every property listed as
+# required and additionalProperties disabled, while validation stays lenient.
+_MODEL_OUTPUT_CONFIG = ConfigDict(
+    json_schema_extra={"additionalProperties": False},
+    json_schema_serialization_defaults_required=True,
+)
+
+
+class SimilarItem(BaseModel):
+    model_config = _MODEL_OUTPUT_CONFIG
+
+    name: str = Field("", description="Product name")
+    description: str = Field("", description="One-sentence description of the item")
+    priceRange: str = Field("", description="Estimated price range, e.g. '$80 - $120'")
+
+
+class StructuredAnalysis(BaseModel):
+    model_config = _MODEL_OUTPUT_CONFIG
+
+    description: str = Field("", description="Overall style and vibe of the outfit")
+    colorTones: str = Field("", description="Main colors and their combinations")
+    coreApparel: str = Field("", description="Main clothing pieces")
+    accessories: str = Field("", description="Accessories or additional items")
+    fashionTips: List[str] = Field(default_factory=list, description="Styling suggestions")
+    similarItems: List[SimilarItem] = Field(
+        default_factory=list, description="Three similar items that could be found on Nordstrom"
+    )
+
+
+class OutfitAnalysis(BaseModel):
+    description: str = ""
+    colorTones: str = ""
+    coreApparel: str = ""
+    accessories: str = ""
+
+
+class SuggestedItem(BaseModel):
+    name: str = ""
+    description: str = ""
+    imageUrl: str = ""
+    productUrl: str = ""
+
+
+class AnalysisResponse(BaseModel):
+    """
+    The payload returned by /api/analyze.
+    """
+    analysis: OutfitAnalysis
+    fashionTips: List[str]
+    suggestedItems: List[SuggestedItem]
+
+
+def _strip_defaults(schema):
+    # Strict mode rejects the "default" keyword
+    if isinstance(schema, dict):
+        return {key: _strip_defaults(value) for key, value in schema.items() if key != "default"}
+    if isinstance(schema, list):
+        return [_strip_defaults(value) for value in schema]
+    return schema
+
+
+def response_format() -> dict:
+    """
+    Build the `response_format` argument requesting `StructuredAnalysis` JSON.
+    """
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "outfit_analysis",
+            "strict": True,
+            "schema": _strip_defaults(StructuredAnalysis.model_json_schema(mode="serialization")),
+        },
+    }
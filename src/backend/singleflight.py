@@ -0,0 +1,80 @@
+"""
+Single-flight deduplication of concurrent identical work.
+
+When the same image is uploaded many times at once, every request misses the
+cache before the first analysis has finished. `SingleFlight.do(key, func)`
+runs `func()` once per key at a time: the first caller starts it as a
+separate task and later callers with the same key await that task, so all of
+them receive its result or its exception.
+
+The shared task belongs to no single caller. A caller that goes away (e.g.
+a client disconnect cancelling its request) only stops waiting; the task is
+cancelled only when its last waiter has gone, so the remaining requests are
+not failed by someone else's disconnect.
+"""
+
+import asyncio
+from typing import Awaitable, Callable, Dict, TypeVar
+
+T = TypeVar("T")
+
+
+class _Flight:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Future):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+        self.started = 0
+        self.coalesced = 0
+        self.abandoned = 0
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    def _finished(self, key: str, flight: _Flight) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        # Mark the outcome as retrieved even if every waiter has left
+        if not flight.task.cancelled():
+            flight.task.exception()
+
+    async def do(self, key: str, func: Callable[[], Awaitable[T]]) -> T:
+        """
+        Return the result of `func()`, sharing one call among concurrent callers with the same `key`.
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(func()))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _, key=key, flight=flight: self._finished(key, flight))
+            self.started += 1
+        else:
+            self.coalesced += 1
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if not flight.task.done() and flight.waiters == 1:
+                # Last one out: nobody wants the result any more
+                self.abandoned += 1
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+
+    def stats(self) -> dict:
+        return {
+            "inFlight": len(self._flights),
+            "started": self.started,
+            "coalesced": self.coalesced,
+            "abandoned": self.abandoned,
+        }
@@ -0,0 +1,424 @@
+"""
+Rate-limit-aware wrapper around the chat completions call.
+
+Azure OpenAI deployments are provisioned with a requests-per-minute and a
+tokens-per-minute quota. `UpstreamClient` keeps local token buckets for both
+so bursts queue briefly instead of being bounced by the service, retries
+429s and transient failures with jittered backoff (honouring `Retry-After`)
+as long as the request deadline allows, and opens a circuit breaker when the
+upstream keeps failing so requests fail fast instead of piling up.
+`pooled_http_client` builds the HTTP connection pool the SDK clients use.
+"""
+
+import asyncio
+import email.utils
+import importlib.util
+import math
+import random
+import time
+from typing import Awaitable, Callable, List, Optional, Sequence, Tuple
+
+from src.backend.scheduler import current_deadline
+
+# Prompt text plus chat formatting overhead, in tokens
+PROMPT_TOKEN_ALLOWANCE = 200
+
+
+class UpstreamRateLimited(Exception):
+    """The request could not be sent within its deadline because of rate limits."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class UpstreamUnavailable(Exception):
+    """The upstream is failing (circuit open or retries exhausted)."""
+
+    def __init__(self, message: str, retry_after: float = 1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def estimate_image_tokens(width: Optional[int], height: Optional[int], detail: str = "high") -> int:
+    """
+    Estimate the prompt tokens an image costs, following OpenAI's tiling rules.
+    """
+    if detail == "low":
+        return 85
+    if not width or not height:
+        # Worst case for an image already capped to 2048x768
+        width, height = 2048, 768
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / 512) * math.ceil(height / 512)
+    return 85 + 170 * tiles
+
+
+def estimate_request_tokens(width: Optional[int], height: Optional[int], max_tokens: int, detail: str = "high") -> int:
+    """
+    Upper-bound estimate of the tokens a request will count against the TPM quota.
+    """
+    return estimate_image_tokens(width, height, detail) + PROMPT_TOKEN_ALLOWANCE + max_tokens
+
+
+def choose_detail(width: Optional[int], height: Optional[int], low_detail_max_edge: int = 512) -> str:
+    """
+    Pick an image's detail level from its size.
+
+    At low detail the model sees the image scaled to fit 512x512 for 85
+    tokens. An image that already fits inside that box gains nothing from
+    high detail except a 170-token tile. Raising `low_detail_max_edge` trades
+    some fidelity for tokens. 0 keeps every image at high detail.
+    """
+    if width and height and max(width, height) <= low_detail_max_edge:
+        return "low"
+    return "high"
+
+
+def choose_detail_levels(sizes: Sequence[Tuple[Optional[int], Optional[int]]], budget: int,
+                         low_detail_max_edge: int = 0) -> List[str]:
+    """
+    Pick "high" or "low" detail for each image so their estimated tokens fit `budget`.
+
+    Each image starts at the level `choose_detail` gives it for its size. The
+    image that costs the most is then switched to low detail first, because
+    that saves the most tokens for each image degraded. Ties go to the later
+    image, so the first photo (usually the whole outfit) keeps its detail
+    longest. A `budget` of 0 or less means no limit.
+    """
+    details = [choose_detail(width, height, low_detail_max_edge) for width, height in sizes]
+    costs = [estimate_image_tokens(width, height, detail) for (width, height), detail in zip(sizes, details)]
+    total = sum(costs)
+    if budget <= 0:
+        return details
+    for index in sorted(range(len(sizes)), key=lambda i: (-costs[i], -i)):
+        if total <= budget or details[index] == "low":
+            break
+        details[index] = "low"
+        total -= costs[index] - estimate_image_tokens(None, None, "low")
+    return details
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at `per_minute` units per minute.
+
+    Reservations may drive the level negative; the deficit is the time the
+    caller must wait, which serves concurrent callers in arrival order.
+    """
+
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity if capacity is not None else per_minute
+        self._level = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._level = min(self.capacity, self._level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, amount: float, max_wait: float) -> Optional[float]:
+        """
+        Reserve `amount` units and return how long to wait before using them,
+        or None (reserving nothing) if that would take longer than `max_wait`.
+        """
+        self._refill()
+        amount = min(amount, self.capacity)
+        wait = max(0.0, (amount - self._level) / self.rate)
+        if wait > max_wait:
+            return None
+        self._level -= amount
+        return wait
+
+    def refund(self, amount: float) -> None:
+        """
+        Return units that were reserved but not used (e.g. an over-estimate).
+        """
+        self._refill()
+        self._level = min(self.capacity, self._level + amount)
+
+    @property
+    def level(self) -> float:
+        self._refill()
+        return self._level
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures and rejects calls
+    for `reset_timeout` seconds, then lets a single trial call through.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_in_progress = False
+        self.trips = 0
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def retry_after(self) -> float:
+        if self._opened_at is None:
+            return 0.0
+        return max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self._trial_in_progress:
+            self._trial_in_progress = True
+            return True
+        return False
+
+    def release_trial(self) -> None:
+        """
+        Give up a trial slot without a verdict, e.g. when the call was never made.
+        """
+        self._trial_in_progress = False
+
+    def record_success(self) -> None:
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_progress = False
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        if self._trial_in_progress or self._failures >= self.failure_threshold:
+            if self._opened_at is None or self._trial_in_progress:
+                self.trips += 1
+            self._opened_at = time.monotonic()
+        self._trial_in_progress = False
+
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """
+    Read the server's Retry-After hint (retry-after-ms or retry-after) from an API error.
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            try:
+                return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    return None
+
+
+def is_retryable(error: Exception) -> bool:
+    # Imported here rather than at module level: the SDK takes ~0.5s to import,
+    # and any error it raised means it is loaded already
+    import openai
+
+    if isinstance(error, (openai.RateLimitError, openai.APIConnectionError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+def pooled_http_client(
+    max_connections: int = 100,
+    max_keepalive_connections: Optional[int] = None,
+    keepalive_expiry: float = 30.0,
+    connect_timeout: float = 5.0,
+    read_timeout: float = 60.0,
+    pool_timeout: float = 10.0,
+    http2: Optional[bool] = None,
+):
+    """
+    Build an HTTP client for an SDK client, with explicit pool limits and timeouts.
+
+    Connections are kept alive for `keepalive_expiry` seconds (the SDK keeps
+    them for 5), and by default as many are kept as may be open, so a burst
+    after a quiet spell reuses connections instead of paying TLS handshakes.
+    Timeouts apply per phase: connecting, waiting for a pooled connection,
+    and each read; the overall deadline is enforced by the scheduler. HTTP/2
+    is used when `h2` is installed, unless `http2` says otherwise.
+    """
+    import openai
+
+    if http2 is None:
+        http2 = importlib.util.find_spec("h2") is not None
+    # The SDK's own HTTP library (httpx, or its fork in newer SDK versions) supplies Limits
+    limits = type(openai.DEFAULT_CONNECTION_LIMITS)(
+        max_connections=max_connections,
+        max_keepalive_connections=max_keepalive_connections if max_keepalive_connections is not None else max_connections,
+        keepalive_expiry=keepalive_expiry,
+    )
+    timeout = openai.Timeout(read_timeout, connect=connect_timeout, pool=pool_timeout)
+    return openai.DefaultAsyncHttpxClient(limits=limits, timeout=timeout, http2=http2)
+
+
+def pool_stats(http_client) -> Optional[dict]:
+    """
+    Connection counts of a client's pool, or None if its transport does not expose them.
+    """
+    pool = getattr(getattr(http_client, "_transport", None), "_pool", None)
+    connections = getattr(pool, "connections", None)
+    if connections is None:
+        return None
+    idle = sum(1 for connection in connections if connection.is_idle())
+    requests = getattr(pool, "_requests", ())
+    return {
+        "connections": len(connections),
+        "active": len(connections) - idle,
+        "idle": idle,
+        "waiting": sum(1 for request in requests if request.is_queued()),
+        "http2": bool(getattr(pool, "_http2", False)),
+    }
+
+
+class UpstreamClient:
+    def __init__(
+        self,
+        create: Callable[..., Awaitable],
+        requests_per_minute: float = 0,
+        tokens_per_minute: float = 0,
+        max_retries: int = 3,
+        base_delay: float = 0.5,
+        max_delay: float = 8.0,
+        breaker: Optional[CircuitBreaker] = None,
+        default_timeout: float = 60.0,
+    ):
+        self._create = create
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute > 0 else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute > 0 else None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker or CircuitBreaker()
+        self.default_timeout = default_timeout
+        self.calls = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.failures = 0
+
+    def _remaining(self) -> float:
+        deadline = current_deadline.get()
+        if deadline is None:
+            return self.default_timeout
+        return deadline - time.monotonic()
+
+    async def _admit(self, estimated_tokens: int) -> None:
+        remaining = self._remaining()
+        request_wait = 0.0
+        if self.request_bucket is not None:
+            request_wait = self.request_bucket.reserve(1, remaining)
+            if request_wait is None:
+                self.rate_limited += 1
+                raise UpstreamRateLimited("Request quota exhausted", retry_after=1 / self.request_bucket.rate)
+        if self.token_bucket is not None:
+            token_wait = self.token_bucket.reserve(estimated_tokens, remaining)
+            if token_wait is None:
+                if self.request_bucket is not None:
+                    self.request_bucket.refund(1)
+                self.rate_limited += 1
+                retry_after = estimated_tokens / self.token_bucket.rate
+                raise UpstreamRateLimited("Token quota exhausted", retry_after=retry_after)
+            request_wait = max(request_wait, token_wait)
+        if request_wait > 0:
+            await asyncio.sleep(request_wait)
+
+    def _backoff(self, attempt: int, hint: Optional[float]) -> float:
+        # Full jitter keeps retrying clients from synchronizing into waves
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if hint is not None:
+            delay = max(delay, hint) + random.uniform(0, self.base_delay)
+        return delay
+
+    async def create(self, estimated_tokens: int = 0, **kwargs):
+        """
+        Call the chat completions API within the request's quota and deadline.
+
+        Raises UpstreamRateLimited when quota cannot be obtained in time,
+        UpstreamUnavailable when the breaker is open or transient failures
+        outlast the retries, and re-raises any non-retryable error as is.
+        """
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise UpstreamUnavailable(
+                    "Upstream is failing; circuit breaker is open",
+                    retry_after=max(1.0, self.breaker.retry_after()),
+                )
+            try:
+                await self._admit(estimated_tokens)
+            except BaseException:
+                # No quota in time, or the caller gave up waiting: the trial call was never made
+                self.breaker.release_trial()
+                raise
+
+            self.calls += 1
+            try:
+                response = await self._create(**kwargs)
+            except Exception as e:
+                if not is_retryable(e):
+                    # Caller errors (bad request, auth) say nothing about upstream health
+                    self.breaker.release_trial()
+                    raise
+                rate_limited = getattr(e, "status_code", None) == 429
+                if rate_limited:
+                    # Throttling is neither a failure nor proof of health
+                    self.rate_limited += 1
+                    self.breaker.release_trial()
+                else:
+                    self.failures += 1
+                    self.breaker.record_failure()
+
+                hint = retry_after_seconds(e)
+                delay = self._backoff(attempt, hint)
+                if attempt >= self.max_retries or delay >= self._remaining():
+                    retry_after = hint if hint is not None else self.base_delay * 2 ** attempt
+                    if rate_limited:
+                        raise UpstreamRateLimited(f"Upstream rate limit: {e}", retry_after=retry_after)
+                    raise UpstreamUnavailable(f"Upstream error: {e}", retry_after=retry_after)
+                attempt += 1
+                self.retries += 1
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                # Cancelled mid-call (deadline, losing hedge, client gone): no verdict, free the trial slot
+                self.breaker.release_trial()
+                raise
+
+            self.breaker.record_success()
+            usage = getattr(response, "usage", None)
+            total_tokens = getattr(usage, "total_tokens", None)
+            if self.token_bucket is not None and isinstance(total_tokens, int) and total_tokens < estimated_tokens:
+                self.token_bucket.refund(estimated_tokens - total_tokens)
+            return response
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "retries": self.retries,
+            "rateLimited": self.rate_limited,
+            "failures": self.failures,
+            "circuit": self.breaker.state,
+            "circuitTrips": self.breaker.trips,
+            "requestBudget": round(self.request_bucket.level, 1) if self.request_bucket else None,
+            "tokenBudget": round(self.token_bucket.level, 1) if self.token_bucket else None,
+        }
@@ -0,0 +1,163 @@
+"""
+Per-request token, cost and latency accounting, kept in a local SQLite file.
+
+Every model call made for an analysis is recorded with its prompt template,
+image detail levels, `max_tokens`, the tokens the provider reported, its
+cost at the configured prices and its latency. Rows are buffered and
+written in batches, because a commit per request would cost more than the
+bookkeeping is worth. The batches are written by a single background
+thread, so recording a call from the request path never waits for SQLite.
+`summary()` aggregates the rows per template so that prompt and budget
+changes can be compared on real traffic.
+"""
+
+import json
+import logging
+import sqlite3
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def request_cost(prompt_tokens: Optional[int], completion_tokens: Optional[int],
+                 prompt_price: float, completion_price: float) -> Optional[float]:
+    """
+    Cost of one call at per-1K-token prices, or None when the provider reported no usage.
+    """
+    if prompt_tokens is None and completion_tokens is None:
+        return None
+    return ((prompt_tokens or 0) * prompt_price + (completion_tokens or 0) * completion_price) / 1000
+
+
+class UsageLedger:
+    """
+    Usage rows in a SQLite file, opened on first use. An empty path keeps nothing.
+    """
+
+    def __init__(self, path: str, batch_size: int = 32, flush_interval: float = 5.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._db = None
+        self._pending: List[tuple] = []
+        self._flushed_at = time.monotonic()
+        self._lock = threading.Lock()
+        # One writer, so batches are committed in the order they were taken
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="usage")
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            # A crash may lose the last few rows, never corrupt the file
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS usage ("
+                "id INTEGER PRIMARY KEY, created_at REAL NOT NULL, template TEXT NOT NULL, backend TEXT, "
+                "images INTEGER NOT NULL, details TEXT, max_tokens INTEGER NOT NULL, prompt_tokens INTEGER, "
+                "completion_tokens INTEGER, finish_reason TEXT, latency_ms REAL NOT NULL, cost REAL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS usage_by_time ON usage (created_at)")
+            self._db = db
+        return self._db
+
+    def record(self, template: str, backend: str, details: List[str], max_tokens: int,
+               prompt_tokens: Optional[int], completion_tokens: Optional[int], finish_reason: Optional[str],
+               latency: float, cost: Optional[float]) -> None:
+        if not self.path:
+            return
+        row = (time.time(), template, backend, len(details), json.dumps(details), max_tokens, prompt_tokens,
+               completion_tokens, finish_reason, round(latency * 1000, 3), cost)
+        with self._lock:
+            self._pending.append(row)
+            if len(self._pending) < self.batch_size and time.monotonic() - self._flushed_at < self.flush_interval:
+                return
+            rows = self._take()
+        self._writer.submit(self._write, rows)
+
+    def _take(self) -> List[tuple]:
+        rows, self._pending = self._pending, []
+        self._flushed_at = time.monotonic()
+        return rows
+
+    def _write(self, rows: List[tuple]) -> None:
+        if not rows:
+            return
+        try:
+            db = self._connect()
+            db.execute("BEGIN")
+            db.executemany(
+                "INSERT INTO usage (created_at, template, backend, images, details, max_tokens, prompt_tokens, "
+                "completion_tokens, finish_reason, latency_ms, cost) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            db.execute("COMMIT")
+        except sqlite3.Error:
+            logger.exception("Could not record %d usage rows", len(rows))
+            if self._db is not None and self._db.in_transaction:
+                self._db.execute("ROLLBACK")
+
+    def flush(self) -> None:
+        """
+        Write the buffered rows, returning once they and every earlier batch are committed.
+        """
+        if not self.path:
+            return
+        with self._lock:
+            rows = self._take()
+        self._writer.submit(self._write, rows).result()
+
+    def summary(self, since: float = 0.0) -> dict:
+        """
+        Per-template request counts, mean tokens and cost, latency percentiles
+        and truncations, for calls made after `since` (a Unix time).
+        """
+        if not self.path:
+            return {"templates": {}}
+        self.flush()
+        # On the writer thread, so it never shares the connection with a batch being written
+        rows = self._writer.submit(lambda: self._connect().execute(
+            "SELECT template, prompt_tokens, completion_tokens, max_tokens, finish_reason, latency_ms, cost "
+            "FROM usage WHERE created_at >= ? ORDER BY template",
+            (since,),
+        ).fetchall()).result()
+
+        templates = {}
+        for row in rows:
+            templates.setdefault(row[0], []).append(row)
+        return {"templates": {name: _summarize(group) for name, group in templates.items()}}
+
+    def close(self) -> None:
+        self.flush()
+
+        def close_db():
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+        self._writer.submit(close_db).result()
+
+
+def _mean(values: list) -> Optional[float]:
+    values = [value for value in values if value is not None]
+    return round(statistics.fmean(values), 3) if values else None
+
+
+def _summarize(rows: list) -> dict:
+    latencies = sorted(row[5] for row in rows)
+    costs = [row[6] for row in rows if row[6] is not None]
+    return {
+        "requests": len(rows),
+        "meanPromptTokens": _mean([row[1] for row in rows]),
+        "meanCompletionTokens": _mean([row[2] for row in rows]),
+        "meanMaxTokens": _mean([row[3] for row in rows]),
+        "truncated": sum(1 for row in rows if row[4] == "length"),
+        "p50LatencyMs": latencies[(len(latencies) - 1) // 2],
+        "p95LatencyMs": latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))],
+        "meanCost": _mean(costs),
+        "totalCost": round(sum(costs), 6) if costs else None,
+    }
@@ -0,0 +1,331 @@
+"""
+Embedding-based retrieval of catalog products.
+
+Product embeddings live next to the keyword catalog index (same product
+numbering) as one memory-mapped float16 or float32 matrix. An IVF index
+partitions it with spherical k-means: vectors are stored grouped by their
+nearest centroid, so a query scores its `n_probe` closest partitions as
+contiguous blocks instead of the whole matrix. `exact_search` scans
+everything and serves as the reference for recall measurements (see
+benchmarks/ann_benchmark.py). Queries are scored in batches, one matrix
+product per probed partition.
+
+Embeddings come either from the built-in `HashingEmbedder`, which runs
+offline with no model, or are precomputed with an embedding model (e.g. an
+Azure OpenAI embedding deployment) and passed to the build command; queries
+must then be embedded with the same model. Build with:
+
+    python -m src.backend.vectors feed.csv catalog_index/ [--embeddings emb.npy --embedder azure:<deployment>]
+"""
+
+import argparse
+import json
+import zlib
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from src.backend.catalog import CatalogIndex, read_feed, tokenize
+
+VECTOR_INDEX_VERSION = 1
+_META = "vectors_meta.json"
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def product_text(product: dict) -> str:
+    return " ".join((product["name"], product["description"], product["category"], product["color"]))
+
+
+class HashingEmbedder:
+    """
+    Deterministic text embedding by signed feature hashing of words, word
+    pairs and character trigrams. Needs no model or network, so it is the
+    offline default; it captures wording overlap, not visual similarity.
+    """
+
+    name = "hashing"
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+
+    def _features(self, text: str):
+        words = tokenize(text)
+        for word in words:
+            yield word, 1.0
+            padded = f"#{word}#"
+            for i in range(len(padded) - 2):
+                yield padded[i:i + 3], 0.35
+        for first, second in zip(words, words[1:]):
+            yield f"{first} {second}", 0.5
+
+    def encode(self, texts: Sequence[str]) -> np.ndarray:
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature, weight in self._features(text):
+                h = zlib.crc32(feature.encode("utf-8"))
+                matrix[row, h % self.dim] += weight if h & 0x80000000 else -weight
+        return _normalize_rows(matrix)
+
+    async def embed(self, texts: Sequence[str]) -> np.ndarray:
+        return self.encode(texts)
+
+
+class OpenAIEmbedder:
+    """
+    Embeddings from an (Azure) OpenAI embedding deployment, one request per batch.
+    """
+
+    def __init__(self, create, deployment: str):
+        self.name = f"azure:{deployment}"
+        self._create = create
+        self.deployment = deployment
+
+    async def embed(self, texts: Sequence[str]) -> np.ndarray:
+        response = await self._create(model=self.deployment, input=list(texts))
+        return _normalize_rows(np.asarray([item.embedding for item in response.data], dtype=np.float32))
+
+
+def make_embedder(spec: str, create=None):
+    """
+    Build the query embedder recorded in an index ("hashing:<dim>" or
+    "azure:<deployment>", the latter calling `create` like embeddings.create).
+    """
+    kind, _, value = spec.partition(":")
+    if kind == "hashing":
+        return HashingEmbedder(int(value or 256))
+    if kind == "azure" and value and create is not None:
+        return OpenAIEmbedder(create, value)
+    raise ValueError(f"Cannot embed queries for vector index built with embedder {spec!r}")
+
+
+def _kmeans(vectors: np.ndarray, n_lists: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """
+    Spherical k-means on a sample of the (normalized) vectors.
+    """
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), 256 * n_lists)
+    sample = vectors[rng.choice(len(vectors), size=sample_size, replace=False)].astype(np.float32)
+    centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        counts = np.bincount(assignment, minlength=n_lists)
+        # Re-seed empty partitions from random points so every list stays in use
+        empty = counts == 0
+        sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()))]
+        centroids = _normalize_rows(sums)
+    return centroids
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray, chunk: int = 65536) -> np.ndarray:
+    assignment = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), chunk):
+        block = np.asarray(vectors[start:start + chunk], dtype=np.float32)
+        assignment[start:start + chunk] = np.argmax(block @ centroids.T, axis=1)
+    return assignment
+
+
+def build_vector_index(
+    embeddings: np.ndarray,
+    directory: str,
+    embedder: str = "hashing:256",
+    n_lists: Optional[int] = None,
+    dtype: str = "float16",
+) -> int:
+    """
+    Write an IVF index for `embeddings` (one row per catalog product, in
+    catalog order) and return the number of partitions.
+    """
+    out = Path(directory)
+    vectors = _normalize_rows(np.asarray(embeddings, dtype=np.float32))
+    n = len(vectors)
+    n_lists = n_lists or max(1, int(np.sqrt(n)))
+    n_lists = min(n_lists, max(1, n))
+    centroids = _kmeans(vectors, n_lists) if n > n_lists else _normalize_rows(vectors.copy())
+    assignment = _assign(vectors, centroids)
+
+    order = np.argsort(assignment, kind="stable")
+    offsets = np.zeros(n_lists + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(assignment, minlength=n_lists))
+
+    np.save(out / "ivf_vectors.npy", vectors[order].astype(dtype))
+    np.save(out / "ivf_ids.npy", order.astype(np.int32))
+    np.save(out / "ivf_offsets.npy", offsets)
+    np.save(out / "ivf_centroids.npy", centroids.astype(np.float32))
+    with open(out / _META, "w", encoding="utf-8") as f:
+        json.dump({
+            "version": VECTOR_INDEX_VERSION,
+            "products": n,
+            "dim": int(vectors.shape[1]),
+            "lists": n_lists,
+            "dtype": dtype,
+            "embedder": embedder,
+        }, f)
+    return n_lists
+
+
+def _top_k(scores: np.ndarray, ids: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    if len(scores) > k:
+        keep = np.argpartition(-scores, k - 1)[:k]
+        scores, ids = scores[keep], ids[keep]
+    order = np.argsort(-scores, kind="stable")
+    return ids[order], scores[order]
+
+
+class VectorIndex:
+    def __init__(self, directory: str, n_probe: int = 8):
+        path = Path(directory)
+        with open(path / _META, encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != VECTOR_INDEX_VERSION:
+            raise ValueError(f"Unsupported vector index version: {meta.get('version')}")
+        self.size = meta["products"]
+        self.dim = meta["dim"]
+        self.embedder = meta["embedder"]
+        self.n_probe = n_probe
+
+        def load(name):
+            return np.asarray(np.load(path / name, mmap_mode="r"))
+
+        self._vectors = load("ivf_vectors.npy")
+        self._ids = load("ivf_ids.npy")
+        self._offsets = load("ivf_offsets.npy")
+        self._centroids = load("ivf_centroids.npy")
+
+    @classmethod
+    def open(cls, directory: str, n_probe: int = 8) -> "VectorIndex":
+        return cls(directory, n_probe)
+
+    @staticmethod
+    def exists(directory: str) -> bool:
+        return (Path(directory) / _META).exists()
+
+    def search(self, queries: np.ndarray, k: int = 10, n_probe: Optional[int] = None) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Approximate top-`k` (product ids, cosine scores) for each query row.
+
+        Queries probing the same partition are scored together with one
+        matrix product against that partition's contiguous block.
+        """
+        queries = _normalize_rows(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        n_probe = min(n_probe or self.n_probe, len(self._centroids))
+        if n_probe >= len(self._centroids):
+            return self.exact_search(queries, k)
+
+        centroid_scores = queries @ self._centroids.T
+        probes = np.argpartition(-centroid_scores, n_probe - 1, axis=1)[:, :n_probe]
+
+        found_scores: List[List[np.ndarray]] = [[] for _ in range(len(queries))]
+        found_ids: List[List[np.ndarray]] = [[] for _ in range(len(queries))]
+        for list_id in np.unique(probes):
+            start, end = self._offsets[list_id], self._offsets[list_id + 1]
+            if start == end:
+                continue
+            rows = np.flatnonzero((probes == list_id).any(axis=1))
+            block = self._vectors[start:end].astype(np.float32) @ queries[rows].T
+            for column, row in enumerate(rows):
+                scores = block[:, column]
+                if len(scores) > k:
+                    keep = np.argpartition(-scores, k - 1)[:k]
+                    found_scores[row].append(scores[keep])
+                    found_ids[row].append(self._ids[start + keep])
+                else:
+                    found_scores[row].append(scores)
+                    found_ids[row].append(self._ids[start:end])
+
+        results = []
+        for scores, ids in zip(found_scores, found_ids):
+            if not scores:
+                results.append((np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)))
+                continue
+            results.append(_top_k(np.concatenate(scores), np.concatenate(ids), k))
+        return results
+
+    def exact_search(self, queries: np.ndarray, k: int = 10, chunk: int = 65536) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Brute-force top-`k` over every product, scanning the matrix in chunks.
+        """
+        queries = _normalize_rows(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        best = [(np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)) for _ in range(len(queries))]
+        for start in range(0, self.size, chunk):
+            block = self._vectors[start:start + chunk].astype(np.float32) @ queries.T
+            ids = self._ids[start:start + chunk]
+            for row in range(len(queries)):
+                best_ids, best_scores = best[row]
+                scores = np.concatenate((best_scores, block[:, row]))
+                best[row] = _top_k(scores, np.concatenate((best_ids, ids)), k)
+        return best
+
+    def match_items(self, items: List[dict], query_vectors: np.ndarray, catalog: CatalogIndex, k: int = 5) -> List[dict]:
+        """
+        Replace suggested items with their nearest catalog products.
+
+        Items are matched together so two of them are not pointed at the
+        same product when another close match is available.
+        """
+        used = set()
+        matched = []
+        for item, (ids, _) in zip(items, self.search(query_vectors, k=k)):
+            product_id = next((int(i) for i in ids if int(i) not in used), None)
+            if product_id is None:
+                matched.append(item)
+                continue
+            used.add(product_id)
+            product = catalog.product(product_id)
+            matched.append({
+                "name": product["name"] or item.get("name", ""),
+                "description": item.get("description") or product["description"],
+                "imageUrl": product["imageUrl"],
+                "productUrl": product["productUrl"],
+            })
+        return matched
+
+
+def item_text(item: dict) -> str:
+    return f"{item.get('name', '')} {item.get('description', '')}"
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Build the embedding index for a product catalog.")
+    parser.add_argument("feed", help="The product feed the catalog index was built from")
+    parser.add_argument("output", help="Catalog index directory")
+    parser.add_argument("--embeddings", help="Precomputed .npy embeddings, one row per feed product")
+    parser.add_argument("--embedder", default=None,
+                        help="Embedder used for the precomputed embeddings, azure:<deployment> or hashing:<dim>; "
+                             "required with --embeddings, since queries are embedded with it at serve time")
+    parser.add_argument("--dim", type=int, default=256, help="Dimension of the built-in hashing embedder")
+    parser.add_argument("--lists", type=int, default=None, help="IVF partitions (default: sqrt of product count)")
+    parser.add_argument("--dtype", choices=("float16", "float32"), default="float16")
+    args = parser.parse_args(argv)
+    if args.embeddings:
+        if not args.embedder:
+            parser.error("--embedder is required with --embeddings")
+        try:
+            # Refuse an index the server could not query, rather than failing at startup
+            make_embedder(args.embedder, create=lambda **kwargs: None)
+        except ValueError as e:
+            parser.error(f"{e}; use azure:<deployment> or hashing:<dim>")
+
+    catalog = CatalogIndex.open(args.output)
+    if args.embeddings:
+        embeddings = np.load(args.embeddings, mmap_mode="r")
+        embedder = args.embedder
+    else:
+        embedder = HashingEmbedder(args.dim)
+        texts = [product_text(product) for product in read_feed(args.feed)]
+        embeddings = embedder.encode(texts)
+        embedder = f"{embedder.name}:{args.dim}"
+    if len(embeddings) != catalog.size:
+        raise SystemExit(f"Expected {catalog.size} embeddings, got {len(embeddings)}")
+    lists = build_vector_index(embeddings, args.output, embedder=embedder, n_lists=args.lists, dtype=args.dtype)
+    print(f"Indexed {len(embeddings)} embeddings into {lists} partitions in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,45 @@
 import pytest
 from fastapi.testclient import TestClient
 from src.backend.main import app
+from src.backend.providers import Completion, VisionBackend
 import base64
 import os
 import json
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
 
 client = TestClient(app)
 
+MOCK_ANALYSIS_TEXT = """### 1. Description
+Test description
+### 2. Color Tones
+Test color tones
+### 3. Core Apparel
+Test core apparel
+### 4. Accessories
+Test accessories
+### 5. Fashion Tips
+- Tip 1
+- Tip 2
+### 6. Similar Items
+1. Test Item
+   - Description: Test description"""
+
+@pytest.fixture(autouse=True)
+def fresh_result_cache(monkeypatch):
+    """Start every test with an empty analysis cache"""
+    from src.backend import main
+    from src.backend.cache import ResultCache
+    monkeypatch.setattr(main, "result_cache", ResultCache())
+
+@pytest.fixture(autouse=True)
+def fresh_usage_accounting(monkeypatch, tmp_path):
+    """Keep usage rows and tuned budgets from leaking between tests"""
+    from src.backend import main
+    from src.backend.prompts import MaxTokensTuner
+    from src.backend.usage import UsageLedger
+    monkeypatch.setattr(main, "usage_ledger", UsageLedger(str(tmp_path / "usage.sqlite3")))
+    monkeypatch.setattr(main, "max_tokens_tuner", MaxTokensTuner(ceiling=main.max_tokens))
+
 # Test data
 SAMPLE_RESPONSE = {
     "analysis": {
@@ -51,7 +83,7 @@ def sample_image():
     yield img_path
     os.remove(img_path)
 
-@patch("src.backend.main.client.chat.completions.create")
+@patch("src.backend.main.client.chat.completions.create", new_callable=AsyncMock)
 def test_analyze_valid_image(mock_create, sample_image):
     """Test analyzing a valid image"""
     # Mock the OpenAI response
@@ -83,13 +115,15 @@ Test accessories
     assert "analysis" in data
     assert "fashionTips" in data
     assert "suggestedItems" in data
+    # Structured output is opt-in: not every deployment accepts response_format
+    assert "response_format" not in mock_create.call_args.kwargs
 
 def test_analyze_missing_file():
     """Test the analyze endpoint without a file"""
     response = client.post("/api/analyze")
     assert response.status_code == 422  # FastAPI validation error
 
-@patch("src.backend.main.client.chat.completions.create")
+@patch("src.backend.main.client.chat.completions.create", new_callable=AsyncMock)
 def test_gpt4v_error_handling(mock_create):
     """Test error handling when GPT-4V API fails"""
     mock_create.side_effect = Exception("API Error")
@@ -99,4 +133,1293 @@ def test_gpt4v_error_handling(mock_create):
     response = client.post("/api/analyze", files=files)
     
     assert response.status_code == 500
-    assert "API call failed" in response.json()["detail"] 
\ No newline at end of file
+    assert "API call failed" in response.json()["detail"]
+
+def test_scheduler_rejects_when_queue_full():
+    """Test that the scheduler fails fast once its wait queue is full"""
+    import asyncio
+    from src.backend.scheduler import AnalysisScheduler, SchedulerOverloaded
+
+    async def scenario():
+        scheduler = AnalysisScheduler(max_in_flight=1, max_queue=1, timeout=5)
+        release = asyncio.Event()
+
+        async def slow_call():
+            await release.wait()
+            return "done"
+
+        first = asyncio.create_task(scheduler.run(slow_call))
+        second = asyncio.create_task(scheduler.run(slow_call))
+        while scheduler.queued < 1:
+            await asyncio.sleep(0)
+        assert scheduler.in_flight == 1
+        assert scheduler.queued == 1
+        with pytest.raises(SchedulerOverloaded):
+            await scheduler.run(slow_call)
+        release.set()
+        assert await asyncio.gather(first, second) == ["done", "done"]
+        assert scheduler.in_flight == 0
+
+    asyncio.run(scenario())
+
+def test_analyze_deadline_exceeded(sample_image):
+    """Test that a slow upstream call returns 504 once the deadline passes"""
+    import asyncio
+    from src.backend import main
+
+    async def never_returns(*args, **kwargs):
+        await asyncio.sleep(10)
+
+    with patch("src.backend.main.client.chat.completions.create", side_effect=never_returns), \
+         patch.object(main.scheduler, "timeout", 0.05):
+        with open(sample_image, "rb") as f:
+            files = {"file": ("test.jpg", f, "image/jpeg")}
+            response = client.post("/api/analyze", files=files)
+
+    assert response.status_code == 504
+
+@patch("src.backend.main.client.chat.completions.create", new_callable=AsyncMock)
+def test_analyze_cache_hit(mock_create, sample_image):
+    """Test that re-uploading the same image is served from the cache"""
+    mock_response = MagicMock()
+    mock_response.choices = [MagicMock()]
+    mock_response.choices[0].message.content = MOCK_ANALYSIS_TEXT
+    mock_create.return_value = mock_response
+
+    responses = []
+    for _ in range(2):
+        with open(sample_image, "rb") as f:
+            files = {"file": ("test.jpg", f, "image/jpeg")}
+            responses.append(client.post("/api/analyze", files=files))
+
+    assert mock_create.call_count == 1
+    assert responses[0].json() == responses[1].json()
+    stats = client.get("/api/cache/stats").json()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+
+def test_result_cache_disk_tier_and_ttl(tmp_path):
+    """Test that the SQLite tier survives restarts and entries expire"""
+    from src.backend.cache import ResultCache, image_digest, make_cache_key
+
+    db_path = str(tmp_path / "cache.db")
+    key = make_cache_key(image_digest(b"image"), "deployment", "1", 1000)
+    ResultCache(path=db_path).set(key, SAMPLE_RESPONSE)
+
+    restarted = ResultCache(path=db_path)
+    assert restarted.get(key) == SAMPLE_RESPONSE
+    assert restarted.stats()["diskHits"] == 1
+
+    expired = ResultCache(ttl=-1, path=db_path)
+    assert expired.get(key) is None
+    assert expired.stats()["expirations"] == 1
+
+def test_result_cache_async_access_keeps_sqlite_off_the_event_loop(tmp_path):
+    """Test that aget/aset serve memory hits on the loop and do disk work in worker threads"""
+    import asyncio
+    import threading
+    from src.backend.cache import ResultCache
+
+    db_path = str(tmp_path / "cache.db")
+    cache = ResultCache(path=db_path)
+    disk_threads = []
+    for name in ("_get_disk", "_store"):
+        method = getattr(cache, name)
+
+        def recording(*args, method=method):
+            disk_threads.append(threading.current_thread())
+            return method(*args)
+        setattr(cache, name, recording)
+
+    async def scenario():
+        await cache.aset("key", SAMPLE_RESPONSE)
+        assert await cache.aget("key") == SAMPLE_RESPONSE  # from memory, no disk access
+        assert await cache.aget("other") is None
+        return threading.current_thread()
+
+    loop_thread = asyncio.run(scenario())
+    assert len(disk_threads) == 2 and loop_thread not in disk_threads
+    assert (cache.stats()["hits"], cache.stats()["misses"]) == (1, 1)
+    assert ResultCache(path=db_path).get("key") == SAMPLE_RESPONSE
+
+def _outfit_like_image(size=(240, 320)):
+    """Build a deterministic, textured test image"""
+    import numpy as np
+    from PIL import Image
+    rng = np.random.default_rng(0)
+    blocks = rng.integers(0, 256, (8, 6, 3), dtype=np.uint8)
+    return Image.fromarray(blocks).resize(size, Image.Resampling.BILINEAR)
+
+def _encode(image, fmt="JPEG", **kwargs):
+    import io
+    buf = io.BytesIO()
+    image.save(buf, format=fmt, **kwargs)
+    return buf.getvalue()
+
+def test_phash_survives_resize_and_recompression():
+    """Test that re-encoded copies of a photo get nearby perceptual hashes"""
+    from PIL import Image
+    from src.backend.phash import phash_bytes
+
+    image = _outfit_like_image()
+    original = phash_bytes(_encode(image, quality=95))
+    copy = phash_bytes(_encode(image.resize((120, 160), Image.Resampling.BICUBIC), "PNG"))
+    other = phash_bytes(_encode(_outfit_like_image().transpose(Image.Transpose.ROTATE_180)))
+
+    assert bin(original ^ copy).count("1") <= 6
+    assert bin(original ^ other).count("1") > 6
+    assert phash_bytes(b"not an image") is None
+
+def test_hamming_index_matches_brute_force():
+    """Test multi-index lookups against a linear scan"""
+    import numpy as np
+    from src.backend.phash import HammingIndex
+
+    rng = np.random.default_rng(1)
+    stored = [int(x) for x in rng.integers(0, 2**63, 5000, dtype=np.uint64)]
+    index = HammingIndex(min_merge=1000)
+    for fp in stored:
+        index.add(fp)
+
+    for base in stored[::250]:
+        query = base ^ (1 << 3) ^ (1 << 40) ^ (1 << 63)
+        expected = min(bin(query ^ fp).count("1") for fp in stored)
+        item_id, distance = index.nearest(query, 7)
+        assert distance == expected == 3
+        assert index.fingerprint(item_id) == base
+    assert index.nearest(stored[0] ^ 0xFFFF, 7) is None
+
+@patch("src.backend.main.client.chat.completions.create", new_callable=AsyncMock)
+def test_analyze_near_duplicate_hit(mock_create, monkeypatch):
+    """Test that a recompressed copy of an analyzed photo reuses its result"""
+    from src.backend import main
+    from src.backend.phash import NearDuplicateIndex
+    monkeypatch.setattr(main, "near_duplicates", NearDuplicateIndex(max_distance=6))
+
+    mock_response = MagicMock()
+    mock_response.choices = [MagicMock()]
+    mock_response.choices[0].message.content = MOCK_ANALYSIS_TEXT
+    mock_create.return_value = mock_response
+
+    image = _outfit_like_image()
+    first = client.post("/api/analyze", files={"file": ("a.jpg", _encode(image, quality=95), "image/jpeg")})
+    second = client.post("/api/analyze", files={"file": ("b.jpg", _encode(image, quality=60), "image/jpeg")})
+
+    assert mock_create.call_count == 1
+    assert first.json() == second.json()
+    assert client.get("/api/cache/stats").json()["nearDuplicates"]["hits"] == 1
+
+def test_prepare_image_downscales_and_strips_metadata():
+    """Test that large uploads are downscaled, re-encoded and stripped of EXIF"""
+    import io
+    from PIL import Image
+    from src.backend.preprocess import prepare_image
+
+    exif = Image.Exif()
+    exif[0x010F] = "PhoneMaker"  # Make
+    exif[0x0112] = 6  # Orientation: rotate 90 CW
+    big = _encode(_outfit_like_image((4000, 3000)), quality=95, exif=exif)
+
+    prepared = prepare_image(big, "image/jpeg", max_edge=2048, max_short_edge=768)
+
+    assert prepared.mime_type == "image/jpeg"
+    assert (prepared.width, prepared.height) == (768, 1024)  # rotated upright, then capped
+    assert len(prepared.content) < len(big)
+    with Image.open(io.BytesIO(prepared.content)) as result:
+        assert not result.getexif()
+    assert list(prepared.timings) == ["decode", "resize", "fingerprint", "encode"]
+
+    png = _encode(_outfit_like_image((200, 100)).convert("RGBA"), "PNG")
+    assert prepare_image(png, "image/png").mime_type == "image/png"
+    assert prepare_image(b"raw bytes", "image/heic").content == b"raw bytes"
+
+def test_prepare_image_strips_xmp_comments_and_text_chunks():
+    """Test that in-bounds uploads are only passed through when they carry no metadata"""
+    from PIL import PngImagePlugin
+    from src.backend.preprocess import prepare_image
+
+    small = _outfit_like_image((200, 100))
+    plain = _encode(small)
+    assert prepare_image(plain, "image/jpeg").content == plain
+
+    tagged = _encode(small, comment=b"shot at home", xmp=b"<x:xmpmeta><exif:GPSLatitude>47,36N</exif:GPSLatitude></x:xmpmeta>")
+    prepared = prepare_image(tagged, "image/jpeg")
+    assert b"GPSLatitude" not in prepared.content
+    assert b"shot at home" not in prepared.content
+
+    text = PngImagePlugin.PngInfo()
+    text.add_text("Comment", "shot at home")
+    text.add_itxt("XML:com.adobe.xmp", "<exif:GPSLatitude>47,36N</exif:GPSLatitude>")
+    prepared = prepare_image(_encode(small, "PNG", pnginfo=text), "image/png")
+    assert b"GPSLatitude" not in prepared.content
+    assert b"shot at home" not in prepared.content
+
+@patch("src.backend.main.client.chat.completions.create", new_callable=AsyncMock)
+def test_analyze_sends_preprocessed_image(mock_create):
+    """Test that the upstream receives the re-encoded image and timings are reported"""
+    mock_response = MagicMock()
+    mock_response.choices = [MagicMock()]
+    mock_response.choices[0].message.content = MOCK_ANALYSIS_TEXT
+    mock_create.return_value = mock_response
+
+    png = _encode(_outfit_like_image((3000, 2000)), "PNG")
+    response = client.post("/api/analyze", files={"file": ("look.png", png, "image/png")})
+
+    assert response.status_code == 200
+    image_url = mock_create.call_args.kwargs["messages"][0]["content"][1]["image_url"]["url"]
+    assert image_url.startswith("data:image/jpeg;base64,")
+    assert len(image_url) < len(png)
+    assert "decode;dur=" in response.headers["Server-Timing"]
+    assert "llm;dur=" in response.headers["Server-Timing"]
+
+def test_streaming_parser_emits_sections_incrementally():
+    """Test that the incremental parser emits parts as they complete"""
+    from src.backend.parsing import StreamingAnalysisParser, parse_analysis_text
+
+    parser = StreamingAnalysisParser()
+    events = []
+    emitted_at = {}
+    for position in range(0, len(MOCK_ANALYSIS_TEXT), 7):
+        for event in parser.feed(MOCK_ANALYSIS_TEXT[position:position + 7]):
+            events.append(event)
+            emitted_at.setdefault(event[0], position)
+    final_events, result = parser.close()
+    events += final_events
+
+    assert result == parse_analysis_text(MOCK_ANALYSIS_TEXT)
+    assert events[0] == ("section", {"name": "description", "content": "Test description"})
+    assert [data for event, data in events if event == "fashionTip"] == ["Tip 1", "Tip 2"]
+    assert [data for event, data in events if event == "suggestedItem"] == result["suggestedItems"]
+    # The description is available long before the model finishes writing
+    assert emitted_at["section"] < len(MOCK_ANALYSIS_TEXT) // 3
+
+def test_streaming_parser_handles_long_item_lists_line_by_line():
+    """Test that items stream in order and match the batch parser, without re-parsing the section per line"""
+    from src.backend.parsing import StreamingAnalysisParser, SuggestedItemsParser, parse_analysis_text
+
+    items = "\n".join(f"{i % 3 + 1}. Item {i}\n   - Description: Piece {i}\n   - Price Range: $10" for i in range(600))
+    text = MOCK_ANALYSIS_TEXT.split("### 6")[0] + "### 6. Similar Items\n" + items + "\n"
+
+    parser = StreamingAnalysisParser()
+    emitted = []
+    with patch.object(SuggestedItemsParser, "line", autospec=True, side_effect=SuggestedItemsParser.line) as line:
+        for position in range(0, len(text), 16):
+            emitted += [data for event, data in parser.feed(text[position:position + 16]) if event == "suggestedItem"]
+    # Each of the section's 1800 lines is parsed once, not the whole section again per line
+    assert line.call_count == 3 * 600
+    final_events, result = parser.close()
+    emitted += [data for event, data in final_events if event == "suggestedItem"]
+
+    assert result == parse_analysis_text(text)
+    assert emitted == result["suggestedItems"] and len(emitted) == 600
+
+@patch("src.backend.main.client.chat.completions.create", new_callable=AsyncMock)
+def test_analyze_stream_endpoint(mock_create, sample_image):
+    """Test the Server-Sent Events analysis endpoint"""
+    from src.backend import main
+
+    async def deltas():
+        for line in MOCK_ANALYSIS_TEXT.splitlines(keepends=True):
+            chunk = MagicMock()
+            chunk.choices = [MagicMock()]
+            chunk.choices[0].delta.content = line
+            chunk.choices[0].finish_reason = None
+            chunk.usage = None
+            yield chunk
+        # The usage chunk requested with stream_options carries no choices
+        chunk = MagicMock()
+        chunk.choices = []
+        chunk.usage.prompt_tokens = 120
+        chunk.usage.completion_tokens = 90
+        yield chunk
+    mock_create.return_value = deltas()
+
+    with open(sample_image, "rb") as f:
+        files = {"file": ("test.jpg", f, "image/jpeg")}
+        response = client.post("/api/analyze/stream", files=files)
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = [
+        (block.split("\n")[0][len("event: "):], json.loads(block.split("\n")[1][len("data: "):]))
+        for block in response.text.strip().split("\n\n")
+    ]
+    assert mock_create.call_args.kwargs["stream"] is True
+    assert mock_create.call_args.kwargs["stream_options"] == {"include_usage": True}
+    assert [event for event, _ in events].count("section") == 4
+    assert events[-1][0] == "result"
+    assert events[-1][1]["fashionTips"] == ["Tip 1", "Tip 2"]
+
+    # Accounted under the streaming prompt, and cached under its version
+    usage = client.get("/api/usage/stats").json()["templates"][main.STREAM_TEMPLATE.key]
+    assert usage["requests"] == 1
+    assert usage["meanPromptTokens"] == 120
+    assert usage["meanCompletionTokens"] == 90
+    with open(sample_image, "rb") as f:
+        digest = main.image_digest(f.read())
+    assert main.result_cache.get(main.cache_key_for(digest, main.STREAM_PROMPT_VERSION)) is not None
+    if main.STREAM_PROMPT_VERSION != main.PROMPT_VERSION:
+        assert main.result_cache.get(main.cache_key_for(digest)) is None
+
+@patch("src.backend.main.client.chat.completions.create", new_callable=AsyncMock)
+def test_analyze_structured_output(mock_create, sample_image, monkeypatch):
+    """Test that JSON structured output is requested and parsed"""
+    from src.backend import main
+    from src.backend.prompts import TEMPLATES
+    monkeypatch.setattr(main, "prompt_template", TEMPLATES["structured-v3"])
+
+    mock_response = MagicMock()
+    mock_response.choices = [MagicMock()]
+    mock_response.choices[0].message.content = json.dumps({
+        "description": "Relaxed grandpa-core",
+        "colorTones": "Earthy browns",
+        "coreApparel": "Cardigan, pleated trousers",
+        "accessories": "Loafers",
+        "fashionTips": ["Roll the sleeves", "Add a beanie"],
+        "similarItems": [{"name": "Wool Cardigan", "description": "Chunky knit", "priceRange": "$90"}],
+    })
+    mock_create.return_value = mock_response
+
+    with open(sample_image, "rb") as f:
+        response = client.post("/api/analyze", files={"file": ("test.jpg", f, "image/jpeg")})
+
+    assert response.status_code == 200
+    assert mock_create.call_args.kwargs["response_format"]["type"] == "json_schema"
+    data = response.json()
+    assert data["analysis"]["accessories"] == "Loafers"
+    assert data["fashionTips"] == ["Roll the sleeves", "Add a beanie"]
+    assert data["suggestedItems"][0]["name"] == "Wool Cardigan"
+    assert data["suggestedItems"][0]["productUrl"] == "https://www.nordstrom.com/s/wool-cardigan"
+
+def test_parse_model_output_recovers_truncated_json():
+    """Test that a response cut off at max_tokens keeps its complete fields"""
+    from src.backend.parsing import parse_model_output
+
+    truncated = '{"description": "Boho", "colorTones": "Cream", "fashionTips": ["Layer it", "Belt the wai'
+    data = parse_model_output(truncated)
+    assert data["analysis"]["description"] == "Boho"
+    assert data["fashionTips"] == ["Layer it"]
+    assert data["suggestedItems"] == []
+
+    # Anything that is not JSON still goes through the markdown parser
+    assert parse_model_output(MOCK_ANALYSIS_TEXT)["fashionTips"] == ["Tip 1", "Tip 2"]
+
+def test_batch_uploads_are_hashed_in_chunks_and_read_when_analyzed():
+    """Test that batch uploads stay spooled until the worker analyzing them reads them"""
+    import io
+    from src.backend.batch import dedupe_uploads
+
+    class RecordingFile(io.BytesIO):
+        def __init__(self, content):
+            super().__init__(content)
+            self.reads = []
+
+        def read(self, size=-1):
+            self.reads.append(size)
+            return super().read(size)
+
+    content = os.urandom(3 * 1024 * 1024)
+    first, duplicate = RecordingFile(content), RecordingFile(content)
+    images = dedupe_uploads([("a.jpg", first, "image/jpeg"), ("b.jpg", duplicate, "image/jpeg")])
+
+    assert len(images) == 1 and images[0].sources == ["a.jpg", "b.jpg"]
+    assert images[0].content is None
+    assert all(0 < size <= 1024 * 1024 for size in first.reads + duplicate.reads)
+    assert images[0].load() == content
+
+def _ndjson(response):
+    return [json.loads(line) for line in response.text.splitlines() if line]
+
+@patch("src.backend.main.client.chat.completions.create", new_callable=AsyncMock)
+def test_analyze_batch_dedupes_and_resumes(mock_create, monkeypatch, tmp_path):
+    """Test batch analysis with duplicate uploads and a resumed job"""
+    from src.backend import main
+    from src.backend.batch import BatchJobStore
+    monkeypatch.setattr(main, "batch_store", BatchJobStore(str(tmp_path)))
+
+    mock_response = MagicMock()
+    mock_response.choices = [MagicMock()]
+    mock_response.choices[0].message.content = MOCK_ANALYSIS_TEXT
+    mock_create.return_value = mock_response
+
+    first_image = _encode(_outfit_like_image())
+    second_image = _encode(_outfit_like_image().transpose(0))
+    files = [
+        ("files", ("a.jpg", first_image, "image/jpeg")),
+        ("files", ("a-copy.jpg", first_image, "image/jpeg")),
+        ("files", ("b.jpg", second_image, "image/jpeg")),
+    ]
+    records = _ndjson(client.post("/api/analyze/batch", files=files))
+
+    assert records[0]["type"] == "job" and records[0]["total"] == 2
+    results = [r for r in records if r["type"] == "result"]
+    assert sorted(len(r["sources"]) for r in results) == [1, 2]
+    assert all(r["status"] == "ok" for r in results)
+    assert records[-1]["analyzed"] == 2
+    assert mock_create.call_count == 2
+
+    # Resuming the job replays logged results without new upstream calls
+    job_id = records[0]["jobId"]
+    main.result_cache.clear()
+    resumed = _ndjson(client.post("/api/analyze/batch", files=files, data={"job_id": job_id}))
+    assert [r.get("resumed") for r in resumed if r["type"] == "result"] == [True, True]
+    assert mock_create.call_count == 2
+    assert client.get(f"/api/analyze/batch/{job_id}").json()["completed"] == 2
+
+def test_batch_manifest_paths_stay_inside_root(tmp_path):
+    """Test that manifest paths cannot escape the configured directory"""
+    from src.backend.batch import BatchInputError, dedupe_paths, parse_manifest
+
+    (tmp_path / "look.jpg").write_bytes(_encode(_outfit_like_image()))
+    paths = parse_manifest("# lookbook\nlook.jpg\nlook.jpg\n")
+    images = dedupe_paths(paths, str(tmp_path))
+    assert len(images) == 1 and images[0].sources == ["look.jpg", "look.jpg"]
+
+    with pytest.raises(BatchInputError):
+        dedupe_paths(["../etc/passwd"], str(tmp_path))
+
+def _api_error(error_class, status_code, headers=None):
+    import openai
+    response = MagicMock(status_code=status_code, headers=headers or {})
+    return getattr(openai, error_class)("upstream says no", response=response, body=None)
+
+def test_upstream_retries_rate_limits_with_retry_after():
+    """Test that 429s are retried after the server's Retry-After hint"""
+    import asyncio
+    from src.backend.upstream import UpstreamClient, UpstreamRateLimited
+
+    create = AsyncMock(side_effect=[
+        _api_error("RateLimitError", 429, {"retry-after-ms": "20"}),
+        "completion",
+    ])
+    upstream = UpstreamClient(create, max_retries=2, base_delay=0.001)
+    assert asyncio.run(upstream.create(model="m")) == "completion"
+    assert create.call_count == 2
+    assert upstream.stats()["retries"] == 1
+
+    create = AsyncMock(side_effect=_api_error("RateLimitError", 429, {"retry-after": "7"}))
+    upstream = UpstreamClient(create, max_retries=0)
+    with pytest.raises(UpstreamRateLimited) as excinfo:
+        asyncio.run(upstream.create(model="m"))
+    assert excinfo.value.retry_after == 7
+
+def test_upstream_circuit_breaker_and_token_budget():
+    """Test breaker tripping on repeated failures and TPM budgeting"""
+    import asyncio
+    from src.backend.upstream import (
+        CircuitBreaker, TokenBucket, UpstreamClient, UpstreamRateLimited, UpstreamUnavailable,
+    )
+
+    create = AsyncMock(side_effect=_api_error("InternalServerError", 500))
+    upstream = UpstreamClient(create, max_retries=0, breaker=CircuitBreaker(failure_threshold=2, reset_timeout=60))
+    for _ in range(2):
+        with pytest.raises(UpstreamUnavailable):
+            asyncio.run(upstream.create(model="m"))
+    with pytest.raises(UpstreamUnavailable, match="circuit breaker"):
+        asyncio.run(upstream.create(model="m"))
+    assert create.call_count == 2
+    assert upstream.stats()["circuit"] == "open"
+
+    bucket = TokenBucket(per_minute=6000)
+    assert bucket.reserve(6000, max_wait=0) == 0
+    assert bucket.reserve(1000, max_wait=1) is None  # would need ~10s of refill
+    assert 9 < bucket.reserve(1000, max_wait=60) < 11
+
+    upstream = UpstreamClient(AsyncMock(), tokens_per_minute=1000, default_timeout=1)
+    upstream.token_bucket.reserve(1000, max_wait=0)
+    with pytest.raises(UpstreamRateLimited):
+        asyncio.run(upstream.create(estimated_tokens=900, model="m"))
+
+def test_cancelled_half_open_trial_frees_the_breaker():
+    """Test that a trial call cancelled mid-flight lets the next call try again"""
+    import asyncio
+    from src.backend.upstream import CircuitBreaker, UpstreamClient
+
+    async def hang(**kwargs):
+        await asyncio.sleep(60)
+
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    assert breaker.state == "half-open"
+    upstream = UpstreamClient(AsyncMock(side_effect=hang), max_retries=0, breaker=breaker)
+
+    async def cancel_trial():
+        trial = asyncio.ensure_future(upstream.create(model="m"))
+        await asyncio.sleep(0.01)
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+
+    asyncio.run(cancel_trial())
+    assert breaker.allow(), "the cancelled trial must not hold the half-open slot"
+
+    # Caller errors and throttling leave the consecutive-failure count alone
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    breaker.record_failure()
+    create = AsyncMock(side_effect=_api_error("BadRequestError", 400))
+    with pytest.raises(Exception):
+        asyncio.run(UpstreamClient(create, max_retries=0, breaker=breaker).create(model="m"))
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+@patch("src.backend.main.client.chat.completions.create", new_callable=AsyncMock)
+def test_analyze_returns_429_when_rate_limited(mock_create, sample_image, monkeypatch):
+    """Test that exhausted upstream quota surfaces as 429 with Retry-After"""
+    from src.backend import main
+    monkeypatch.setattr(main.upstream, "max_retries", 0)
+    mock_create.side_effect = _api_error("RateLimitError", 429, {"retry-after": "3"})
+
+    with open(sample_image, "rb") as f:
+        response = client.post("/api/analyze", files={"file": ("test.jpg", f, "image/jpeg")})
+
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "3"
+
+class _FakeBackend(VisionBackend):
+    """Vision backend stand-in with scripted latency and failures"""
+    def __init__(self, name, delay=0.0, error=None):
+        self.name, self.delay, self.error, self.calls, self.cancelled = name, delay, error, 0, 0
+
+    async def complete(self, request):
+        import asyncio
+        self.calls += 1
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        if self.error is not None:
+            raise self.error
+        return Completion(text=self.name, backend=self.name)
+
+def test_router_fails_over_and_marks_backend_unhealthy():
+    """Test failover to another backend when one is unavailable"""
+    import asyncio
+    from src.backend.providers import BackendRouter, VisionRequest
+    from src.backend.upstream import UpstreamUnavailable
+
+    broken = _FakeBackend("broken", error=UpstreamUnavailable("down"))
+    working = _FakeBackend("working")
+    router = BackendRouter([broken, working], hedge=False, failure_threshold=2)
+    request = VisionRequest(prompt="p", images=[], max_tokens=10)
+
+    async def scenario():
+        return [(await router.complete(request)).text for _ in range(4)]
+
+    assert asyncio.run(scenario()) == ["working"] * 4
+    assert broken.calls == 2  # skipped once it was marked unhealthy
+    assert router.stats()["backends"]["broken"]["healthy"] is False
+
+def test_router_hedges_requests_slower_than_p95():
+    """Test that a slow primary is hedged with a second backend"""
+    import asyncio
+    from src.backend.providers import BackendRouter, VisionRequest
+
+    slow = _FakeBackend("slow")
+    fast = _FakeBackend("fast")
+    router = BackendRouter([slow, fast], hedge=True, hedge_min_delay=0.01, max_hedge_ratio=1.0)
+    for _ in range(30):
+        router.states["slow"].latencies.append(0.01)
+    router._requests = 30
+    router.states["fast"].outstanding = 1  # make the slow backend the first choice
+    slow.delay = 1.0
+    request = VisionRequest(prompt="p", images=[], max_tokens=10)
+
+    completion = asyncio.run(router.complete(request))
+    assert completion.text == "fast"
+    assert router.stats()["hedgedRequests"] == 1
+    # The slow primary lost the race and was cancelled rather than left to finish
+    assert (slow.calls, slow.cancelled, fast.calls, fast.cancelled) == (1, 1, 1, 0)
+    assert router.states["slow"].outstanding == 0
+
+def test_router_cancels_primary_when_caller_is_cancelled_during_hedge_delay():
+    """Test that cancelling a request while it waits out the hedge delay cancels its upstream call"""
+    import asyncio
+    from src.backend.providers import BackendRouter, VisionRequest
+
+    slow = _FakeBackend("slow", delay=60.0)
+    fast = _FakeBackend("fast")
+    router = BackendRouter([slow, fast], hedge=True, hedge_min_delay=30.0, max_hedge_ratio=1.0)
+    for _ in range(30):
+        router.states["slow"].latencies.append(0.01)
+    router._requests = 30
+    router.states["fast"].outstanding = 1  # make the slow backend the first choice
+    request = VisionRequest(prompt="p", images=[], max_tokens=10)
+
+    async def scenario():
+        call = asyncio.ensure_future(router.complete(request))
+        while slow.calls == 0:
+            await asyncio.sleep(0)
+        call.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await call
+        # Let the cancelled upstream call unwind, then check before the loop shuts down
+        # (asyncio.run would cancel a leftover call itself)
+        for _ in range(3):
+            await asyncio.sleep(0)
+        assert (slow.calls, slow.cancelled, fast.calls) == (1, 1, 0)
+        assert router.states["slow"].outstanding == 0
+
+    asyncio.run(scenario())
+    assert router.stats()["hedgedRequests"] == 0
+
+@patch("src.backend.main.client.chat.completions.create", new_callable=AsyncMock)
+def test_metrics_endpoint(mock_create, sample_image):
+    """Test that /metrics exposes stage latencies, token usage and cache counters"""
+    mock_response = MagicMock()
+    mock_response.choices = [MagicMock()]
+    mock_response.choices[0].message.content = MOCK_ANALYSIS_TEXT
+    mock_response.usage.prompt_tokens = 812
+    mock_response.usage.completion_tokens = 240
+    mock_response.usage.total_tokens = 1052
+    mock_create.return_value = mock_response
+
+    with open(sample_image, "rb") as f:
+        assert client.post("/api/analyze", files={"file": ("test.jpg", f, "image/jpeg")}).status_code == 200
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    text = response.text
+    for stage in ("read", "decode", "base64", "llm", "parse"):
+        assert f'stylefinder_stage_seconds_count{{stage="{stage}"}}' in text
+    assert 'stylefinder_upstream_tokens_total{backend="primary",kind="prompt"}' in text
+    assert 'stylefinder_cache_lookups_total{result="miss"} 1' in text
+    assert 'stylefinder_scheduler_requests{state="in_flight"} 0' in text
+    assert 'stylefinder_http_requests_total{method="POST",route="/api/analyze",status="200"}' in text
+
+def test_histogram_exposition_and_tracing():
+    """Test cumulative histogram buckets and trace IDs taken from traceparent"""
+    from src.backend.metrics import Histogram, Trace, current_trace, stage, trace_id_from_headers
+
+    histogram = Histogram("demo_seconds", "Demo", ("stage",), buckets=(0.1, 1))
+    for value in (0.05, 0.5, 5):
+        histogram.labels("x").observe(value)
+    text = histogram.render()
+    assert 'demo_seconds_bucket{stage="x",le="0.1"} 1' in text
+    assert 'demo_seconds_bucket{stage="x",le="1"} 2' in text
+    assert 'demo_seconds_bucket{stage="x",le="+Inf"} 3' in text
+    assert 'demo_seconds_count{stage="x"} 3' in text
+
+    trace_id = "4bf92f3577b34da6a3ce929d0e0e4736"
+    assert trace_id_from_headers(f"00-{trace_id}-00f067aa0ba902b7-01", None) == trace_id
+    trace = Trace(trace_id)
+    token = current_trace.set(trace)
+    try:
+        with stage("parse"):
+            pass
+    finally:
+        current_trace.reset(token)
+    assert [span[0] for span in trace.spans] == ["parse"]
+
+def test_upload_size_limit(monkeypatch):
+    """Test that oversized uploads get 413, whether or not Content-Length is declared"""
+    from src.backend import main
+
+    monkeypatch.setitem(main.upload_limits, "/api/analyze", 1024)
+    response = client.post("/api/analyze", files={"file": ("big.jpg", b"\xff" * 4096, "image/jpeg")})
+    assert response.status_code == 413
+
+    def chunked_body():
+        yield b"--boundary\r\nContent-Disposition: form-data; name=\"file\"; filename=\"big.jpg\"\r\n"
+        yield b"Content-Type: image/jpeg\r\n\r\n"
+        for _ in range(8):
+            yield b"\xff" * 512
+        yield b"\r\n--boundary--\r\n"
+
+    response = client.post(
+        "/api/analyze",
+        content=chunked_body(),
+        headers={"Content-Type": "multipart/form-data; boundary=boundary"},
+    )
+    assert response.status_code == 413
+
+def test_data_url_matches_b64encode():
+    """Test that chunked base64 encoding produces the same data URL"""
+    from src.backend.uploads import data_url
+
+    for size in (0, 1, 2, 3, 196607, 196608, 196610, 1000003):
+        content = os.urandom(size)
+        expected = f"data:image/jpeg;base64,{base64.b64encode(content).decode('utf-8')}"
+        assert data_url(content, "image/jpeg") == expected
+
+def test_spooled_upload_is_not_read_into_memory():
+    """Test that hashing and preprocessing a spooled upload keep peak memory below its size"""
+    import tempfile
+    import tracemalloc
+    import numpy as np
+    from PIL import Image
+    from src.backend.cache import image_digest
+    from src.backend.preprocess import prepare_image
+
+    noise = np.random.default_rng(0).integers(0, 256, size=(2400, 3200, 3), dtype=np.uint8)
+    upload = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    Image.fromarray(noise).save(upload, format="JPEG", quality=95)
+    size = upload.tell()
+    assert size > 4 * 1024 * 1024
+
+    tracemalloc.start()
+    try:
+        digest = image_digest(upload)
+        prepared = prepare_image(upload, "image/jpeg")
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        upload.close()
+
+    assert len(digest) == 64
+    assert max(prepared.width, prepared.height) <= 2048 and min(prepared.width, prepared.height) <= 768
+    assert peak < size / 2
+
+def _write_catalog(tmp_path):
+    from src.backend.catalog import build_index, read_feed
+
+    feed = tmp_path / "feed.jsonl"
+    products = [
+        {"id": "1", "title": "Chunky Cable-Knit Cardigan", "description": "Oversized wool cardigan", "category": "Sweaters",
+         "color": "Cream", "price": "$98.00", "image_link": "https://img.example/1.jpg", "link": "https://shop.example/1"},
+        {"id": "2", "title": "Fine Merino Cardigan", "description": "Lightweight layering cardigan", "category": "Sweaters",
+         "color": "Black", "price": "$249.00", "image_link": "https://img.example/2.jpg", "link": "https://shop.example/2"},
+        {"id": "3", "title": "Pleated Wide-Leg Trousers", "description": "High-rise pleated trousers", "category": "Pants",
+         "color": "Brown", "price": "$120.00", "image_link": "https://img.example/3.jpg", "link": "https://shop.example/3"},
+        {"id": "4", "title": "Leather Penny Loafers", "description": "Classic loafers", "category": "Shoes",
+         "color": "Brown", "price": "$180.00", "image_link": "https://img.example/4.jpg", "link": "https://shop.example/4"},
+    ]
+    feed.write_text("\n".join(json.dumps(p) for p in products) + "\n")
+    build_index(read_feed(str(feed)), str(tmp_path / "index"))
+    return str(tmp_path / "index")
+
+def test_catalog_bm25_search_and_filters(tmp_path):
+    """Test BM25 ranking, attribute filters and item matching on a memory-mapped catalog"""
+    from src.backend.catalog import CatalogIndex
+
+    catalog = CatalogIndex.open(_write_catalog(tmp_path))
+    assert [p["id"] for p, _ in catalog.search("wool cardigan", k=2)] == ["1", "2"]
+    assert [p["id"] for p, _ in catalog.search("cardigan", color="black")] == ["2"]
+    assert [p["id"] for p, _ in catalog.search("cardigan", price_band="premium")] == ["2"]
+    assert catalog.search("cardigan", category="shoes") == []
+    assert catalog.search("sequin gown") == []
+
+    # Color named in the item text narrows the match; an impossible price is relaxed
+    assert catalog.match("Black Cardigan", "Sleek knit layer")["id"] == "2"
+    assert catalog.match("Cream cardigans", "Around $10")["id"] == "1"
+    assert catalog.match("Sequin gown") is None
+    catalog.close()
+
+@patch("src.backend.main.client.chat.completions.create", new_callable=AsyncMock)
+def test_analyze_matches_catalog_products(mock_create, sample_image, monkeypatch, tmp_path):
+    """Test that suggested items link to catalog products when a catalog is configured"""
+    from src.backend import main
+    from src.backend.catalog import CatalogIndex
+
+    monkeypatch.setattr(main, "catalog", CatalogIndex.open(_write_catalog(tmp_path)))
+    mock_response = MagicMock()
+    mock_response.choices = [MagicMock()]
+    mock_response.choices[0].message.content = json.dumps({
+        "description": "Grandpa-core", "colorTones": "", "coreApparel": "", "accessories": "", "fashionTips": [],
+        "similarItems": [
+            {"name": "Brown Penny Loafers", "description": "Leather slip-ons", "priceRange": "$150"},
+            {"name": "Sequin Gown", "description": "Evening wear", "priceRange": "$300"},
+        ],
+    })
+    mock_create.return_value = mock_response
+
+    with open(sample_image, "rb") as f:
+        response = client.post("/api/analyze", files={"file": ("test.jpg", f, "image/jpeg")})
+
+    items = response.json()["suggestedItems"]
+    assert items[0]["name"] == "Leather Penny Loafers"
+    assert items[0]["productUrl"] == "https://shop.example/4"
+    assert items[0]["imageUrl"] == "https://img.example/4.jpg"
+    # Unmatched items keep their search links
+    assert items[1]["productUrl"] == "https://www.nordstrom.com/s/sequin-gown"
+
+def test_vector_index_ivf_matches_exact_search(tmp_path):
+    """Test IVF search against brute force, and embedding matches for suggested items"""
+    import numpy as np
+    from src.backend.catalog import CatalogIndex, read_feed
+    from src.backend.vectors import HashingEmbedder, VectorIndex, build_vector_index, item_text, product_text
+
+    rng = np.random.default_rng(1)
+    embeddings = rng.standard_normal((2000, 32)).astype(np.float32)
+    build_vector_index(embeddings, str(tmp_path), embedder="synthetic", n_lists=16, dtype="float32")
+    index = VectorIndex.open(str(tmp_path))
+    queries = embeddings[:8] + 0.05 * rng.standard_normal((8, 32)).astype(np.float32)
+
+    exact = index.exact_search(queries, k=5)
+    assert [int(ids[0]) for ids, _ in exact] == list(range(8))
+    # Probing every partition is exact; probing a few still finds the near-duplicates
+    full = index.search(queries, k=5, n_probe=16)
+    assert all(np.array_equal(a[0], e[0]) for a, e in zip(full, exact))
+    assert [int(ids[0]) for ids, _ in index.search(queries, k=5, n_probe=4)] == list(range(8))
+
+    (tmp_path / "catalog").mkdir()
+    directory = _write_catalog(tmp_path / "catalog")
+    embedder = HashingEmbedder(64)
+    products = list(read_feed(str(tmp_path / "catalog" / "feed.jsonl")))
+    build_vector_index(embedder.encode([product_text(p) for p in products]), directory, embedder="hashing:64")
+    vectors = VectorIndex.open(directory)
+    items = [{"name": "Cable Knit Cardigan", "description": "chunky"}, {"name": "Knit Cardigan", "description": ""}]
+    matched = vectors.match_items(items, embedder.encode([item_text(i) for i in items]), CatalogIndex.open(directory))
+    # The second item is steered to a different product than the first
+    assert matched[0]["productUrl"] == "https://shop.example/1"
+    assert matched[1]["productUrl"] == "https://shop.example/2"
+
+def test_vector_index_requires_a_servable_embedder(tmp_path, capsys):
+    """Test that precomputed embeddings cannot be indexed under an embedder the server cannot use"""
+    from src.backend import vectors
+
+    np_path = tmp_path / "emb.npy"
+    for argv in ([str(tmp_path / "feed.csv"), str(tmp_path), "--embeddings", str(np_path)],
+                 [str(tmp_path / "feed.csv"), str(tmp_path), "--embeddings", str(np_path), "--embedder", "external"]):
+        with pytest.raises(SystemExit) as excinfo:
+            vectors.main(argv)
+        assert excinfo.value.code == 2
+    assert "azure:<deployment> or hashing:<dim>" in capsys.readouterr().err
+
+@patch("src.backend.main.client.chat.completions.create", new_callable=AsyncMock)
+def test_concurrent_identical_uploads_share_one_call(mock_create, sample_image):
+    """Test that simultaneous analyses of one image make a single upstream call"""
+    import asyncio
+    from src.backend import main
+    from src.backend.singleflight import SingleFlight
+
+    mock_response = MagicMock()
+    mock_response.choices = [MagicMock()]
+    mock_response.choices[0].message.content = MOCK_ANALYSIS_TEXT
+
+    async def slow_create(**kwargs):
+        await asyncio.sleep(0.05)
+        return mock_response
+    mock_create.side_effect = slow_create
+
+    with open(sample_image, "rb") as f:
+        content = f.read()
+
+    async def uploads():
+        return await asyncio.gather(*(main.analyze_upload(content, "image/jpeg") for _ in range(5)))
+
+    results = asyncio.run(uploads())
+    assert mock_create.call_count == 1
+    assert all(result == results[0] for result in results)
+
+    async def cancellation():
+        flights = SingleFlight()
+        release = asyncio.Event()
+        calls = []
+
+        async def work():
+            calls.append(1)
+            await release.wait()
+            return "done"
+
+        first = asyncio.create_task(flights.do("k", work))
+        second = asyncio.create_task(flights.do("k", work))
+        await asyncio.sleep(0)
+        # One waiter leaving does not cancel the call for the other
+        first.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        assert await second == "done"
+        assert first.cancelled() and len(calls) == 1
+
+        # The last waiter leaving cancels the call
+        release.clear()
+        third = asyncio.create_task(flights.do("k", work))
+        await asyncio.sleep(0)
+        shared = flights._flights["k"].task
+        third.cancel()
+        await asyncio.gather(third, return_exceptions=True)
+        await asyncio.sleep(0)
+        assert shared.cancelled() and len(flights) == 0
+        assert flights.stats()["coalesced"] == 1 and flights.stats()["abandoned"] == 1
+
+    asyncio.run(cancellation())
+
+@patch("src.backend.main.client.chat.completions.create", new_callable=AsyncMock)
+def test_analysis_jobs_persist_results(mock_create, sample_image, monkeypatch, tmp_path):
+    """Test submitting a job, following its events, and reading the stored result later"""
+    from src.backend import main
+    from src.backend.jobs import JobQueue, JobStore
+
+    mock_response = MagicMock()
+    mock_response.choices = [MagicMock()]
+    mock_response.choices[0].message.content = MOCK_ANALYSIS_TEXT
+    mock_create.return_value = mock_response
+    db_path = str(tmp_path / "jobs.sqlite3")
+    monkeypatch.setattr(main, "job_queue", JobQueue(JobStore(db_path), main.analyze_job, workers=2))
+
+    with TestClient(app) as jobs_client:
+        with open(sample_image, "rb") as f:
+            submitted = jobs_client.post("/api/jobs", files={"file": ("test.jpg", f, "image/jpeg")})
+        assert submitted.status_code == 202
+        job_id = submitted.json()["jobId"]
+        assert submitted.headers["location"] == f"/api/jobs/{job_id}"
+
+        with jobs_client.stream("GET", f"/api/jobs/{job_id}/events") as stream:
+            body = "".join(stream.iter_text())
+        events = [block.split("\n") for block in body.strip().split("\n\n") if block.startswith("event:")]
+        assert events[-1][0] == "event: result"
+        result = json.loads(events[-1][1][len("data: "):])
+        assert result["fashionTips"] == ["Tip 1", "Tip 2"]
+
+        assert jobs_client.get("/api/jobs/unknown").status_code == 404
+        assert jobs_client.post("/api/jobs", files={"file": ("a.txt", b"text", "text/plain")}).status_code == 400
+
+    # A client reconnecting after a restart gets the stored result without a new analysis
+    job = JobStore(db_path).get(job_id)
+    assert job["status"] == "done" and job["result"] == result
+    assert mock_create.call_count == 1
+
+def test_job_store_recovers_interrupted_jobs(tmp_path):
+    """Test that a job claimed by a dead worker is queued again, then failed after too many attempts"""
+    from src.backend.jobs import JobStore
+
+    store = JobStore(str(tmp_path / "jobs.sqlite3"))
+    job_id = store.submit(b"image", "image/jpeg")
+    assert store.claim() == (job_id, b"image", "image/jpeg", 1)
+    assert store.claim() is None
+    assert store.recover(stale_after=0, max_attempts=2) == 1
+    assert store.claim()[0] == job_id
+    assert store.recover(stale_after=0, max_attempts=2) == 0
+    job = store.get(job_id)
+    assert job["status"] == "failed" and job["attempts"] == 2
+
+def test_analysis_job_stops_backing_off_before_it_would_be_presumed_dead(monkeypatch):
+    """Test that a job attempt fails under sustained overload instead of waiting until it is re-queued"""
+    import asyncio
+    from fastapi import HTTPException
+    from src.backend import main
+    from src.backend.scheduler import SchedulerOverloaded
+
+    assert main.job_max_wait + main.analyze_timeout < main.job_stale_after
+    attempts = []
+
+    async def overloaded(image_contents, content_type):
+        attempts.append(content_type)
+        if len(attempts) > 2:
+            raise RuntimeError("kept backing off past job_max_wait")
+        raise SchedulerOverloaded("Too many analyses are queued")
+
+    monkeypatch.setattr(main, "analyze_upload", overloaded)
+    monkeypatch.setattr(main, "job_max_wait", 0.2)
+
+    with pytest.raises(HTTPException) as raised:
+        asyncio.run(main.analyze_job(b"image", "image/jpeg"))
+    assert raised.value.status_code == 503
+    # One back-off of 0.5 s would already pass the 0.2 s cap
+    assert len(attempts) == 1
+
+def test_job_store_rejects_results_from_superseded_claims(tmp_path):
+    """Test that a slow worker whose job was re-queued as stale cannot overwrite the retry's result"""
+    from src.backend.jobs import JobStore
+
+    store = JobStore(str(tmp_path / "jobs.sqlite3"))
+    job_id = store.submit(b"image", "image/jpeg")
+    first = store.claim()
+    assert store.recover(stale_after=0, max_attempts=3) == 1
+    second = store.claim()
+    assert (first[3], second[3]) == (1, 2)
+
+    assert store.finish(job_id, second[3], result={"fashionTips": ["retry"]})
+    assert not store.finish(job_id, first[3], error={"status": 500, "detail": "late"})
+    job = store.get(job_id)
+    assert job["status"] == "done" and job["result"] == {"fashionTips": ["retry"]}
+
+def test_job_queue_drops_change_events_nobody_waits_for(tmp_path):
+    """Test that waiting on jobs this process never finishes leaves no per-job state behind"""
+    import asyncio
+    from src.backend.jobs import JobQueue, JobStore
+
+    async def analyze(content, content_type):
+        return {}
+
+    queue = JobQueue(JobStore(str(tmp_path / "jobs.sqlite3")), analyze)
+
+    async def waits():
+        await asyncio.gather(*(queue.wait(job_id, timeout=0.01) for job_id in ("a", "a", "b")))
+
+    asyncio.run(waits())
+    assert queue._changes == {} and queue._waiters == {}
+
+def test_import_is_lazy_and_does_not_require_config(tmp_path):
+    """Test that the module imports without credentials and without loading the OpenAI SDK"""
+    import subprocess
+    import sys
+
+    env = {key: value for key, value in os.environ.items() if not key.startswith("AZURE_OPENAI")}
+    result = subprocess.run(
+        [sys.executable, "-c", "import sys, src.backend.main; print('openai' in sys.modules)"],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        env={**env, "JOBS_DB_PATH": str(tmp_path / "jobs.sqlite3")},
+        capture_output=True, text=True,
+    )
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == "False"
+
+def test_health_and_readiness(monkeypatch, tmp_path):
+    """Test liveness, and readiness following warm-up and upstream reachability"""
+    import time
+    from src.backend import main
+    from src.backend.jobs import JobQueue, JobStore
+
+    reachable = {"value": True}
+
+    async def probe(make_client):
+        return {"reachable": reachable["value"]}
+
+    monkeypatch.setattr(main, "probe_upstream", probe)
+    monkeypatch.setattr(main, "upstream_probed_at", 0.0)
+    monkeypatch.setattr(main, "job_queue", JobQueue(JobStore(str(tmp_path / "jobs.sqlite3")), main.analyze_job))
+
+    with TestClient(app) as live_client:
+        assert live_client.get("/healthz").json() == {"status": "ok"}
+        for _ in range(100):
+            ready = live_client.get("/readyz")
+            if ready.status_code == 200:
+                break
+            time.sleep(0.01)
+        assert ready.status_code == 200
+        assert ready.json()["backends"]["primary"]["reachable"] is True
+
+        # Probes are cached; an expired result is refreshed on the next check
+        reachable["value"] = False
+        assert live_client.get("/readyz").status_code == 200
+        main.upstream_probed_at = 0.0
+        unready = live_client.get("/readyz")
+        assert unready.status_code == 503
+        assert unready.json()["status"] == "unavailable"
+
+def test_pooled_http_client_limits_and_metrics():
+    """Test the upstream HTTP pool settings and that pool usage is exported"""
+    from src.backend import main
+    from src.backend.upstream import pool_stats, pooled_http_client
+
+    http_client = pooled_http_client(max_connections=8, connect_timeout=2, read_timeout=30, pool_timeout=3, http2=False)
+    assert (http_client.timeout.connect, http_client.timeout.read, http_client.timeout.pool) == (2, 30, 3)
+    assert pool_stats(http_client) == {"connections": 0, "active": 0, "idle": 0, "waiting": 0, "http2": False}
+
+    # The primary SDK client sends through its configured pool
+    assert main.client._client is main.http_pools["primary"]
+    assert 'stylefinder_upstream_pool_connections{backend="primary"}' in client.get("/metrics").text
+    assert "waiting" in client.get("/api/upstream/stats").json()["backends"]["primary"]["pool"]
+
+def test_encode_analysis_matches_fastapi_json():
+    """Test that the fast encoder writes exactly what FastAPI's default path would"""
+    from fastapi.encoders import jsonable_encoder
+    from src.backend.encoding import encode_analysis
+    from src.backend.schemas import AnalysisResponse
+
+    payload = {
+        "analysis": {"description": 'A "quoted" café look\n', "colorTones": "Navy   & ivory 👗",
+                     "coreApparel": "Blazer", "unknown": "dropped"},
+        "fashionTips": ["Tip \\ one", "Tip\ttwo"],
+        "suggestedItems": [{"name": "Coat", "description": "Wool", "imageUrl": "", "productUrl": "https://x/y?a=1&b=2"},
+                           {"name": "Scarf"}],
+    }
+    expected = json.dumps(jsonable_encoder(AnalysisResponse.model_validate(payload)),
+                          ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+    assert encode_analysis(payload) == expected
+    assert json.loads(encode_analysis(SAMPLE_RESPONSE)) == SAMPLE_RESPONSE
+
+@patch("src.backend.main.client.chat.completions.create", new_callable=AsyncMock)
+def test_analysis_etag_and_conditional_get(mock_create, sample_image):
+    """Test that a result can be re-fetched by digest and revalidated with If-None-Match"""
+    mock_response = MagicMock()
+    mock_response.choices = [MagicMock()]
+    mock_response.choices[0].message.content = MOCK_ANALYSIS_TEXT
+    mock_create.return_value = mock_response
+
+    with open(sample_image, "rb") as f:
+        posted = client.post("/api/analyze", files={"file": ("test.jpg", f, "image/jpeg")})
+    assert posted.status_code == 200
+    location = posted.headers["content-location"]
+    assert location.startswith("/api/analysis/")
+
+    fetched = client.get(location)
+    assert fetched.status_code == 200
+    assert fetched.json() == posted.json()
+    etag = fetched.headers["etag"]
+    # Same bytes, same tag (weakened if the response was compressed)
+    assert etag.replace("W/", "") == posted.headers["etag"].replace("W/", "")
+
+    not_modified = client.get(location, headers={"If-None-Match": etag})
+    assert not_modified.status_code == 304
+    assert not_modified.content == b""
+    assert not_modified.headers["etag"] == etag
+    assert client.get(location, headers={"If-None-Match": '"other"'}).status_code == 200
+    assert client.get("/api/analysis/" + "0" * 64).status_code == 404
+    assert mock_create.call_count == 1
+
+def test_compression_middleware_negotiates_and_skips_small_or_streamed_bodies():
+    """Test gzip above the size threshold only, with Vary and a weakened ETag"""
+    from fastapi import FastAPI
+    from fastapi.responses import JSONResponse, StreamingResponse
+    from src.backend.compression import CompressionMiddleware, choose_encoding
+
+    assert choose_encoding("gzip, br", ("br", "gzip")) == "br"
+    assert choose_encoding("gzip;q=1, br;q=0.5", ("br", "gzip")) == "gzip"
+    assert choose_encoding("br;q=0, *;q=0.1", ("br", "gzip")) == "gzip"
+    assert choose_encoding("identity", ("br", "gzip")) is None
+
+    small_app = FastAPI()
+    small_app.add_middleware(CompressionMiddleware, minimum_size=512, encodings=["gzip"])
+    big = {"items": ["the same outfit suggestion"] * 100}
+
+    @small_app.get("/big")
+    def get_big():
+        return JSONResponse(big, headers={"ETag": '"abc"'})
+
+    @small_app.get("/small")
+    def get_small():
+        return {"ok": True}
+
+    @small_app.get("/stream")
+    def get_stream():
+        return StreamingResponse(iter([b"x" * 600, b"y" * 600]), media_type="text/plain")
+
+    test_client = TestClient(small_app)
+    response = test_client.get("/big", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert response.headers["etag"] == 'W/"abc"'
+    assert int(response.headers["content-length"]) < len(json.dumps(big)) / 5
+    assert response.json() == big
+
+    raw = test_client.get("/big", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in raw.headers
+    assert raw.headers["vary"] == "Accept-Encoding"
+    assert raw.headers["etag"] == '"abc"'
+
+    assert "content-encoding" not in test_client.get("/small", headers={"Accept-Encoding": "gzip"}).headers
+    streamed = test_client.get("/stream", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in streamed.headers
+    assert streamed.content == b"x" * 600 + b"y" * 600
+
+def test_choose_detail_levels_fits_the_token_budget():
+    """Test that the costliest images drop to low detail first, later photos before earlier ones"""
+    from src.backend.upstream import choose_detail_levels
+
+    sizes = [(1200, 1600), (1600, 1200), (400, 400)]
+    assert choose_detail_levels(sizes, 0) == ["high", "high", "high"]
+    assert choose_detail_levels(sizes, 1800) == ["high", "high", "high"]
+    assert choose_detail_levels(sizes, 1200) == ["high", "low", "high"]
+    assert choose_detail_levels(sizes, 500) == ["low", "low", "high"]
+    assert choose_detail_levels(sizes, 100) == ["low", "low", "low"]
+    # Photos that fit the 512px low-detail render start there
+    assert choose_detail_levels(sizes, 0, low_detail_max_edge=512) == ["high", "high", "low"]
+
+@patch("src.backend.main.client.chat.completions.create", new_callable=AsyncMock)
+def test_analyze_multi_sends_all_photos_in_one_call(mock_create, monkeypatch):
+    """Test that several photos of an outfit are analyzed with one model call"""
+    from src.backend import main
+    mock_response = MagicMock()
+    mock_response.choices = [MagicMock()]
+    mock_response.choices[0].message.content = MOCK_ANALYSIS_TEXT
+    mock_create.return_value = mock_response
+    monkeypatch.setattr(main, "multi_image_token_budget", 1200)
+
+    photos = [("front.jpg", _encode(_outfit_like_image((1200, 1600)))),
+              ("back.jpg", _encode(_outfit_like_image((1600, 1200)))),
+              ("detail.png", _encode(_outfit_like_image((400, 400)), "PNG"))]
+    files = [("files", (name, content, "image/png" if name.endswith(".png") else "image/jpeg"))
+             for name, content in photos]
+    response = client.post("/api/analyze/multi", files=files)
+
+    assert response.status_code == 200
+    assert response.json()["analysis"]["description"] == "Test description"
+    assert mock_create.call_count == 1
+    content = mock_create.call_args.kwargs["messages"][0]["content"]
+    assert content[0]["text"].startswith("These 3 photos show the same outfit")
+    # The 400px close-up fits the low-detail render; the back shot is dropped to low to meet the budget
+    assert [part["image_url"]["detail"] for part in content[1:]] == ["high", "low", "low"]
+    assert "llm;dur=" in response.headers["Server-Timing"]
+
+    # The same set is answered from the cache, and can be fetched again by its digest
+    assert client.post("/api/analyze/multi", files=files).json() == response.json()
+    assert mock_create.call_count == 1
+    assert client.get(response.headers["content-location"]).json() == response.json()
+
+    too_many = [files[0]] * (main.multi_image_max_images + 1)
+    assert client.post("/api/analyze/multi", files=too_many).status_code == 400
+    assert client.post("/api/analyze/multi", files=[files[0], ("files", ("a.txt", b"x", "text/plain"))]).status_code == 400
+
+def test_usage_ledger_writes_batches_on_its_own_thread(tmp_path):
+    """Test that recording usage hands full batches to the writer thread instead of committing inline"""
+    import threading
+    from src.backend.usage import UsageLedger
+
+    ledger = UsageLedger(str(tmp_path / "usage.sqlite3"), batch_size=2, flush_interval=3600)
+    write = ledger._write
+    writers = []
+
+    def recording_write(rows):
+        writers.append((threading.current_thread(), len(rows)))
+        write(rows)
+    ledger._write = recording_write
+
+    for latency in (0.1, 0.2, 0.3):
+        ledger.record("markdown-v1", "primary", ["low"], 256, 100, 50, "stop", latency, None)
+    ledger.flush()
+
+    assert [rows for _, rows in writers] == [2, 1]
+    assert threading.current_thread() not in [thread for thread, _ in writers]
+    assert ledger.summary()["templates"]["markdown-v1"]["requests"] == 3
+    ledger.close()
+
+def test_max_tokens_tuner_tracks_completion_lengths():
+    """Test that max_tokens follows observed lengths and falls back to the ceiling after a truncation"""
+    from src.backend.prompts import MaxTokensTuner
+
+    tuner = MaxTokensTuner(ceiling=1000, min_samples=20)
+    for tokens in range(300, 319):
+        tuner.observe("structured-v3", tokens)
+    assert tuner.max_tokens("structured-v3") == 1000, "too few samples yet"
+    tuner.observe("structured-v3", 320)
+    assert tuner.max_tokens("structured-v3") == 448  # 320 * 1.25, rounded up to a multiple of 64
+    assert tuner.max_tokens("markdown-v1") == 1000
+
+    tuner.observe("structured-v3", None, truncated=True)
+    assert tuner.max_tokens("structured-v3") == 1000
+    assert tuner.stats()["structured-v3"] == {"maxTokens": 1000, "samples": 0, "truncations": 1}
+    assert MaxTokensTuner(ceiling=1000, enabled=False).max_tokens("structured-v3") == 1000
+
+@patch("src.backend.main.client.chat.completions.create", new_callable=AsyncMock)
+def test_truncated_answer_is_retried_and_usage_recorded(mock_create, sample_image, monkeypatch):
+    """Test that a cut-off answer is asked again at the full budget, and each call's cost is recorded"""
+    from src.backend import main
+    from src.backend.prompts import MaxTokensTuner
+
+    def completion(text, finish_reason, completion_tokens):
+        response = MagicMock()
+        response.choices = [MagicMock()]
+        response.choices[0].message.content = text
+        response.choices[0].finish_reason = finish_reason
+        response.usage.prompt_tokens = 300
+        response.usage.completion_tokens = completion_tokens
+        return response
+
+    tuner = MaxTokensTuner(ceiling=main.max_tokens, min_samples=1)
+    tuner.observe(main.prompt_template.key, 100)
+    monkeypatch.setattr(main, "max_tokens_tuner", tuner)
+    monkeypatch.setattr(main, "prompt_token_price", 2.5)
+    monkeypatch.setattr(main, "completion_token_price", 10.0)
+    mock_create.side_effect = [completion(MOCK_ANALYSIS_TEXT[:40], "length", 256),
+                               completion(MOCK_ANALYSIS_TEXT, "stop", 180)]
+
+    with open(sample_image, "rb") as f:
+        response = client.post("/api/analyze", files={"file": ("test.jpg", f, "image/jpeg")})
+
+    assert response.status_code == 200
+    assert response.json()["fashionTips"] == ["Tip 1", "Tip 2"]
+    assert [call.kwargs["max_tokens"] for call in mock_create.call_args_list] == [256, main.max_tokens]
+    # The 100x100 sample fits the low-detail render
+    assert mock_create.call_args.kwargs["messages"][0]["content"][1]["image_url"]["detail"] == "low"
+
+    stats = client.get("/api/usage/stats").json()
+    usage = stats["templates"][main.prompt_template.key]
+    assert usage["requests"] == 2
+    assert usage["truncated"] == 1
+    assert usage["meanCompletionTokens"] == 218
+    assert usage["totalCost"] == pytest.approx(2 * 300 * 2.5 / 1000 + (256 + 180) * 10.0 / 1000)
+    assert stats["maxTokens"][main.prompt_template.key]["truncations"] == 1